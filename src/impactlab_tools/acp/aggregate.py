@@ -1,9 +1,26 @@
 
 
-import xarray as xr
+from functools import cache
 import os
 
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import xarray as xr
+
 import impactlab_tools.assets
+from impactlab_tools.utils.sparse import (
+    array_key, membership_matrix, sparse_sum)
+
+
+# temporary dimension holding the groups of all requested levels
+_GROUP_DIM = '__population_weighted_mean_group__'
+
+# group codes and sparse membership matrices of population datasets, by level
+_MEMBERSHIP_CACHE = {}
+
+# number of population datasets and levels kept in the membership cache
+_MEMBERSHIP_CACHE_SIZE = 64
 
 
 def population_weighted_mean(
@@ -11,20 +28,30 @@ def population_weighted_mean(
         level='state',
         dim='fips',
         year=2012,
-        pop=None):
+        pop=None,
+        combine_dim=None,
+        year_dim=None,
+        year_method='nearest'):
     '''
     Find the population-weighted mean of a county-level xarray DataArray
 
+    The population in every group of ``level`` is summed with a cached sparse
+    membership matrix along ``dim``. When several levels are requested,
+    the weighted sums of the finest level are computed from the counties
+    once and rolled up to every coarser level nested in it (e.g. state sums
+    to census regions and to the nation).
+
     Parameters
     ----------
     ds : array
         :py:class:`~xarray.DataArray` to be aggregated. May contain any number
         of dimensions >= 1.
 
-    level : str (optional)
+    level : str or list of str (optional)
         Level of resolution to aggregate to. May be one of ``'fips'``,
         ``'state'``, ``'state_names'``, ``'state_abbrevs'``, ``'census'``,
-        or ``'national'`` (default ``'state'``)
+        or ``'national'`` (default ``'state'``). If a list, all levels are
+        computed in one call.
 
     dim : str (optional)
         dimension to aggregate along (default ``'fips'``)
@@ -34,28 +61,296 @@ def population_weighted_mean(
         weights. If not provided, 2012 population is used.
 
     pop : array (optional)
-        :py:class:`~xarray.DataArray` to use for weights. If not provided,
-        US Census Bureau 2014 vintage CO-EST2014-alldata.csv estimates from
-        the ACP are used
+        :py:class:`~xarray.Dataset` of population by year (one variable per
+        year) to use for weights. If not provided, US Census Bureau 2014
+        vintage CO-EST2014-alldata.csv estimates from the ACP are used (see
+        :py:func:`acp_population`)
+
+    combine_dim : str (optional)
+        if provided with a list of levels, the means of all levels are
+        concatenated along this dimension, indexed by ``level`` and
+        ``group``
+
+    year_dim : str (optional)
+        if provided, the weights vary along this time dimension of ``ds``
+        (years or dates) instead of using a single ``year``. The population
+        of every time step is chosen with ``year_method`` and all steps are
+        aggregated at once.
+
+    year_method : str (optional)
+        ``'nearest'`` (default) to use the population of the nearest
+        available year, or ``'linear'`` to interpolate between available
+        years. Steps outside the available years use the first or last
+        year.
 
     Returns
     -------
     mean : array
-        weighted average aggregated :py:class:`~xarray.DataArray`
+        weighted average aggregated :py:class:`~xarray.DataArray`, with
+        ``level`` in place of ``dim``. If ``level`` is a list, a dict of
+        means by level, or the means of all levels along ``combine_dim``.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> pop = acp_population()
+        >>> da = xr.DataArray(
+        ...     np.ones(pop.sizes['fips']),
+        ...     dims=['fips'],
+        ...     coords={'fips': pop.fips})
+        ...
+        >>> means = population_weighted_mean(da, ['state', 'national'])
+        >>> means['national'].values
+        array([1.])
+
+    '''
+
+    if year_dim is not None:
+        weights = _population_by_step(
+            acp_population() if pop is None else _stack_years(pop),
+            ds.indexes[year_dim], year_dim, year_method)
+
+    elif pop is None:
+        weights = acp_population().sel(year=year, drop=True)
+
+    else:
+        weights = pop[str(year)]
+
+    if pop is None and dim != 'fips':
+        weights = weights.rename({'fips': dim})
+
+    levels = [level] if isinstance(level, str) else list(level)
+
+    # inner join on ``dim``, as in ``ds * weights``
+    ds, _ = xr.align(ds, weights[dim], join='inner')
+    columns = weights.indexes[dim].get_indexer(ds.indexes[dim])
+
+    if year_dim is None:
+        values = weights.values.astype('float64')
+        folded = values[columns]
+
+    else:
+        # weights by (county, step) are applied to the data directly, and
+        # the sparse sums are unweighted
+        values = weights.transpose(dim, year_dim).values
+        ds = ds * weights
+        folded = np.ones(len(columns))
+
+    groupings = {name: _grouping(weights, name, dim) for name in levels}
+
+    # as with a groupby, only groups present in ``ds`` are returned
+    present = {}
+    for name, (codes, _, _) in groupings.items():
+        present[name] = np.unique(codes[columns])
+        present[name] = present[name][present[name] >= 0]
+
+    # finest levels first, so that coarser levels can roll up the sums of
+    # the closest level nested in them
+    order = sorted(levels, key=lambda name: -len(present[name]))
+    parents = {}
+    for i, name in enumerate(order):
+        for finer in reversed(order[:i]):
+            if _nests(groupings[finer][0], groupings[name][0]):
+                parents[name] = finer
+                break
+
+    roots = [name for name in order if name not in parents]
+
+    # population-weighted membership of the root levels, summed from the
+    # counties in one sparse product
+    matrix = scipy.sparse.vstack(
+        [groupings[name][2][present[name]][:, columns] for name in roots],
+        format='csr') @ scipy.sparse.diags(folded)
+
+    root_sums = sparse_sum(ds, matrix, dim, _GROUP_DIM)
+
+    sums = {}
+    start = 0
+    for name in roots:
+        stop = start + len(present[name])
+        sums[name] = root_sums.isel({_GROUP_DIM: slice(start, stop)})
+        start = stop
+
+    for name in order:
+        if name in parents:
+            parent = parents[name]
+            sums[name] = sparse_sum(
+                sums[parent].rename({_GROUP_DIM: parent}),
+                _rollup_matrix(
+                    groupings[parent][0], groupings[name][0],
+                    present[parent], present[name]),
+                parent,
+                _GROUP_DIM)
+
+    means = {}
+    for name in levels:
+        codes, groups, membership = groupings[name]
+
+        # each group is normalized by its total population
+        total = membership[present[name]] @ values
+
+        if year_dim is None:
+            total = xr.DataArray(total, dims=[_GROUP_DIM])
+        else:
+            total = xr.DataArray(
+                total, dims=[_GROUP_DIM, year_dim],
+                coords={year_dim: weights.coords[year_dim]})
+
+        mean = sums[name] / total
+        mean = mean.rename({_GROUP_DIM: name}).assign_coords(
+            {name: groups[present[name]]})
+
+        # as with a groupby, fips-level means keep the other levels
+        if name == dim and combine_dim is None:
+            mean = mean.assign_coords({
+                coord: (dim, weights.coords[coord].values[
+                    weights.indexes[dim].get_indexer(mean.indexes[dim])])
+                for coord in weights.coords
+                if coord != dim and weights.coords[coord].dims == (dim, )})
+
+        means[name] = mean
+
+    if isinstance(level, str):
+        return means[level]
+
+    if combine_dim is not None:
+        return _combine_levels(means, combine_dim)
+
+    return means
+
+
+@cache
+def acp_population():
+    '''
+    County population of the ACP by ``fips`` and ``year``
+
+    The asset is read once per process and kept in memory as a read-only
+    float array, with the aggregation levels (``state``, ``census``, ...) as
+    coordinates along ``fips``. Calling this before forking worker processes
+    shares the array with them.
 
+    Returns
+    -------
+    pop : array
+        :py:class:`~xarray.DataArray` of population with dimensions
+        ``('fips', 'year')``
+    '''
+
+    with xr.open_dataset(
+        os.path.join(
+            os.path.dirname(impactlab_tools.assets.__file__),
+            'ACP_county_census_pop.nc')) as ds:
+
+        pop = _stack_years(ds).load()
+
+    pop.values.flags.writeable = False
+
+    return pop
+
+
+def _stack_years(pop):
+    '''
+    Population by ``year`` from a Dataset with one variable per year
+    '''
+
+    years = [name for name in pop.data_vars if str(name).isdigit()]
+
+    stacked = xr.concat(
+        [pop[year] for year in years],
+        dim=pd.Index([int(year) for year in years], name='year'))
+
+    dims = [d for d in stacked.dims if d != 'year'] + ['year']
+
+    return stacked.transpose(*dims).astype('float64')
+
+
+def _population_by_step(pop, steps, year_dim, method):
+    '''
+    Population for every step of ``year_dim``, from population by ``year``
+    '''
+
+    years = steps.year if isinstance(steps, pd.DatetimeIndex) else steps
+    years = np.asarray(years)
+
+    if method == 'nearest':
+        weights = pop.sel(year=years, method='nearest')
+
+    elif method == 'linear':
+        available = pop.indexes['year']
+        weights = pop.interp(
+            year=np.clip(years, available.min(), available.max()))
+
+    else:
+        raise ValueError(
+            f'year_method should be "nearest" or "linear", got "{method}"')
+
+    return weights.rename(year=year_dim).assign_coords({year_dim: steps})
+
+
+def _grouping(weights, level, dim):
+    '''
+    Group codes of the counties, group labels and sparse (group, ``dim``)
+    membership matrix of ``level``
+    '''
+
+    values = weights.coords[level].values
+    key = (
+        level,
+        array_key(weights.indexes[dim].values),
+        array_key(values))
+
+    if key not in _MEMBERSHIP_CACHE:
+        codes, groups = pd.factorize(values, sort=True)
+
+        if len(_MEMBERSHIP_CACHE) >= _MEMBERSHIP_CACHE_SIZE:
+            _MEMBERSHIP_CACHE.clear()
+
+        _MEMBERSHIP_CACHE[key] = (
+            codes,
+            pd.Index(groups).values,
+            membership_matrix(codes, len(groups)))
+
+    return _MEMBERSHIP_CACHE[key]
+
+
+def _nests(fine, coarse):
     '''
+    Whether every group of the ``fine`` codes lies in one ``coarse`` group
+    '''
+
+    if (fine < 0).any() or (coarse < 0).any():
+        return False
+
+    pairs = fine.astype('int64') * (coarse.max() + 1) + coarse
+
+    return len(np.unique(pairs)) == len(np.unique(fine))
+
+
+def _rollup_matrix(fine, coarse, fine_present, coarse_present):
+    '''
+    Sparse (coarse, fine) membership of the present groups of nested levels
+    '''
+
+    parent_of = np.empty(fine.max() + 1, dtype=coarse.dtype)
+    parent_of[fine] = coarse
+
+    return membership_matrix(
+        np.searchsorted(coarse_present, parent_of[fine_present]),
+        len(coarse_present))
+
 
-    if pop is None:
-        with xr.open_dataset(
-            os.path.join(
-                os.path.dirname(impactlab_tools.assets.__file__),
-                'ACP_county_census_pop.nc')) as pop:
+def _combine_levels(means, combine_dim):
 
-            return pop.load()
+    combined = []
+    for name, mean in means.items():
+        index = pd.MultiIndex.from_arrays(
+            [np.full(mean.sizes[name], name), mean.indexes[name].astype(object)],
+            names=['level', 'group'])
 
-        if dim != 'fips':
-            pop = pop.rename({'fips': dim})
+        combined.append(
+            mean.drop_vars(name).rename({name: combine_dim}).assign_coords(
+                xr.Coordinates.from_pandas_multiindex(index, combine_dim)))
 
-    return (
-        ((ds * pop[str(year)]).groupby(level).sum(dim=dim)) /
-        ((pop[str(year)]).groupby(level).sum(dim=dim)))
+    return xr.concat(combined, dim=combine_dim)
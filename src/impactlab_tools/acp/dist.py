@@ -1,8 +1,7 @@
 
 
-import numpy as np
-
-from impactlab_tools.utils.weighting import weighted_quantile_xr, _get_weights
+from impactlab_tools.utils.weighting import weighted_cdf, weighted_quantile_xr
+from impactlab_tools.utils.weightregistry import get_weight_registry
 
 
 def acp_quantiles(
@@ -10,16 +9,18 @@ def acp_quantiles(
         rcp,
         quantiles=[0.05, 0.17, 0.5, 0.83, 0.95],
         values_sorted=False,
-        dim='model'):
+        dim='model',
+        skipna=False):
     """
     Compute quantiles of an xarray distribution using ACP weights
 
     .. NOTE ::
 
-        This function does not control for the number of samples of each model.
-        If they are not constant across models provide a correctly weighted
-        weights array to :py:func:`utils.weighting.weighted_quantile_xr`.
-        We would like to fix this. If you have a good fix we'd love a PR :)
+        To pool several samples per model (e.g. Monte-Carlo batches), pass
+        a list of dimensions such as ``dim=['model', 'batch']``. Each model
+        then keeps its total weight, split equally among its samples. If
+        models have different numbers of samples, pad the missing ones with
+        NaN and set ``skipna=True``.
 
     Parameters
     ----------
@@ -29,9 +30,12 @@ def acp_quantiles(
         indexed by ACP model along the dimension ``dim``. If a Dataset is
         passed, ``acp_quantiles`` computes the weighted quantile for each
         variable in the ``Dataset`` that is indexed by ``dim``.
+        Dask-backed inputs are computed lazily, in parallel over chunks.
 
-    rcp : str
-        RCP weights/models to use ('rcp45', 'rcp85')
+    rcp : str or list of str
+        RCP weights/models to use ('rcp45', 'rcp85'). If a list, quantiles
+        are computed for the weights of every RCP along a new leading
+        dimension ``rcp``, sorting the data only once.
 
     quantiles : list-like, optional
         quantiles of distribution to return. quantiles should be in [0, 1].
@@ -40,11 +44,17 @@ def acp_quantiles(
     values_sorted : bool, optional
         if True, then will avoid sorting of initial array. default False.
 
-    dim : str, optional
+    dim : str or list of str, optional
         dimension along which to retrieve quantiles. The indices of this
         dimension should be valid (case insensitive) ACP climate models.
+        If a list, the first dimension holds the models and the
+        distribution pools all dimensions in the list.
         Default: `'model'`.
 
+    skipna : bool, optional
+        if True, ignore NaN samples and renormalize the weights of the
+        remaining samples separately for every cell. Default False.
+
     Returns
     -------
 
@@ -69,19 +79,77 @@ def acp_quantiles(
 
     """
 
-    # prep weight
-    sample_weight = _get_weights(project='acp', rcp=rcp)
-    sample_weight = sample_weight.rename({'model': dim})
+    if isinstance(rcp, (list, tuple)):
+        sample_weight = {r: _align_acp_weights(data, r, dim) for r in rcp}
+    else:
+        sample_weight = _align_acp_weights(data, rcp, dim)
 
-    # prepare arrays of models to align along `dim` (case insensitive)
-    models_in_data = data.coords[dim].values
-    models_in_data_aligned = np.array([m.lower() for m in models_in_data])
+    return weighted_quantile_xr(
+        data, quantiles, sample_weight=sample_weight, dim=dim, skipna=skipna,
+        weighting_dim='rcp')
 
-    # align weights to match ordering of models (using lowercase models)
-    sample_weight = sample_weight.sel(**{dim: models_in_data_aligned})
 
-    # swap weights coordinate to use model names from data
-    sample_weight.coords[dim] = models_in_data
+def acp_cdf(
+        data,
+        thresholds,
+        rcp,
+        dim='model',
+        skipna=False,
+        exceedance=False):
+    """
+    Weighted probability of thresholds using ACP weights
 
-    return weighted_quantile_xr(
-        data, quantiles, sample_weight=sample_weight, dim=dim)
+    Weights are aligned exactly as in :py:func:`acp_quantiles`.
+
+    Parameters
+    ----------
+
+    data : DataArray or Dataset
+        :py:class:`xarray.DataArray` or :py:class:`xarray.Dataset` with data
+        indexed by ACP model along the dimension ``dim``.
+
+    thresholds : scalar, array-like or DataArray
+        values at which to evaluate the CDF. A
+        :py:class:`xarray.DataArray` broadcasts against the dimensions of
+        ``data`` other than ``dim`` (e.g. a threshold map by region). See
+        :py:func:`.utils.weighting.weighted_cdf`.
+
+    rcp : str
+        RCP weights/models to use ('rcp45', 'rcp85').
+
+    dim : str or list of str, optional
+        dimension holding the ACP models, as in :py:func:`acp_quantiles`.
+        Default: `'model'`.
+
+    skipna : bool, optional
+        if True, ignore NaN samples and renormalize the weights of the
+        remaining samples separately for every cell. Default False.
+
+    exceedance : bool, optional
+        if True, return the probability of exceeding the thresholds
+        instead. Default False.
+
+    Returns
+    -------
+
+    DataArray or Dataset
+        probabilities with ``dim`` dropped
+
+    """
+
+    sample_weight = _align_acp_weights(data, rcp, dim)
+
+    return weighted_cdf(
+        data, thresholds, sample_weight=sample_weight, dim=dim, skipna=skipna,
+        exceedance=exceedance)
+
+
+def _align_acp_weights(data, rcp, dim):
+
+    # with several dimensions, the first one holds the models
+    if not isinstance(dim, str):
+        dim = dim[0]
+
+    # vectorized, case insensitive lookup in the cached weight registry
+    return get_weight_registry().align(
+        data.coords[dim].values, project='acp', rcp=rcp)
@@ -0,0 +1,245 @@
+"""
+Aggregation of impact regions to coarser levels of the GCP hierarchy
+
+Impact region ids (hierids) encode their place in the hierarchy:
+``CAN.1.2.28`` lies in the first-level administrative region ``CAN.1`` of
+the country ``CAN``. :py:func:`region_hierarchy` parses the hierids of the
+agglomerated-world-new regions once per process. :py:func:`aggregate_regions`
+then sums or averages data over regions with cached sparse membership
+matrices, in one sparse matrix product per call instead of a groupby on
+string prefixes.
+
+The levels, from finest to coarsest, are ``'hierid'``, ``'admin1'``,
+``'iso'`` and ``'global'``. Regions without a first-level component (e.g.
+``ABW``) are their own ``admin1`` region.
+"""
+
+from functools import cache
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import xarray as xr
+
+from impactlab_tools.gcp.reindex import get_region_index
+from impactlab_tools.utils.sparse import (
+    array_key, membership_matrix, sparse_sum)
+
+
+LEVELS = ('hierid', 'admin1', 'iso', 'global')
+
+# temporary dimension holding the groups of all requested levels
+_GROUP_DIM = '__aggregate_regions_group__'
+
+# group labels and sparse membership matrices of region lists, by level
+_MATRIX_CACHE = {}
+
+# number of region lists and levels kept in the matrix cache
+_MATRIX_CACHE_SIZE = 64
+
+
+@cache
+def region_hierarchy():
+    """
+    Levels of every impact region of the agglomerated-world-new definitions
+
+    Returns
+    -------
+
+    pandas.DataFrame
+        one row per hierid, in the order of ``GCP_impact_regions.nc``, with
+        the ``admin1``, ``iso`` and ``global`` region of each
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> hierarchy = region_hierarchy()
+        >>> hierarchy.loc['CAN.1.2.28'].to_dict()
+        {'admin1': 'CAN.1', 'iso': 'CAN', 'global': 'global'}
+        >>> hierarchy.loc['ABW'].to_dict()
+        {'admin1': 'ABW', 'iso': 'ABW', 'global': 'global'}
+
+    """
+    hierids = pd.Index(get_region_index().hierids, name='hierid')
+
+    components = hierids.str.split('.', n=2, expand=True)
+    iso = components.get_level_values(0)
+    admin1 = components.get_level_values(1)
+
+    return pd.DataFrame(
+        {
+            'admin1': np.where(admin1.isna(), iso, iso + '.' + admin1),
+            'iso': iso,
+            'global': 'global'},
+        index=hierids)
+
+
+def aggregate_regions(
+        data,
+        level='iso',
+        dim='hierid',
+        weights=None,
+        how='mean'):
+    """
+    Aggregate impact-region data to coarser levels of the GCP hierarchy
+
+    Parameters
+    ----------
+
+    data : DataArray or Dataset
+        data indexed by hierid along ``dim``. May have any other dimensions.
+        Dask-backed data are aggregated lazily, chunk by chunk.
+
+    level : str or list of str, optional
+        level to aggregate to, one of :py:data:`LEVELS`: ``'hierid'``,
+        ``'admin1'``, ``'iso'`` (default) or ``'global'``. If a list, all
+        levels are computed from one sparse product and returned as a dict
+        by level.
+
+    dim : str, optional
+        region dimension of ``data`` (default ``'hierid'``)
+
+    weights : DataArray, optional
+        weights (e.g. population or area) along ``dim``, possibly with other
+        dimensions of ``data`` such as years. As with ``data * weights``,
+        only regions present in both are aggregated. Default: every region
+        has the same weight.
+
+    how : str, optional
+        ``'mean'`` (default) for the weighted mean of each group, or
+        ``'sum'`` for the weighted sum
+
+    Returns
+    -------
+
+    DataArray or Dataset
+        aggregated data with ``level`` in place of ``dim``, indexed by the
+        groups present in ``data``. NaN values are skipped. If ``level`` is
+        a list, a dict of aggregates by level.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> da = xr.DataArray(
+        ...     [1., 2., 6.],
+        ...     dims=['hierid'],
+        ...     coords={'hierid': ['CAN.1.2.28', 'CAN.1.17.403', 'ABW']})
+        ...
+        >>> pop = xr.DataArray([1., 3., 2.], dims=['hierid'], coords=da.coords)
+        >>> aggregate_regions(da, 'iso', weights=pop)
+        <xarray.DataArray (iso: 2)> Size: 16B
+        array([6.  , 1.75])
+        Coordinates:
+          * iso      (iso) <U3 24B 'ABW' 'CAN'
+
+    """
+    levels = [level] if isinstance(level, str) else list(level)
+
+    for name in levels:
+        if name not in LEVELS:
+            raise ValueError(f'level should be one of {LEVELS}, got "{name}"')
+
+    if how not in ('mean', 'sum'):
+        raise ValueError(f'how should be "mean" or "sum", got "{how}"')
+
+    if weights is not None:
+        data, weights = xr.align(data, weights, join='inner', exclude=[
+            d for d in weights.dims if d != dim])
+
+    groupings = {
+        name: _grouping(data.indexes[dim], name, dim) for name in levels}
+
+    # all levels are summed from the regions in one sparse product
+    matrix = scipy.sparse.vstack(
+        [groupings[name][1] for name in levels], format='csr')
+
+    if weights is None or weights.dims == (dim, ):
+        folded = 1. if weights is None else weights.values.astype('float64')
+        matrix = matrix @ scipy.sparse.diags(
+            np.broadcast_to(folded, matrix.shape[1]))
+        sums = sparse_sum(data, matrix, dim, _GROUP_DIM)
+
+    else:
+        # weights along other dimensions are applied to the data directly,
+        # and the sparse sums are unweighted
+        sums = sparse_sum(data * weights, matrix, dim, _GROUP_DIM)
+
+    if how == 'mean':
+        sums = sums / _total_weights(data, weights, matrix, dim)
+
+    result = {}
+    start = 0
+    for name in levels:
+        labels = groupings[name][0]
+        stop = start + len(labels)
+        result[name] = (
+            sums
+            .isel({_GROUP_DIM: slice(start, stop)})
+            .rename({_GROUP_DIM: name})
+            .assign_coords({name: labels}))
+        start = stop
+
+    if isinstance(level, str):
+        return result[level]
+
+    return result
+
+
+def _grouping(regions, level, dim):
+    """
+    Labels of the groups of ``level`` present in ``regions``, and their
+    sparse (group, region) membership matrix
+    """
+    key = (level, array_key(regions.values))
+
+    if key not in _MATRIX_CACHE:
+        hierarchy = region_hierarchy()
+        rows = hierarchy.index.get_indexer(np.asarray(regions).astype(str))
+
+        if (rows < 0).any():
+            raise IndexError(f'Not all values in "{dim}" found in "hierid"')
+
+        values = (
+            hierarchy.index.values if level == 'hierid'
+            else hierarchy[level].values)
+
+        codes, labels = pd.factorize(values[rows], sort=True)
+
+        if len(_MATRIX_CACHE) >= _MATRIX_CACHE_SIZE:
+            _MATRIX_CACHE.clear()
+
+        _MATRIX_CACHE[key] = (
+            labels.astype(str), membership_matrix(codes, len(labels)))
+
+    return _MATRIX_CACHE[key]
+
+
+def _total_weights(data, weights, matrix, dim):
+    """
+    Sum of the weights of the non-NaN values of every group
+    """
+    # weights along ``dim`` only are folded into the matrix
+    folded = weights is None or weights.dims == (dim, )
+
+    if isinstance(data, xr.Dataset):
+        nan_free = all(
+            var.chunks is None and not var.isnull().any()
+            for var in data.data_vars.values())
+    else:
+        nan_free = data.chunks is None and not data.isnull().any()
+
+    if nan_free and folded:
+        return xr.DataArray(
+            np.asarray(matrix.sum(axis=1)).ravel(), dims=[_GROUP_DIM])
+
+    if nan_free:
+        return sparse_sum(weights, matrix, dim, _GROUP_DIM)
+
+    if folded:
+        return sparse_sum(data.notnull(), matrix, dim, _GROUP_DIM)
+
+    return sparse_sum(data.notnull() * weights, matrix, dim, _GROUP_DIM)
@@ -1,8 +1,12 @@
 
 
+from collections.abc import Mapping
+
 import numpy as np
 
-from impactlab_tools.utils.weighting import weighted_quantile_xr, _get_weights
+from impactlab_tools.utils.weighting import (
+    WeightedDistributionXr, weighted_cdf, weighted_quantile_xr)
+from impactlab_tools.utils.weightregistry import get_weight_registry
 
 
 def gcp_quantiles(
@@ -11,16 +15,19 @@ def gcp_quantiles(
         quantiles=[0.05, 0.17, 0.5, 0.83, 0.95],
         values_sorted=False,
         dim='model',
-        sample_weight=None):
+        sample_weight=None,
+        skipna=False,
+        rank_index=None):
     """
     Compute quantiles of an xarray distribution using GCP weights
 
     .. NOTE ::
 
-        This function does not control for the number of samples of each model.
-        If they are not constant across models provide a correctly weighted
-        weights array to :py:func:`utils.weighting.weighted_quantile_xr`.
-        We would like to fix this. If you have a good fix we'd love a PR :)
+        To pool several samples per model (e.g. Monte-Carlo batches), pass
+        a list of dimensions such as ``dim=['model', 'batch']``. Each model
+        then keeps its total weight, split equally among its samples. If
+        models have different numbers of samples, pad the missing ones with
+        NaN and set ``skipna=True``.
 
     Parameters
     ----------
@@ -30,10 +37,13 @@ def gcp_quantiles(
         indexed by GCP model along the dimension ``dim``. If a Dataset is
         passed, ``gcp_quantiles`` computes the weighted quantile for each
         variable in the ``Dataset`` that is indexed by ``dim``.
+        Dask-backed inputs are computed lazily, in parallel over chunks.
 
-    rcp : str, optional
+    rcp : str or list of str, optional
         RCP weights/models to use ('rcp45', 'rcp85'). Required if no
-        ``sample_weight`` provided.
+        ``sample_weight`` provided. If a list, quantiles are computed for
+        the weights of every RCP along a new leading dimension ``rcp``,
+        sorting the data only once.
 
     quantiles : array-like
         quantiles of distribution to return. quantiles should be in [0, 1].
@@ -41,15 +51,28 @@ def gcp_quantiles(
     values_sorted : bool
         if True, then will avoid sorting of initial array
 
-    dim : str, optional
+    dim : str or list of str, optional
         dimension along which to retrieve quantiles. The indices of this
         dimension should be valid (case insensitive) GCP climate models.
+        If a list, the first dimension holds the models and the
+        distribution pools all dimensions in the list.
         Default: `'model'`.
 
-     sample_weight : DataArray, optional
+     sample_weight : DataArray or mapping, optional
         weights to use when producing the weighted quantiles. Required
         if no RCP provided. If not provided, uses the defualt weights
-        for the RCP provided, based on Rasmussen et al. (2015).
+        for the RCP provided, based on Rasmussen et al. (2015). If a
+        mapping of names to weights, quantiles are computed for every
+        weight set along a new leading dimension ``weighting``.
+
+    skipna : bool, optional
+        if True, ignore NaN samples and renormalize the weights of the
+        remaining samples separately for every cell. Default False.
+
+    rank_index : RankIndex, optional
+        sorted-order index of ``data`` along ``dim`` (see
+        :py:func:`.utils.rankindex.build_rank_index`). The data are then
+        not sorted again.
 
     Returns
     -------
@@ -75,20 +98,256 @@ def gcp_quantiles(
 
     """
 
-    # prep weight
-    if sample_weight is None:
-        sample_weight = _get_weights(project='gcp', rcp=rcp)
-        sample_weight = sample_weight.rename({'model': dim})
+    weighting_dim = 'weighting'
+
+    if isinstance(sample_weight, Mapping):
+        sample_weight = {
+            key: _align_gcp_weights(data, rcp, dim, weights)
+            for key, weights in sample_weight.items()}
+
+    elif sample_weight is None and isinstance(rcp, (list, tuple)):
+        sample_weight = {r: _align_gcp_weights(data, r, dim) for r in rcp}
+        weighting_dim = 'rcp'
+
+    else:
+        sample_weight = _align_gcp_weights(data, rcp, dim, sample_weight)
+
+    return weighted_quantile_xr(
+        data, quantiles, sample_weight=sample_weight, dim=dim, skipna=skipna,
+        weighting_dim=weighting_dim, rank_index=rank_index)
+
+
+def gcp_cdf(
+        data,
+        thresholds,
+        rcp=None,
+        dim='model',
+        sample_weight=None,
+        skipna=False,
+        exceedance=False,
+        rank_index=None):
+    """
+    Weighted probability of thresholds using GCP weights
+
+    Weights are aligned exactly as in :py:func:`gcp_quantiles`.
+
+    Parameters
+    ----------
+
+    data : DataArray or Dataset
+        :py:class:`xarray.DataArray` or :py:class:`xarray.Dataset` with data
+        indexed by GCP model along the dimension ``dim``.
+
+    thresholds : scalar, array-like or DataArray
+        values at which to evaluate the CDF. A
+        :py:class:`xarray.DataArray` broadcasts against the dimensions of
+        ``data`` other than ``dim`` (e.g. a threshold map by region). See
+        :py:func:`.utils.weighting.weighted_cdf`.
+
+    rcp : str, optional
+        RCP weights/models to use ('rcp45', 'rcp85'). Required if no
+        ``sample_weight`` provided.
+
+    dim : str or list of str, optional
+        dimension holding the GCP models, as in :py:func:`gcp_quantiles`.
+        Default: `'model'`.
+
+    sample_weight : DataArray, optional
+        weights to use instead of the default weights of the RCP.
+
+    skipna : bool, optional
+        if True, ignore NaN samples and renormalize the weights of the
+        remaining samples separately for every cell. Default False.
+
+    exceedance : bool, optional
+        if True, return the probability of exceeding the thresholds
+        instead. Default False.
+
+    rank_index : RankIndex, optional
+        sorted-order index of ``data`` along ``dim``, as in
+        :py:func:`gcp_quantiles`.
+
+    Returns
+    -------
+
+    DataArray or Dataset
+        probabilities with ``dim`` dropped
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> import xarray as xr
+        >>> da = xr.DataArray(
+        ...     [1., 2., 3.],
+        ...     dims=['model'],
+        ...     coords=[['GFDL-ESM2G', 'MIROC-ESM-CHEM', 'CCSM4']])
+        ...
+        >>> median = gcp_quantiles(da, 'rcp85', [0.5])
+        >>> bool(gcp_cdf(da, median.item(), rcp='rcp85') == 0.5)
+        True
+
+    """
+
+    sample_weight = _align_gcp_weights(data, rcp, dim, sample_weight)
+
+    return weighted_cdf(
+        data, thresholds, sample_weight=sample_weight, dim=dim, skipna=skipna,
+        exceedance=exceedance, rank_index=rank_index)
+
+
+def gcp_distribution(
+        data,
+        rcp=None,
+        values_sorted=False,
+        dim='model',
+        sample_weight=None):
+    """
+    Build a reusable weighted distribution of a DataArray using GCP weights
+
+    The data are sorted once; quantiles, CDF values and moments can then be
+    queried repeatedly from the returned object. Weights are aligned exactly
+    as in :py:func:`gcp_quantiles`.
+
+    Parameters
+    ----------
+
+    data : DataArray
+        :py:class:`xarray.DataArray` with data indexed by GCP model along the
+        dimension ``dim``. The data are loaded into memory.
+
+    rcp : str, optional
+        RCP weights/models to use ('rcp45', 'rcp85'). Required if no
+        ``sample_weight`` provided.
+
+    values_sorted : bool
+        if True, then will avoid sorting of initial array
+
+    dim : str, optional
+        dimension holding the distribution. The indices of this dimension
+        should be valid (case insensitive) GCP climate models.
+        Default: `'model'`.
+
+    sample_weight : DataArray, optional
+        weights to use for the distribution. Required if no RCP provided.
+
+    Returns
+    -------
+
+    WeightedDistributionXr
+        see :py:class:`.utils.weighting.WeightedDistributionXr`
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> import xarray as xr
+        >>> da = xr.DataArray(
+        ...     [1., 2., 3.],
+        ...     dims=['model'],
+        ...     coords=[['GFDL-ESM2G', 'MIROC-ESM-CHEM', 'CCSM4']])
+        ...
+        >>> dist = gcp_distribution(da, rcp='rcp85')
+        >>> q = dist.quantile([0.17, 0.5, 0.83])
+        >>> bool((q == gcp_quantiles(da, 'rcp85', [0.17, 0.5, 0.83])).all())
+        True
+
+        >>> bool(dist.cdf(q.sel(quantile=0.5).item()) == 0.5)
+        True
+
+    """
+
+    sample_weight = _align_gcp_weights(data, rcp, dim, sample_weight)
+
+    return WeightedDistributionXr(
+        data, sample_weight, dim, values_sorted=values_sorted)
+
+
+def gcp_distribution_add(
+        distribution,
+        data,
+        rcp=None,
+        values_sorted=False,
+        sample_weight=None):
+    """
+    Merge new GCP models into a distribution from :py:func:`gcp_distribution`
+
+    Only the new models are sorted and merged into the cached sorted state,
+    so refreshed quantiles cost time proportional to the new data rather
+    than the whole ensemble. Weights are aligned as in
+    :py:func:`gcp_quantiles`.
+
+    Parameters
+    ----------
+
+    distribution : WeightedDistributionXr
+        distribution to update in place
+
+    data : DataArray
+        new models along the distribution's dimension, e.g. surrogate
+        models or additional Monte-Carlo batches
+
+    rcp : str, optional
+        RCP weights/models to use ('rcp45', 'rcp85'). Required if no
+        ``sample_weight`` provided.
+
+    values_sorted : bool
+        if True, then will avoid sorting of the new models
+
+    sample_weight : DataArray, optional
+        weights of the new models. Required if no RCP provided.
+
+    Returns
+    -------
+
+    WeightedDistributionXr
+        the updated ``distribution``
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> import xarray as xr
+        >>> da = xr.DataArray(
+        ...     [1., 2., 3., 4.],
+        ...     dims=['model'],
+        ...     coords=[['GFDL-ESM2G', 'MIROC-ESM-CHEM', 'CCSM4', 'inmcm4']])
+        ...
+        >>> dist = gcp_distribution(da[:2], rcp='rcp85')
+        >>> dist = gcp_distribution_add(dist, da[2:], rcp='rcp85')
+        >>> q = gcp_quantiles(da, 'rcp85', [0.17, 0.5, 0.83])
+        >>> bool((dist.quantile([0.17, 0.5, 0.83]) == q).all())
+        True
+
+    """
+
+    sample_weight = _align_gcp_weights(
+        data, rcp, distribution.dim, sample_weight)
+
+    return distribution.add(data, sample_weight, values_sorted=values_sorted)
+
+
+def _align_gcp_weights(data, rcp, dim, sample_weight=None):
+
+    # with several dimensions, the first one holds the models
+    if not isinstance(dim, str):
+        dim = dim[0]
 
-    # prepare arrays of models to align along `dim` (case insensitive)
     models_in_data = data.coords[dim].values
-    models_in_data_aligned = np.array([m.lower() for m in models_in_data])
+
+    # default weights: vectorized lookup in the cached weight registry
+    if sample_weight is None:
+        return get_weight_registry().align(
+            models_in_data, project='gcp', rcp=rcp)
 
     # align weights to match ordering of models (using lowercase models)
-    sample_weight = sample_weight.sel(**{dim: models_in_data_aligned})
+    sample_weight = sample_weight.sel(
+        **{dim: np.char.lower(models_in_data.astype(str))})
 
     # swap weights coordinate to use model names from data
     sample_weight.coords[dim] = models_in_data
 
-    return weighted_quantile_xr(
-        data, quantiles, sample_weight=sample_weight, dim=dim)
+    return sample_weight
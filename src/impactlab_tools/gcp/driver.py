@@ -0,0 +1,432 @@
+"""
+Out-of-core GCP quantiles over region blocks
+
+Production ensembles, e.g. of shape ``(model, batch, hierid, year)``, are
+far larger than memory. :py:func:`compute_gcp_quantiles` never loads them
+whole. It splits the region dimension into blocks of ``block_size``
+regions. A process pool then reads each block from the inputs, computes its
+quantiles with :py:func:`~impactlab_tools.gcp.dist.gcp_quantiles` and writes
+them to a part file. Finally the parts are assembled into the output
+NetCDF file, or Zarr store if the output ends in ``.zarr``. A Zarr store is
+created from the layout of the parts and filled block by block with region
+writes. A NetCDF file is written from the parts opened lazily with
+:py:func:`xarray.open_mfdataset`. Neither holds all the quantiles in memory
+at once. Assembling the output requires dask, and zarr for a Zarr store
+(the ``impactlab-tools[driver]`` extra). Both are checked before any block
+is computed.
+
+Part files are written next to the output (in ``<output>.parts``) as soon
+as their block is done, so an interrupted run resumes where it stopped.
+Only the missing blocks are computed when the same command is run again.
+
+The same driver is installed as the ``gcp-quantiles`` console command:
+
+.. code-block:: bash
+
+    gcp-quantiles 'impacts/*.nc4' -o quantiles.nc --rcp rcp85 \\
+        --dim model --dim batch --block-size 500 -j 8
+
+Inputs may be one file or several files (or a glob) split along the
+ensemble dimensions, e.g. one file per model. All inputs must share the
+same regions in the same order.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import sys
+
+import xarray as xr
+
+from impactlab_tools.gcp.dist import gcp_quantiles
+
+
+_PARTS_SUFFIX = '.parts'
+_CONFIG_FILE = 'config.json'
+
+
+def compute_gcp_quantiles(
+        inputs,
+        output,
+        rcp,
+        quantiles=[0.05, 0.17, 0.5, 0.83, 0.95],
+        dim='model',
+        region_dim='hierid',
+        block_size=500,
+        processes=None,
+        variables=None,
+        skipna=False,
+        resume=True,
+        keep_parts=False,
+        progress=True):
+    """
+    Compute GCP-weighted quantiles of an on-disk ensemble, region block by
+    region block
+
+    Parameters
+    ----------
+
+    inputs : str or list of str
+        NetCDF files or Zarr stores holding the ensemble. A string may be a
+        glob pattern. Several inputs are combined by coordinates, block by
+        block.
+
+    output : str
+        NetCDF file, or Zarr store if it ends in ``.zarr``, to write the
+        quantiles to
+
+    rcp : str
+        RCP weights/models to use ('rcp45', 'rcp85')
+
+    quantiles : list-like, optional
+        quantiles of distribution to return. quantiles should be in [0, 1].
+
+    dim : str or list of str, optional
+        ensemble dimension(s), as in :py:func:`.gcp.dist.gcp_quantiles`.
+        Default: `'model'`.
+
+    region_dim : str, optional
+        dimension split into blocks (default ``'hierid'``)
+
+    block_size : int, optional
+        number of regions per block. Each worker holds one block of the
+        whole ensemble in memory. Default 500.
+
+    processes : int, optional
+        number of worker processes. Defaults to the number of CPUs. With
+        ``processes=1``, blocks are computed in this process.
+
+    variables : list of str, optional
+        data variables to summarize. Defaults to all variables with both
+        the ensemble and region dimensions.
+
+    skipna : bool, optional
+        if True, ignore NaN samples, as in
+        :py:func:`.gcp.dist.gcp_quantiles`. Default False.
+
+    resume : bool, optional
+        if True (default), keep the blocks already computed by an
+        interrupted run with the same arguments. If False, start over.
+
+    keep_parts : bool, optional
+        if True, keep the part files after assembling the output.
+        Default False.
+
+    progress : bool, optional
+        if True (default), report finished blocks on ``stderr``
+
+    Returns
+    -------
+
+    xarray.Dataset
+        the quantiles written to ``output``, opened lazily. Close it when
+        done.
+    """
+    _check_requirements(output)
+
+    paths = _expand_inputs(inputs)
+    ensemble_dims = [dim] if isinstance(dim, str) else list(dim)
+
+    regions, variables = _inspect_inputs(
+        paths, ensemble_dims[0], region_dim, variables)
+
+    blocks = [
+        (start, min(start + block_size, len(regions)))
+        for start in range(0, len(regions), block_size)]
+
+    parts_dir = str(output).rstrip('/') + _PARTS_SUFFIX
+    _prepare_parts(
+        parts_dir,
+        {
+            'inputs': paths,
+            'rcp': rcp,
+            'quantiles': [float(q) for q in quantiles],
+            'dim': ensemble_dims,
+            'region_dim': region_dim,
+            'block_size': block_size,
+            'variables': variables,
+            'skipna': skipna},
+        resume)
+
+    parts = [_part_path(parts_dir, start, stop) for start, stop in blocks]
+    todo = [
+        (block, part) for block, part in zip(blocks, parts)
+        if not os.path.exists(part)]
+
+    kwargs = {
+        'rcp': rcp, 'quantiles': quantiles, 'dim': dim,
+        'region_dim': region_dim, 'variables': variables, 'skipna': skipna}
+
+    done = len(blocks) - len(todo)
+    if progress and done:
+        _report(done, len(blocks), 'blocks already computed')
+
+    if processes == 1:
+        for block, part in todo:
+            _compute_block(paths, block, part, **kwargs)
+            done += 1
+            if progress:
+                _report(done, len(blocks), _block_label(region_dim, block))
+
+    elif todo:
+        with ProcessPoolExecutor(processes) as pool:
+            futures = {
+                pool.submit(_compute_block, paths, block, part, **kwargs): block
+                for block, part in todo}
+
+            for future in as_completed(futures):
+                future.result()
+                done += 1
+                if progress:
+                    _report(
+                        done, len(blocks),
+                        _block_label(region_dim, futures[future]))
+
+    zarr = _is_zarr(output)
+
+    if zarr:
+        _write_zarr(parts, blocks, output, region_dim)
+    else:
+        _write_netcdf(parts, output, region_dim)
+
+    if not keep_parts:
+        shutil.rmtree(parts_dir)
+
+    if progress:
+        _report(len(blocks), len(blocks), f'wrote {output}')
+
+    if zarr:
+        return xr.open_zarr(output)
+
+    return xr.open_dataset(output)
+
+
+def main(argv=None):
+    """
+    Console entry point ``gcp-quantiles``, see :py:func:`compute_gcp_quantiles`
+    """
+    parser = argparse.ArgumentParser(
+        prog='gcp-quantiles',
+        description=(
+            'Compute GCP-weighted quantiles of an ensemble, region block by '
+            'region block, in a process pool.'))
+
+    parser.add_argument(
+        'inputs', nargs='+', help='input NetCDF files, Zarr stores or globs')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='output NetCDF file, or Zarr store ending in .zarr')
+    parser.add_argument(
+        '--rcp', required=True, help='RCP weights to use, e.g. rcp85')
+    parser.add_argument(
+        '-q', '--quantiles', nargs='+', type=float,
+        default=[0.05, 0.17, 0.5, 0.83, 0.95], help='quantiles in [0, 1]')
+    parser.add_argument(
+        '--dim', action='append',
+        help='ensemble dimension, repeat to pool several (default: model)')
+    parser.add_argument(
+        '--region-dim', default='hierid', help='dimension split into blocks')
+    parser.add_argument(
+        '--block-size', type=int, default=500, help='regions per block')
+    parser.add_argument(
+        '-j', '--processes', type=int, help='number of worker processes')
+    parser.add_argument(
+        '--variable', action='append', dest='variables',
+        help='data variable to summarize, repeat for several (default: all)')
+    parser.add_argument(
+        '--skipna', action='store_true', help='ignore NaN samples')
+    parser.add_argument(
+        '--no-resume', dest='resume', action='store_false',
+        help='recompute blocks left by an interrupted run')
+    parser.add_argument(
+        '--keep-parts', action='store_true',
+        help='keep the per-block part files')
+    parser.add_argument(
+        '--quiet', dest='progress', action='store_false',
+        help='do not report progress')
+
+    args = parser.parse_args(argv)
+
+    dim = args.dim or ['model']
+
+    result = compute_gcp_quantiles(
+        [path for pattern in args.inputs for path in _expand_inputs(pattern)],
+        args.output,
+        rcp=args.rcp,
+        quantiles=args.quantiles,
+        dim=dim[0] if len(dim) == 1 else dim,
+        region_dim=args.region_dim,
+        block_size=args.block_size,
+        processes=args.processes,
+        variables=args.variables,
+        skipna=args.skipna,
+        resume=args.resume,
+        keep_parts=args.keep_parts,
+        progress=args.progress)
+
+    result.close()
+
+
+def _is_zarr(output):
+    return str(output).rstrip('/').endswith('.zarr')
+
+
+def _check_requirements(output):
+
+    # the parts are assembled lazily with dask, and into Zarr with zarr
+    required = ['dask', 'zarr'] if _is_zarr(output) else ['dask']
+    missing = [
+        module for module in required
+        if importlib.util.find_spec(module) is None]
+
+    if missing:
+        raise ImportError(
+            f'Writing "{output}" requires {" and ".join(missing)}. Install '
+            'the impactlab-tools[driver] extra.')
+
+
+def _expand_inputs(inputs):
+    if isinstance(inputs, (str, os.PathLike)):
+        inputs = [inputs]
+
+    paths = []
+    for pattern in map(str, inputs):
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [
+            pattern]
+        if not matches:
+            raise FileNotFoundError(f'No inputs match "{pattern}"')
+        paths.extend(matches)
+
+    return paths
+
+
+def _inspect_inputs(paths, model_dim, region_dim, variables):
+
+    # only coordinates are read here
+    with xr.open_dataset(paths[0]) as ds:
+        regions = ds.indexes[region_dim]
+
+        if variables is None:
+            variables = [
+                var for var in ds.data_vars
+                if {model_dim, region_dim} <= set(ds[var].dims)]
+
+    for path in paths[1:]:
+        with xr.open_dataset(path) as ds:
+            if not ds.indexes[region_dim].equals(regions):
+                raise ValueError(
+                    f'"{path}" does not have the same {region_dim} as '
+                    f'"{paths[0]}"')
+
+    if not variables:
+        raise ValueError(
+            f'No variables with dimensions "{model_dim}" and "{region_dim}"')
+
+    return regions, list(variables)
+
+
+def _prepare_parts(parts_dir, config, resume):
+
+    config_path = os.path.join(parts_dir, _CONFIG_FILE)
+
+    if os.path.isdir(parts_dir):
+        if not resume:
+            shutil.rmtree(parts_dir)
+
+        else:
+            with open(config_path) as f:
+                previous = json.load(f)
+
+            if previous != config:
+                raise ValueError(
+                    f'The blocks in "{parts_dir}" were computed with other '
+                    'arguments. Pass resume=False (--no-resume) to start '
+                    'over.')
+
+            return
+
+    os.makedirs(parts_dir)
+
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def _part_path(parts_dir, start, stop):
+    return os.path.join(parts_dir, f'block_{start:07d}_{stop:07d}.nc')
+
+
+def _compute_block(
+        paths, block, part, rcp, quantiles, dim, region_dim, variables,
+        skipna):
+
+    region = {region_dim: slice(*block)}
+
+    # read only this block of each input
+    datasets = []
+    for path in paths:
+        with xr.open_dataset(path) as ds:
+            datasets.append(ds[variables].isel(region).load())
+
+    if len(datasets) == 1:
+        data = datasets[0]
+    else:
+        data = xr.combine_by_coords(datasets, combine_attrs='override')
+
+    result = gcp_quantiles(
+        data, rcp=rcp, quantiles=quantiles, dim=dim, skipna=skipna)
+
+    # parts only appear once complete, so that interrupted blocks are redone
+    tmp = part + '.tmp'
+    result.to_netcdf(tmp)
+    os.replace(tmp, part)
+
+
+def _open_parts(parts, region_dim):
+    # only variables along the regions are concatenated, block by block
+    combined = xr.open_mfdataset(
+        parts, combine='nested', concat_dim=region_dim, data_vars='minimal',
+        coords='minimal', compat='override')
+
+    # the encoding of the first part (e.g. string widths) may not fit all
+    for variable in combined.variables.values():
+        variable.encoding = {}
+
+    return combined
+
+
+def _write_zarr(parts, blocks, output, region_dim):
+
+    # the store is laid out from the lazily opened parts, with one chunk
+    # per block, and only the data without regions is written here
+    with _open_parts(parts, region_dim) as template:
+        template.to_zarr(output, mode='w', compute=False)
+
+    for (start, stop), part in zip(blocks, parts):
+        with xr.open_dataset(part) as block:
+            block = block.drop_vars([
+                name for name, variable in block.variables.items()
+                if region_dim not in variable.dims])
+
+            for variable in block.variables.values():
+                variable.encoding = {}
+
+            block.to_zarr(output, region={region_dim: slice(start, stop)})
+
+
+def _write_netcdf(parts, output, region_dim):
+
+    # the parts are read and written one block at a time
+    with _open_parts(parts, region_dim) as result:
+        result.to_netcdf(output)
+
+
+def _block_label(region_dim, block):
+    return f'{region_dim} {block[0]}:{block[1]}'
+
+
+def _report(done, total, message):
+    print(f'[{done}/{total}] {message}', file=sys.stderr, flush=True)
@@ -4,14 +4,125 @@ import os
 from functools import cache
 
 import numpy as np
+import pandas as pd
 import xarray as xr
 
 import impactlab_tools.assets
 
-try:
-    unicode
-except NameError:
-    unicode = str
+
+class RegionIndex:
+    '''
+    Two-way lookup between impact region hierids and SHAPENUMs
+
+    hierids are looked up in a hashed :py:class:`pandas.Index` and
+    SHAPENUMs in a dense table of positions, so a whole coordinate is
+    converted in one vectorized lookup with one check for missing keys.
+    Coordinates holding all regions in the order of the index are returned
+    as the index's own read-only arrays, without copying. Use
+    :py:func:`get_region_index` for the shared index of the
+    agglomerated-world-new regions.
+
+    Parameters
+    ----------
+
+    hierids : array-like
+        impact region names (str)
+
+    shapenums : array-like
+        SHAPENUM of every region in ``hierids``
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> index = get_region_index()
+        >>> index.to_shapenum(['AFG.1.12', 'ABW'])
+        array([5747., 1369.])
+        >>> index.to_hierid([5747, 1369])
+        array(['AFG.1.12', 'ABW'], dtype='<U35')
+
+    '''
+
+    def __init__(self, hierids, shapenums):
+        self.hierids = _decode(np.asarray(hierids))
+        self.shapenums = np.asarray(shapenums, dtype='float64')
+
+        for values in (self.hierids, self.shapenums):
+            values.flags.writeable = False
+
+        self._hierid_index = pd.Index(self.hierids)
+        self._shapenum_index = pd.Index(self.shapenums)
+
+        # SHAPENUMs are small positive integers, so they are looked up by
+        # position in a dense table rather than hashed
+        self._shapenum_table = None
+        if len(self.shapenums):
+            numbers = self.shapenums.astype('intp')
+            if (
+                    (numbers == self.shapenums).all()
+                    and numbers.min() >= 0
+                    and numbers.max() < 4 * len(numbers)):
+                self._shapenum_table = np.full(
+                    numbers.max() + 1, -1, dtype='intp')
+                self._shapenum_table[numbers] = np.arange(len(numbers))
+
+    def __len__(self):
+        return len(self.hierids)
+
+    def to_hierid(self, shapenums, dim='SHAPENUM'):
+        '''
+        hierids of ``shapenums``
+
+        Raises ``IndexError`` if any SHAPENUM is unknown. ``dim`` names the
+        coordinate in the error message.
+        '''
+        keys = np.asarray(shapenums, dtype='float64')
+
+        if self._shapenum_table is None:
+            positions = self._shapenum_index.get_indexer(keys)
+
+        else:
+            numbers = keys.astype('intp')
+            valid = (
+                (numbers == keys)
+                & (numbers >= 0)
+                & (numbers < len(self._shapenum_table)))
+            positions = self._shapenum_table[np.where(valid, numbers, 0)]
+            positions[~valid] = -1
+
+        return _take(
+            self.hierids, _check_positions(positions, keys, dim, 'SHAPENUM'))
+
+    def to_shapenum(self, hierids, dim='hierid'):
+        '''
+        SHAPENUMs of ``hierids``
+
+        Raises ``IndexError`` if any hierid is unknown. ``dim`` names the
+        coordinate in the error message.
+        '''
+        keys = hierids
+        if not isinstance(keys, pd.Index) or (
+                len(keys) and isinstance(keys[0], bytes)):
+            keys = _decode(np.asarray(keys))
+
+        positions = self._hierid_index.get_indexer(keys)
+
+        return _take(
+            self.shapenums, _check_positions(positions, keys, dim, 'hierid'))
+
+
+@cache
+def get_region_index():
+    '''
+    :py:class:`RegionIndex` of the agglomerated-world-new regions
+
+    Built once per process from ``GCP_impact_regions.nc``. Its arrays are
+    read-only.
+    '''
+    mapping = _get_impactregion_mapping()
+
+    return RegionIndex(mapping.hierid.values, mapping.SHAPENUM.values)
 
 
 @cache
@@ -27,7 +138,37 @@ def _get_impactregion_mapping():
     return mapping
 
 
-def shapenum_to_hierid(data, dim='SHAPENUM', new_dim='hierid', inplace=False):
+def _decode(values):
+    if values.dtype.kind == 'S':
+        return values.astype(str)
+
+    if values.dtype.kind == 'O' and len(values) and isinstance(
+            values.flat[0], bytes):
+        return values.astype(bytes).astype(str)
+
+    return values
+
+
+def _take(values, positions):
+    if len(positions) == len(values) and (
+            positions == np.arange(len(values))).all():
+        return values
+
+    return values[positions]
+
+
+def _check_positions(positions, keys, dim, name):
+    missing = positions < 0
+    if missing.any():
+        raise IndexError(
+            f'Not all values in "{dim}" found in "{name}": '
+            f'{list(np.asarray(keys)[missing][:5])}')
+
+    return positions
+
+
+def shapenum_to_hierid(
+        data, dim='SHAPENUM', new_dim='hierid', inplace=False, copy=True):
     '''
     Re-indexes a DataArray or Dataset from SHAPENUM to hierid
     using agglomerated-world-new region definitions
@@ -49,6 +190,14 @@ def shapenum_to_hierid(data, dim='SHAPENUM', new_dim='hierid', inplace=False):
         Modify the Dataset or DataArray in place rather than
         returning a copy (default False)
 
+    copy : bool, optional
+        If True (default), the returned copy has its own copy of the data.
+        If False, only the coordinate is replaced and the dimension renamed
+        on a shallow copy, which shares the data (numpy buffers or dask
+        graphs) with ``data``. The only new memory is then the new
+        coordinate, instead of a second copy of every variable. Ignored if
+        ``inplace`` is True.
+
     Returns
     -------
 
@@ -81,29 +230,21 @@ def shapenum_to_hierid(data, dim='SHAPENUM', new_dim='hierid', inplace=False):
         True
 
     '''
-    mapping = _get_impactregion_mapping()
+    hierids = get_region_index().to_hierid(data.coords[dim].to_index(), dim)
 
     if inplace:
         res = data
     else:
-        res = data.copy()
+        res = data.copy(deep=copy)
 
-    if not np.in1d(res.coords[dim].values, mapping.SHAPENUM.values).all():
-        raise IndexError(
-            f'Not all values in "{dim}" found in SHAPENUM')
-
-    res.coords[dim] = (
-        mapping
-        .set_coords('SHAPENUM')
-        .swap_dims({'hierid': 'SHAPENUM'})
-        .sel(SHAPENUM=res.coords[dim].astype('float64'))
-        .hierid.values)
+    res.coords[dim] = hierids
 
     res = res.rename({dim: new_dim})
     return res
 
 
-def hierid_to_shapenum(data, dim='hierid', new_dim='SHAPENUM', inplace=False):
+def hierid_to_shapenum(
+        data, dim='hierid', new_dim='SHAPENUM', inplace=False, copy=True):
     '''
     Re-indexes a DataArray or Dataset from hierid to SHAPENUM
     using agglomerated-world-new region definitions
@@ -125,6 +266,14 @@ def hierid_to_shapenum(data, dim='hierid', new_dim='SHAPENUM', inplace=False):
         Modify the Dataset or DataArray in place rather than
         returning a copy (default False)
 
+    copy : bool, optional
+        If True (default), the returned copy has its own copy of the data.
+        If False, only the coordinate is replaced and the dimension renamed
+        on a shallow copy, which shares the data (numpy buffers or dask
+        graphs) with ``data``. The only new memory is then the new
+        coordinate, instead of a second copy of every variable. Ignored if
+        ``inplace`` is True.
+
     Returns
     -------
 
@@ -154,7 +303,7 @@ def hierid_to_shapenum(data, dim='hierid', new_dim='SHAPENUM', inplace=False):
         <xarray.Dataset> Size: 160B
         Dimensions:   (SHAPENUM: 10)
         Coordinates:
-          * SHAPENUM  (SHAPENUM) float64 80B 1.369e+03 5.747e+03 ... 5.812e+03 5.832e+03
+          * SHAPENUM  (SHAPENUM) float64 80B 1.369e+03 5.747e+03 ... 5.764e+03 5.772e+03
         Data variables:
             var2      (SHAPENUM) float64 80B 0.417 0.7203 0.0001144 ... 0.3968 0.5388
 
@@ -162,24 +311,15 @@ def hierid_to_shapenum(data, dim='hierid', new_dim='SHAPENUM', inplace=False):
         True
 
     '''
-    mapping = _get_impactregion_mapping()
-    mapping["hierid"] = mapping["hierid"].astype(unicode)
+    shapenums = get_region_index().to_shapenum(
+        data.coords[dim].to_index(), dim)
 
     if inplace:
         res = data
     else:
-        res = data.copy()
+        res = data.copy(deep=copy)
 
-    if not np.in1d(res.coords[dim].values, mapping.hierid.values).all():
-        raise IndexError(
-            f'Not all values in "{dim}" found in "hierid"')
-
-    # Insert SHAPENUM values where "dim" values match with mapping['hierid'].
-    # Needed rewrite because `where()` and prev. approach did not work in
-    # xarray v0.14.0.
-    res.coords[dim] = mapping.isel(
-        hierid=mapping['hierid'].isin(res[dim].astype(unicode))
-    )['SHAPENUM'].values
+    res.coords[dim] = shapenums
 
     res = res.rename({dim: new_dim})
     return res
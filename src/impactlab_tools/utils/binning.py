@@ -6,8 +6,11 @@ import scipy.stats
 
 from pandas import CategoricalIndex
 
+from impactlab_tools.utils import engines
 
-def binned_statistic_1d(da, dim, bins=10, statistic='count', value_range=None):
+
+def binned_statistic_1d(
+        da, dim, bins=10, statistic='count', value_range=None, engine=None):
     '''
     Bin a data array by values and summarize along a dimension
 
@@ -62,6 +65,14 @@ def binned_statistic_1d(da, dim, bins=10, statistic='count', value_range=None):
         The lower and upper range of the bins. If not provided, value_range is
         simply (x.min(), x.max()). Values outside the range are ignored.
 
+    engine : str, optional
+        ``'numpy'``, ``'numba'`` or ``'auto'``. The ``'numba'`` engine bins
+        all slices in parallel in a compiled kernel for the 'count', 'sum',
+        'mean', 'min' and 'max' statistics; other statistics always use
+        :py:func:`scipy.stats.binned_statistic`. If not provided, uses the
+        global option set with
+        :py:class:`~impactlab_tools.utils.engines.set_options`.
+
     Returns
     -------
 
@@ -117,14 +128,25 @@ def binned_statistic_1d(da, dim, bins=10, statistic='count', value_range=None):
           * b        (b) <U1 'w' 'x' 'y' 'z'
     '''
 
-    # apply binned_statistic along dim
-    bnd = np.apply_along_axis(
-        lambda x, **kwds: scipy.stats.binned_statistic(x, x, **kwds)[0],
-        da.get_axis_num(dim),
-        da.values,
-        bins=bins,
-        statistic=statistic,
-        range=value_range)
+    engine = engines.get_engine(engine)
+
+    if engine == 'numba' and statistic in engines.NUMBA_STATISTICS:
+        bnd = engines.binned_statistic_numba(
+            da.values,
+            da.get_axis_num(dim),
+            bins,
+            statistic,
+            value_range)
+
+    else:
+        # apply binned_statistic along dim
+        bnd = np.apply_along_axis(
+            lambda x, **kwds: scipy.stats.binned_statistic(x, x, **kwds)[0],
+            da.get_axis_num(dim),
+            da.values,
+            bins=bins,
+            statistic=statistic,
+            range=value_range)
 
     if isinstance(bins, int):
         if value_range is None:
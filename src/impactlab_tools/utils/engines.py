@@ -0,0 +1,400 @@
+"""
+Optional compiled computation engines
+
+The vectorized NumPy implementations in :py:mod:`impactlab_tools.utils`
+allocate full-size sorted copies of their inputs. When `numba
+<https://numba.pydata.org>`_ is installed, a compiled engine is available
+that loops over cells in parallel with small per-thread scratch buffers
+instead.
+
+The engine can be chosen per call with the ``engine`` argument of
+:py:func:`~impactlab_tools.utils.weighting.weighted_quantile`,
+:py:func:`~impactlab_tools.utils.weighting.weighted_quantile_xr` and
+:py:func:`~impactlab_tools.utils.binning.binned_statistic_1d`, or globally
+with :py:class:`set_options`:
+
+* ``'numpy'`` (default): vectorized NumPy/SciPy implementation
+* ``'numba'``: compiled kernels (raises ``ImportError`` without numba)
+* ``'auto'``: ``'numba'`` if numba is installed, otherwise ``'numpy'``
+
+The compiled kernels return the same results as the NumPy implementation up
+to floating point rounding of the cumulative weights. The order of tied
+values with different weights may also differ.
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+OPTIONS = {'engine': 'numpy'}
+
+_ENGINES = ('numpy', 'numba', 'auto')
+
+
+class set_options:
+    """
+    Set global options for :py:mod:`impactlab_tools.utils`
+
+    May be used as a function or as a context manager.
+
+    Parameters
+    ----------
+    engine : str, optional
+        default computation engine: ``'numpy'``, ``'numba'`` or ``'auto'``
+
+    Examples
+    --------
+    .. code-block:: python
+
+        >>> with set_options(engine='auto'):
+        ...     get_engine() in ('numpy', 'numba')
+        ...
+        True
+
+        >>> get_engine()
+        'numpy'
+    """
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            if key not in OPTIONS:
+                raise ValueError(f'Unknown option "{key}"')
+
+            if key == 'engine' and value not in _ENGINES:
+                raise ValueError(
+                    f'engine should be one of {_ENGINES}, got "{value}"')
+
+        self.old = {key: OPTIONS[key] for key in kwargs}
+        OPTIONS.update(kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        OPTIONS.update(self.old)
+
+
+def get_engine(engine=None):
+    """
+    Resolve the computation engine to use
+
+    Parameters
+    ----------
+    engine : str, optional
+        requested engine. If not provided, the global ``engine`` option is
+        used.
+
+    Returns
+    -------
+    engine : str
+        ``'numpy'`` or ``'numba'``
+    """
+    if engine is None:
+        engine = OPTIONS['engine']
+
+    if engine not in _ENGINES:
+        raise ValueError(f'engine should be one of {_ENGINES}, got "{engine}"')
+
+    if engine == 'auto':
+        return 'numpy' if numba is None else 'numba'
+
+    if engine == 'numba' and numba is None:
+        raise ImportError('engine="numba" requires numba to be installed')
+
+    return engine
+
+
+# statistics of binned_statistic_1d handled by the compiled engine
+NUMBA_STATISTICS = ('count', 'sum', 'mean', 'min', 'max')
+
+
+def weighted_quantile_numba(
+        values,
+        quantiles,
+        sample_weight,
+        values_sorted=False,
+        old_style=False,
+        axis=-1,
+        skipna=False):
+    """
+    Compiled counterpart of :py:func:`.weighting.weighted_quantile`
+
+    Returns the quantiles along a new last axis, with ``axis`` removed.
+    """
+    values = np.moveaxis(np.asarray(values), axis, -1)
+    shape = values.shape[:-1]
+    flat = np.ascontiguousarray(values.reshape(-1, values.shape[-1]))
+
+    # as in the NumPy engine, N-D weights broadcast against the values with
+    # ``axis`` moved last
+    weights = np.asarray(sample_weight, dtype='float64')
+    if weights.ndim == 1:
+        if len(weights) != flat.shape[-1]:
+            raise ValueError(
+                'sample_weight should have the length of values along axis')
+        weights = weights[np.newaxis, :]
+    else:
+        weights = np.ascontiguousarray(
+            np.broadcast_to(weights, values.shape).reshape(flat.shape))
+
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype='float64'))
+
+    result = _weighted_quantile_kernel(
+        flat, weights, quantiles, old_style, skipna, values_sorted,
+        _num_chunks(len(flat)))
+
+    return result.reshape(shape + (len(quantiles), ))
+
+
+def binned_statistic_numba(values, axis, bins, statistic, value_range=None):
+    """
+    Compiled counterpart of :py:func:`scipy.stats.binned_statistic` applied
+    along ``axis``, as in :py:func:`.binning.binned_statistic_1d`
+
+    Returns the statistic with the bins replacing ``axis``.
+    """
+    values = np.moveaxis(np.asarray(values), axis, -1)
+    shape = values.shape[:-1]
+    flat = np.ascontiguousarray(values.reshape(-1, values.shape[-1]))
+
+    # bin edges follow scipy.stats.binned_statistic, slice by slice
+    edges_dtype = (
+        flat.dtype if np.issubdtype(flat.dtype, np.floating) else 'float64')
+
+    if np.isscalar(bins):
+        if value_range is None:
+            smin = flat.min(axis=-1).astype('float64')
+            smax = flat.max(axis=-1).astype('float64')
+        else:
+            if np.ndim(value_range) == 2:
+                value_range = value_range[0]
+            smin = np.full(len(flat), value_range[0], dtype='float64')
+            smax = np.full(len(flat), value_range[1], dtype='float64')
+
+        same = smin == smax
+        smin[same] -= .5
+        smax[same] += .5
+
+        edges = np.linspace(smin, smax, bins + 1, axis=-1, dtype=edges_dtype)
+
+    else:
+        edges = np.asarray(bins, dtype=edges_dtype)[np.newaxis, :]
+
+    edges = np.ascontiguousarray(edges)
+
+    min_width = np.diff(edges, axis=-1).min(axis=-1)
+    if (min_width == 0).any():
+        raise ValueError('The smallest edge difference is numerically 0.')
+
+    decimals = (-np.log10(min_width)).astype('int64') + 6
+
+    result = _binned_statistic_kernel(
+        flat, edges, decimals, NUMBA_STATISTICS.index(statistic),
+        _num_chunks(len(flat)))
+
+    return np.moveaxis(result.reshape(shape + (edges.shape[-1] - 1, )), -1, axis)
+
+
+# below this length, compiled kernels sort with an insertion sort
+_INSERTION_SORT_SIZE = 64
+
+
+def _num_chunks(ncells):
+    # split cells into a few chunks per thread, each of which allocates its
+    # scratch buffers once
+    return min(ncells, 4 * numba.get_num_threads())
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _fill_quantiles(v, w, c, m, quantiles, old_style, out):
+
+        if m == 0:
+            out[:] = np.nan
+            return
+
+        # locate the center of each weight's mass
+        acc = 0.
+        for i in range(m):
+            acc += w[i]
+            c[i] = acc - 0.5 * w[i]
+
+        if old_style:
+            first = c[0]
+            for i in range(m):
+                c[i] -= first
+            scale = c[m - 1]
+        else:
+            scale = acc
+
+        # a single member (old_style) or weights summing to zero leave no
+        # spread to normalize, and the NumPy engine's interpolation on the
+        # resulting NaN centers returns the first value
+        if scale == 0:
+            out[:] = v[0]
+            return
+
+        for i in range(m):
+            c[i] /= scale
+
+        # numpy.interp of each quantile
+        for k in range(len(quantiles)):
+            x = quantiles[k]
+
+            lo = 0
+            hi = m
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if c[mid] <= x:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            j = lo - 1
+
+            if j < 0:
+                out[k] = v[0]
+            elif j >= m - 1:
+                out[k] = v[m - 1]
+            elif x == c[j]:
+                out[k] = v[j]
+            else:
+                slope = (v[j + 1] - v[j]) / (c[j + 1] - c[j])
+                res = slope * (x - c[j]) + v[j]
+                if np.isnan(res):
+                    res = slope * (x - c[j + 1]) + v[j + 1]
+                    if np.isnan(res) and v[j] == v[j + 1]:
+                        res = v[j]
+                out[k] = res
+
+    @numba.njit(parallel=True, cache=True)
+    def _weighted_quantile_kernel(
+            values, weights, quantiles, old_style, skipna, values_sorted,
+            nchunks):
+
+        ncells, n = values.shape
+        result = np.empty((ncells, len(quantiles)))
+
+        for chunk in numba.prange(nchunks):
+            start = chunk * ncells // nchunks
+            stop = (chunk + 1) * ncells // nchunks
+
+            v = np.empty(n)
+            w = np.empty(n)
+            c = np.empty(n)
+
+            for cell in range(start, stop):
+                row = 0 if weights.shape[0] == 1 else cell
+
+                if values_sorted or n > _INSERTION_SORT_SIZE:
+                    if values_sorted:
+                        order = np.arange(n)
+                    else:
+                        order = np.argsort(values[cell])
+
+                    m = 0
+                    for i in range(n):
+                        x = values[cell, order[i]]
+                        if skipna and np.isnan(x):
+                            continue
+                        v[m] = x
+                        w[m] = weights[row, order[i]]
+                        m += 1
+
+                else:
+                    # short distributions: insertion sort into the scratch
+                    # buffers, NaNs last, without allocating
+                    m = 0
+                    for i in range(n):
+                        x = values[cell, i]
+                        if skipna and np.isnan(x):
+                            continue
+                        wx = weights[row, i]
+                        j = m
+                        while j > 0 and (
+                                x < v[j - 1]
+                                or (np.isnan(v[j - 1]) and not np.isnan(x))):
+                            v[j] = v[j - 1]
+                            w[j] = w[j - 1]
+                            j -= 1
+                        v[j] = x
+                        w[j] = wx
+                        m += 1
+
+                _fill_quantiles(
+                    v, w, c, m, quantiles, old_style, result[cell])
+
+        return result
+
+    @numba.njit(parallel=True, cache=True)
+    def _binned_statistic_kernel(values, edges, decimals, statistic, nchunks):
+
+        ncells, n = values.shape
+        nbins = edges.shape[1] - 1
+        result = np.empty((ncells, nbins))
+
+        for chunk in numba.prange(nchunks):
+            start = chunk * ncells // nchunks
+            stop = (chunk + 1) * ncells // nchunks
+
+            counts = np.empty(nbins)
+            acc = np.empty(nbins)
+
+            for cell in range(start, stop):
+                row = 0 if edges.shape[0] == 1 else cell
+                last_edge = edges[row, nbins]
+                rounded_last = np.round(last_edge, decimals[row])
+
+                counts[:] = 0.
+                acc[:] = 0.
+
+                for i in range(n):
+                    x = values[cell, i]
+
+                    # np.digitize: index of the first edge > x
+                    lo = 0
+                    hi = nbins + 1
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if edges[row, mid] <= x:
+                            lo = mid + 1
+                        else:
+                            hi = mid
+
+                    # values on the rightmost edge go in the last bin
+                    if x >= last_edge and (
+                            np.round(x, decimals[row]) == rounded_last):
+                        lo -= 1
+
+                    if lo < 1 or lo > nbins:
+                        continue
+
+                    b = lo - 1
+                    counts[b] += 1
+
+                    if statistic == 3:
+                        if counts[b] == 1 or x < acc[b]:
+                            acc[b] = x
+                    elif statistic == 4:
+                        if counts[b] == 1 or x > acc[b]:
+                            acc[b] = x
+                    else:
+                        acc[b] += x
+
+                for b in range(nbins):
+                    if statistic == 0:
+                        result[cell, b] = counts[b]
+                    elif statistic == 1:
+                        result[cell, b] = acc[b]
+                    elif counts[b] == 0:
+                        result[cell, b] = np.nan
+                    elif statistic == 2:
+                        result[cell, b] = acc[b] / counts[b]
+                    else:
+                        result[cell, b] = acc[b]
+
+        return result
@@ -0,0 +1,328 @@
+"""
+Persistent sorted-order indexes of ensembles
+
+Archived ensembles are often queried many times for new quantiles or
+thresholds. A rank index stores, once, the argsort permutation of every
+cell along the ensemble dimension, so later queries with
+:py:func:`~impactlab_tools.utils.weighting.weighted_quantile_xr` or
+:py:func:`~impactlab_tools.utils.weighting.weighted_cdf` (and the GCP
+wrappers) only gather values instead of sorting them.
+
+Permutations are stored with the smallest integer type holding the ensemble
+size (``int8`` up to 127 members, ``int16`` up to 32767), together with the
+ensemble's member order and a fingerprint of the source. The fingerprint
+covers the shape, the coordinates and, for data read from a file, the
+file's size and modification time (for a Zarr store, its consolidated
+metadata and the size and modification time of the variable's chunks), so
+a stale index is refused instead of silently returning wrong quantiles.
+Variables read from Zarr carry no source of their own and are traced back
+to their store through their Dataset, so query Zarr data as a Dataset.
+Data without a source file are fingerprinted by their values (or their dask
+graph). Changes made in memory to data loaded from a file are not detected.
+
+Example
+-------
+
+.. code-block:: python
+
+    >>> import xarray as xr
+    >>> from impactlab_tools.utils.weighting import weighted_quantile_xr
+    >>> da = xr.DataArray(
+    ...     np.random.random((3, 4)),
+    ...     dims=['model', 'region'],
+    ...     coords={'model': ['a', 'b', 'c']})
+    ...
+    >>> index = build_rank_index(da, 'model')
+    >>> index.order().dtype
+    dtype('int8')
+
+    >>> q = weighted_quantile_xr(da, [0.5], np.ones(3), 'model')
+    >>> bool((q == weighted_quantile_xr(
+    ...     da, [0.5], np.ones(3), 'model', rank_index=index)).all())
+    True
+
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import xarray as xr
+
+
+# name of the index variable for an unnamed DataArray, as in xarray's own
+# DataArray.to_netcdf
+_DATAARRAY_NAME = '__xarray_dataarray_variable__'
+
+_VALID_COUNT_SUFFIX = '_valid_count'
+
+
+class RankIndex:
+    """
+    Sorted-order index of an ensemble along one dimension
+
+    Use :py:func:`build_rank_index` to create an index and
+    :py:func:`open_rank_index` to read a saved one.
+
+    Parameters
+    ----------
+
+    index : xarray.Dataset
+
+        one integer permutation variable per indexed data variable, along
+        with its number of non-NaN members per cell
+        (``<name>_valid_count``)
+
+    dim : str
+
+        ensemble dimension of the index
+    """
+
+    def __init__(self, index, dim):
+        self.index = index
+        self.dim = dim
+
+    @property
+    def models(self):
+        """Member order of the indexed ensemble along ``dim``"""
+        return self.index.coords[self.dim].values
+
+    def order(self, name=None):
+        """
+        Argsort permutation of a data variable along ``dim``
+
+        Parameters
+        ----------
+
+        name : str, optional
+
+            data variable name. Not needed for an index of a DataArray.
+
+        Returns
+        -------
+
+        xarray.DataArray
+        """
+        return self.index[_index_name(name)]
+
+    def valid_count(self, name=None):
+        """Number of non-NaN members of each cell of a data variable"""
+        return self.index[_index_name(name) + _VALID_COUNT_SUFFIX]
+
+    def check(self, data, source=None):
+        """
+        Raise a ``ValueError`` if ``data`` is not the indexed ensemble
+
+        Parameters
+        ----------
+
+        data : xarray.DataArray
+
+            data to be queried with the index
+
+        source : str, optional
+
+            file or Zarr store ``data`` was read from, if its own encoding
+            does not say, e.g. the source of its parent Dataset
+        """
+        name = _index_name(data.name)
+
+        if name not in self.index:
+            raise ValueError(f'No rank index for variable "{data.name}"')
+
+        if self.index[name].attrs.get('fingerprint') != _fingerprint(
+                data, self.dim, source):
+            raise ValueError(
+                f'The rank index of "{data.name}" is out of date. Rebuild it '
+                'with build_rank_index.')
+
+    def lookup(self, data, source=None):
+        """
+        Permutation and valid counts for ``data``, after :py:meth:`check`
+
+        Returns
+        -------
+
+        order, valid_count : xarray.DataArray
+            aligned with ``data``
+        """
+        self.check(data, source)
+
+        order = self.order(data.name).reset_coords(drop=True)
+        valid_count = self.valid_count(data.name).reset_coords(drop=True)
+
+        return (
+            order.transpose(*data.dims),
+            valid_count.transpose(*[d for d in data.dims if d != self.dim]))
+
+    def save(self, path):
+        """
+        Write the index to NetCDF, or to Zarr if ``path`` ends in ``.zarr``
+        """
+        if str(path).endswith('.zarr'):
+            self.index.to_zarr(path, mode='w')
+        else:
+            self.index.to_netcdf(path)
+
+
+def build_rank_index(data, dim='model', path=None):
+    """
+    Sort an ensemble once and store its rank index
+
+    Parameters
+    ----------
+
+    data : DataArray or Dataset
+
+        ensemble indexed by ``dim``. For a Dataset, every variable with
+        ``dim`` is indexed. Dask-backed data are sorted chunk by chunk.
+
+    dim : str, optional
+
+        ensemble dimension (default ``'model'``)
+
+    path : str, optional
+
+        if provided, the index is also written to this NetCDF (or ``.zarr``)
+        file, e.g. next to the ensemble's own files
+
+    Returns
+    -------
+
+    RankIndex
+    """
+    if hasattr(data, 'data_vars'):
+        arrays = [data[var] for var in data.data_vars if dim in data[var].dims]
+    else:
+        arrays = [data]
+
+    source = data.encoding.get('source')
+
+    # smallest signed type holding both the positions and the valid counts
+    dtype = np.min_scalar_type(-data.sizes[dim] - 1)
+
+    index = xr.Dataset()
+
+    for array in arrays:
+        name = _index_name(array.name)
+
+        order = xr.apply_ufunc(
+            _argsort,
+            array.chunk({dim: -1}) if array.chunks is not None else array,
+            input_core_dims=[[dim]],
+            output_core_dims=[[dim]],
+            kwargs={'dtype': dtype},
+            dask='parallelized',
+            output_dtypes=[dtype])
+
+        index[name] = order.transpose(*array.dims).reset_coords(drop=True)
+        index[name].attrs['fingerprint'] = _fingerprint(array, dim, source)
+
+        index[name + _VALID_COUNT_SUFFIX] = (
+            array.notnull().sum(dim).astype(dtype).reset_coords(drop=True))
+
+    index.attrs['dim'] = dim
+
+    rank_index = RankIndex(index, dim)
+
+    if path is not None:
+        rank_index.save(path)
+
+    return rank_index
+
+
+def open_rank_index(path, data=None):
+    """
+    Open a rank index written by :py:func:`build_rank_index`
+
+    Parameters
+    ----------
+
+    path : str
+
+        NetCDF file or ``.zarr`` store
+
+    data : DataArray or Dataset, optional
+
+        if provided, the index is checked against ``data`` immediately
+
+    Returns
+    -------
+
+    RankIndex
+    """
+    if str(path).endswith('.zarr'):
+        index = xr.open_zarr(path)
+    else:
+        index = xr.open_dataset(path)
+
+    rank_index = RankIndex(index, index.attrs['dim'])
+
+    if data is not None:
+        if hasattr(data, 'data_vars'):
+            for var in data.data_vars:
+                if rank_index.dim in data[var].dims:
+                    rank_index.check(data[var], data.encoding.get('source'))
+        else:
+            rank_index.check(data)
+
+    return rank_index
+
+
+def _index_name(name):
+    return _DATAARRAY_NAME if name is None else str(name)
+
+
+def _argsort(values, dtype):
+    return np.argsort(values, axis=-1).astype(dtype)
+
+
+def _update_from_store(digest, store, name):
+    """
+    Hash a Zarr store's consolidated metadata and the size and modification
+    time of the chunks of variable ``name``, without reading them
+    """
+    for metadata in ['.zmetadata', 'zarr.json']:
+        path = os.path.join(store, metadata)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+
+    root = os.path.join(store, str(name))
+    if not os.path.isdir(root):
+        root = store
+
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for file in sorted(files):
+            stat = os.stat(os.path.join(directory, file))
+            digest.update(repr((
+                os.path.relpath(os.path.join(directory, file), store),
+                stat.st_size,
+                stat.st_mtime_ns)).encode())
+
+
+def _fingerprint(data, dim, source=None):
+    digest = hashlib.sha256()
+
+    digest.update(repr((data.dims, data.shape, str(data.dtype))).encode())
+    for d in data.dims:
+        if d in data.coords:
+            digest.update(np.asarray(data.coords[d].values).astype(str).tobytes())
+
+    source = data.encoding.get('source', source)
+    if source is not None and os.path.isdir(source):
+        _update_from_store(digest, source, data.name)
+
+    elif source is not None and os.path.exists(source):
+        stat = os.stat(source)
+        digest.update(repr((source, stat.st_size, stat.st_mtime_ns)).encode())
+
+    elif data.chunks is None:
+        digest.update(np.ascontiguousarray(data.values).tobytes())
+
+    else:
+        # dask names are deterministic tokens of the graph's inputs
+        digest.update(data.data.name.encode())
+
+    return digest.hexdigest()
@@ -0,0 +1,151 @@
+"""
+Sparse-matrix aggregation of xarray objects along one dimension
+
+Grouped sums (e.g. of counties to states, or of impact regions to
+countries) are computed as a product with a sparse (group, member)
+membership matrix. Group memberships are built once and reused, and all
+the cells of the data are aggregated in one product instead of a groupby
+shuffle.
+
+Example
+-------
+
+.. code-block:: python
+
+    >>> import xarray as xr
+    >>> da = xr.DataArray([1., 2., 4.], dims=['region'])
+    >>> matrix = membership_matrix([0, 1, 1])
+    >>> sparse_sum(da, matrix, 'region', 'group').values
+    array([1., 6.])
+
+"""
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import xarray as xr
+
+
+def membership_matrix(codes, ngroups=None, weights=None):
+    """
+    Sparse (group, member) matrix from the group code of every member
+
+    Parameters
+    ----------
+
+    codes : array-like
+
+        integer group of every member. Members with a negative code belong
+        to no group.
+
+    ngroups : int, optional
+
+        number of groups (default: the largest code plus one)
+
+    weights : array-like, optional
+
+        weight of every member (default 1)
+
+    Returns
+    -------
+
+    scipy.sparse.csr_matrix
+    """
+    codes = np.asarray(codes)
+
+    if ngroups is None:
+        ngroups = codes.max() + 1 if len(codes) else 0
+
+    members = np.nonzero(codes >= 0)[0]
+    data = (
+        np.ones(len(members)) if weights is None
+        else np.asarray(weights, dtype='float64')[members])
+
+    return scipy.sparse.csr_matrix(
+        (data, (codes[members], members)), shape=(ngroups, len(codes)))
+
+
+def sparse_sum(data, matrix, dim, new_dim):
+    """
+    Sum ``data`` along ``dim`` into groups with a sparse matrix
+
+    NaN values are skipped, as in a groupby sum.
+
+    Parameters
+    ----------
+
+    data : DataArray or Dataset
+
+        data to aggregate. Variables without ``dim`` are broadcast along it.
+        Dask-backed data are aggregated lazily, chunk by chunk.
+
+    matrix : scipy.sparse matrix
+
+        (group, member) matrix, with one column per element of ``dim``
+
+    dim : str
+
+        dimension to aggregate
+
+    new_dim : str
+
+        name of the group dimension, which takes the place of ``dim``
+
+    Returns
+    -------
+
+    DataArray or Dataset
+    """
+    if isinstance(data, xr.Dataset):
+        return data.map(sparse_sum, args=(matrix, dim, new_dim))
+
+    if dim not in data.dims:
+        return data * xr.DataArray(
+            np.asarray(matrix.sum(axis=1)).ravel(), dims=[new_dim])
+
+    if data.chunks is not None:
+        data = data.chunk({dim: -1})
+
+    sums = xr.apply_ufunc(
+        _sparse_sum,
+        data,
+        input_core_dims=[[dim]],
+        output_core_dims=[[new_dim]],
+        kwargs={'matrix': matrix.tocsr(), 'axis': data.get_axis_num(dim)},
+        dask='parallelized',
+        output_dtypes=['float64'],
+        dask_gufunc_kwargs={'output_sizes': {new_dim: matrix.shape[0]}})
+
+    return sums.transpose(*[new_dim if d == dim else d for d in data.dims])
+
+
+def array_key(values):
+    """
+    Hashable digest of an array's values, to cache matrices by membership
+    """
+    return hashlib.sha1(
+        pd.util.hash_array(np.asarray(values).ravel()).tobytes()).digest()
+
+
+def _sparse_sum(values, matrix, axis):
+
+    # undo the transposition of apply_ufunc, which is usually a view of a
+    # contiguous array, so that it reshapes without copying
+    values = np.moveaxis(np.asarray(values), -1, axis)
+
+    if values.dtype.kind == 'f' and np.isnan(values).any():
+        values = np.where(np.isnan(values), 0., values)
+
+    shape = values.shape
+    blocks = values.reshape(
+        (int(np.prod(shape[:axis])), shape[axis], -1))
+
+    result = np.empty((len(blocks), matrix.shape[0], blocks.shape[-1]))
+    for i, block in enumerate(blocks):
+        result[i] = matrix @ block
+
+    return np.moveaxis(
+        result.reshape(shape[:axis] + (matrix.shape[0], ) + shape[axis + 1:]),
+        axis, -1)
@@ -4,27 +4,32 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
-from functools import cache
-import os
+from collections.abc import Mapping
 
-import impactlab_tools.assets
+from impactlab_tools.utils import engines
+from impactlab_tools.utils.weightregistry import get_weight_registry
 
 
-# file readers for default weights files in assets directory
+# temporary dimension used to stack Dataset variables into a single block
+_VARIABLE_DIM = '__weighted_quantile_variable__'
 
-@cache
-def _get_weights(project='acp', rcp='rcp85'):
+# statistics available in weighted_summary besides quantiles
+_SUMMARY_MOMENTS = ('mean', 'var', 'std', 'skew', 'min', 'max')
+
+# default cap on the number of gathered values per bootstrap batch
+_BOOTSTRAP_BATCH_ELEMENTS = 2 ** 24
+
+# default cap on the number of pooled values per batch of rolling windows
+_ROLLING_BATCH_ELEMENTS = 2 ** 21
+
+# probability that WeightedQuantileSketch.rank_error is exceeded at a value
+_SKETCH_FAILURE_PROBABILITY = 1e-6
 
-    da = (
-        pd.read_csv(
-            os.path.join(
-                os.path.dirname(impactlab_tools.assets.__file__),
-                f'weights_{project}.csv'),
-            index_col=[0, 1])['weight']
-        .xs(rcp, level='rcp')
-        .to_xarray())
 
-    return da
+# default weights from the assets directory
+
+def _get_weights(project='acp', rcp='rcp85'):
+    return get_weight_registry().weights(project, rcp)
 
 
 # Computation helpers
@@ -34,7 +39,12 @@ def weighted_quantile_xr(
         quantiles,
         sample_weight,
         dim,
-        values_sorted=False):
+        values_sorted=False,
+        algorithm='sort',
+        skipna=False,
+        weighting_dim='weighting',
+        engine=None,
+        rank_index=None):
     """
     Compute quantiles of a weighted distribution
 
@@ -57,17 +67,57 @@ def weighted_quantile_xr(
 
         quantiles of distribution to return
 
-    sample_weight : numpy.array
+    sample_weight : numpy.array or mapping
 
-        weights array-like of the same length as `array`
+        weights array-like of the same length as `array`. If a mapping of
+        names to weights (e.g. ``{'rcp45': w45, 'rcp85': w85}``), quantiles
+        are computed for every weight set along a new leading dimension
+        ``weighting_dim`` labelled by the mapping's keys. The data are
+        sorted only once for all weight sets.
 
     values_sorted : bool
 
         if True, then will avoid sorting of initial array
 
-    dim : str
+    dim : str or list of str
 
-        Dimension along which to weight the data
+        Dimension along which to weight the data. If a list, the quantiles
+        are taken over all members of these dimensions (e.g.
+        ``['model', 'batch']``) without stacking the data. Weights may then
+        be given for the first dimension only, or for any subset of the
+        dimensions as a :py:class:`xarray.DataArray`. Members that share a
+        weight split it equally, i.e. the weights are divided by the number
+        of samples (the number of non-NaN samples in each cell if
+        ``skipna``) along the dimensions they do not vary over.
+
+    algorithm : str, optional
+
+        ``'sort'`` (default) or ``'select'``. See
+        :py:func:`weighted_quantile`.
+
+    skipna : bool, optional
+
+        if True, ignore NaN members and renormalize the remaining weights
+        separately for every cell. See :py:func:`weighted_quantile`.
+
+    weighting_dim : str, optional
+
+        name of the new dimension when ``sample_weight`` is a mapping
+        (default ``'weighting'``)
+
+    engine : str, optional
+
+        computation engine, see :py:func:`weighted_quantile`
+
+    rank_index : RankIndex, optional
+
+        sorted-order index of ``data`` along ``dim`` built with
+        :py:func:`~impactlab_tools.utils.rankindex.build_rank_index`. The
+        data are then not sorted: the weights are reordered with the stored
+        permutation and only the values bracketing each quantile are
+        gathered. ``dim`` must be the index's dimension; ``values_sorted``,
+        ``algorithm`` and ``engine`` are ignored. Raises ``ValueError`` if
+        the index does not match ``data``.
 
     Returns
     -------
@@ -76,21 +126,113 @@ def weighted_quantile_xr(
 
         computed quantiles from weighted distribution
 
+    Notes
+    -----
+
+    Dask-backed inputs stay lazy. ``data`` is rechunked so that ``dim`` is
+    held in a single chunk and the quantiles are computed block-by-block
+    with :py:func:`xarray.apply_ufunc`, so arrays larger than memory can be
+    processed in parallel by the active dask scheduler. Call ``.compute()``
+    (or write the result to disk) to evaluate it.
+
     """
     if hasattr(data, 'data_vars'):
-        res = xr.Dataset()
-        for var in data.data_vars.keys():
-            if dim in data[var].dims:
-                res[var] = _weighted_quantile_xr_da(
-                    data[var], quantiles, sample_weight, dim, values_sorted)
-            else:
-                res[var] = data[var]
-
-        return res
+        return _weighted_xr_ds(
+            _weighted_quantile_xr_da, data, quantiles, sample_weight, dim,
+            weighting_dim=weighting_dim, values_sorted=values_sorted,
+            algorithm=algorithm, skipna=skipna, engine=engine,
+            rank_index=rank_index)
 
     else:
         return _weighted_quantile_xr_da(
-            data, quantiles, sample_weight, dim, values_sorted)
+            data, quantiles, sample_weight, dim, weighting_dim=weighting_dim,
+            values_sorted=values_sorted, algorithm=algorithm, skipna=skipna,
+            engine=engine, rank_index=rank_index)
+
+
+def _core_dims(dim):
+    return [dim] if isinstance(dim, str) else list(dim)
+
+
+def _align_weights(sample_weight, data, dim):
+    if isinstance(sample_weight, Mapping):
+        return {
+            key: _align_weights(weights, data, dim)
+            for key, weights in sample_weight.items()}
+
+    if isinstance(dim, str):
+        if isinstance(sample_weight, (pd.Series, xr.DataArray)):
+            return sample_weight.loc[data.coords[dim].values].values
+
+        return sample_weight
+
+    # weights over several dims are returned with one (possibly length 1)
+    # axis per dimension in ``dim``
+    if isinstance(sample_weight, pd.Series):
+        sample_weight = xr.DataArray(
+            sample_weight, dims=[dim[0]], coords={dim[0]: sample_weight.index})
+
+    if isinstance(sample_weight, xr.DataArray):
+        weight_dims = [d for d in dim if d in sample_weight.dims]
+        sample_weight = sample_weight.sel({
+            d: data.coords[d].values for d in weight_dims if d in data.coords})
+
+        return sample_weight.transpose(*weight_dims).values.reshape(
+            [data.sizes[d] if d in weight_dims else 1 for d in dim])
+
+    return sample_weight
+
+
+def _weighted_xr_ds(
+        func, data, quantiles, sample_weight, dim, required_dims=(),
+        **kwargs):
+
+    # align the weights once for all variables
+    weights = _align_weights(sample_weight, data, dim)
+
+    # variables sharing the same dimensions are stacked along a temporary
+    # dimension and handled by one call to the DataArray function
+    # variables queried through a rank index are handled one by one, with
+    # their own stored permutation
+    # variables read from Zarr carry no source of their own, and are checked
+    # against the index through the Dataset's
+    indexed = kwargs.get('rank_index') is not None
+    if indexed:
+        kwargs['source'] = data.encoding.get('source')
+
+    # variables missing any of the dimensions are passed through
+    required_dims = list(_core_dims(dim)) + list(required_dims)
+
+    groups = {}
+    for var in data.data_vars.keys():
+        if all(d in data[var].dims for d in required_dims):
+            groups.setdefault(
+                var if indexed else data[var].dims, []).append(var)
+
+    computed = {}
+    for variables in groups.values():
+        if len(variables) == 1:
+            computed[variables[0]] = func(
+                data[variables[0]], quantiles, weights, dim, **kwargs)
+            continue
+
+        block = xr.concat(
+            [data[var].reset_coords(drop=True) for var in variables],
+            dim=_VARIABLE_DIM)
+
+        block_dist = func(block, quantiles, weights, dim, **kwargs)
+
+        for i, var in enumerate(variables):
+            computed[var] = block_dist.isel({_VARIABLE_DIM: i})
+
+    res = xr.Dataset()
+    for var in data.data_vars.keys():
+        if var in computed:
+            res[var] = computed[var]
+        else:
+            res[var] = data[var]
+
+    return res
 
 
 def _weighted_quantile_xr_da(
@@ -98,179 +240,2374 @@ def _weighted_quantile_xr_da(
         quantiles,
         sample_weight,
         dim,
-        values_sorted=False):
+        weighting_dim='weighting',
+        rank_index=None,
+        source=None,
+        **kwargs):
 
-    axis = data.get_axis_num(dim)
-    dims = list(data.dims[:axis]) + ['quantile'] + list(data.dims[axis+1:])
-    coords = {
-        coord: data.coords[coord] for coord in data.dims if coord in dims}
-    coords.update({'quantile': quantiles})
+    core_dims = _core_dims(dim)
 
-    if isinstance(sample_weight, (pd.Series, xr.DataArray)):
-        weights = sample_weight.loc[data.coords[dim].values].values
-    else:
-        weights = sample_weight
+    # the quantiles replace the first of the core dimensions
+    axis = min(data.get_axis_num(core_dims))
+    dims = (
+        list(data.dims[:axis]) + ['quantile'] +
+        [d for d in data.dims[axis:] if d not in core_dims])
 
-    data_dist = weighted_quantile(
-        data.values,
-        quantiles,
-        weights,
-        values_sorted=values_sorted,
-        axis=axis)
+    weights = _align_weights(sample_weight, data, dim)
+
+    kwargs.update(
+        quantiles=quantiles,
+        axis=-1 if isinstance(dim, str) else tuple(range(-len(core_dims), 0)))
+
+    output_core_dims = ['quantile']
+    output_sizes = {'quantile': len(quantiles)}
+    coords = {'quantile': quantiles}
 
-    data_dist = xr.DataArray(data_dist, dims=dims, coords=coords)
+    if isinstance(weights, dict):
+        func = _weighted_quantile_multi
+        kwargs['sample_weights'] = list(weights.values())
+        output_core_dims.insert(0, weighting_dim)
+        output_sizes[weighting_dim] = len(weights)
+        coords[weighting_dim] = list(weights.keys())
+        dims.insert(0, weighting_dim)
+
+    else:
+        func = weighted_quantile
+        kwargs['sample_weight'] = weights
+
+    inputs, input_core_dims = _rank_index_inputs(
+        data, rank_index, dim, core_dims, source)
+
+    if rank_index is not None:
+        func = _weighted_quantile_ranked
+        for key in ['values_sorted', 'algorithm', 'engine', 'axis']:
+            kwargs.pop(key, None)
+
+    # quantiles are computed independently for every cell, so dask arrays
+    # only need ``dim`` in a single chunk to be processed block-by-block
+    inputs = [
+        arr.chunk({d: -1 for d in core_dims})
+        if arr.chunks is not None and core_dims[0] in arr.dims else arr
+        for arr in inputs]
+
+    data_dist = xr.apply_ufunc(
+        func,
+        *inputs,
+        input_core_dims=input_core_dims,
+        output_core_dims=[output_core_dims],
+        kwargs=kwargs,
+        dask='parallelized',
+        output_dtypes=['float64'],
+        dask_gufunc_kwargs={'output_sizes': output_sizes})
+
+    data_dist = (
+        data_dist
+        .reset_coords(drop=True)
+        .assign_coords(coords)
+        .transpose(*dims))
 
     return data_dist
 
 
-def weighted_quantile(
-        values,
-        quantiles,
-        sample_weight=None,
-        values_sorted=False,
-        old_style=False,
-        axis=None):
+def _rank_index_inputs(data, rank_index, dim, core_dims, source=None):
     """
-    Compute quantiles of a weighted distribution
+    apply_ufunc inputs and core dimensions, adding the permutation and valid
+    counts of ``rank_index`` after ``data`` if given. ``source`` is the file
+    ``data`` was read from, if not in its encoding.
+    """
+    if rank_index is None:
+        return [data], [core_dims]
 
-    similar to :py:func:`weighted_quantile_1d` but supports weighting along any
-    (numbered) dimension
+    if dim != rank_index.dim:
+        raise ValueError(
+            f'rank_index is built along "{rank_index.dim}", not {dim!r}')
 
-    .. NOTE ::
+    order, valid_count = rank_index.lookup(data, source)
 
-        quantiles should be in [0, 1]!
+    return [data, order, valid_count], [core_dims, core_dims, []]
+
+
+def weighted_summary(
+        data,
+        dim,
+        sample_weight=None,
+        quantiles=[0.05, 0.17, 0.5, 0.83, 0.95],
+        moments=('mean', 'var', 'skew', 'min', 'max'),
+        skipna=False):
+    """
+    Compute weighted moments and quantiles of a distribution in one pass
+
+    The data are sorted once per chunk and all statistics are computed from
+    the sorted copy, so a (possibly dask-backed) ensemble is read only once
+    instead of once per statistic.
 
     Parameters
     ----------
 
-    values : numpy.array
+    data : DataArray or Dataset
 
-        numpy.array with data
+        :py:class:`xarray.DataArray` or :py:class:`xarray.Dataset` with data
+        indexed by ``dim``. Dataset variables without ``dim`` are passed
+        through unchanged.
 
-    quantiles : array-like
+    dim : str or list of str
 
-        quantiles of distribution to return
+        dimension(s) holding the distribution, as in
+        :py:func:`weighted_quantile_xr`
 
-    sample_weight : numpy.array
+    sample_weight : array-like, optional
 
-        weights array-like of the same length as `array`
+        weights along ``dim``, as in :py:func:`weighted_quantile_xr`. If not
+        provided, all members are weighted equally.
 
-    values_sorted : bool
+    quantiles : array-like, optional
 
-        if True, then will avoid sorting of initial array
+        quantiles of distribution to return. quantiles should be in [0, 1].
 
-    old_style : bool
+    moments : sequence of str, optional
 
-        if True, will correct output to be consistent with numpy.percentile.
+        statistics to compute besides the quantiles, among ``'mean'``,
+        ``'var'``, ``'std'``, ``'skew'``, ``'min'`` and ``'max'``. Variance,
+        standard deviation and skewness are population (biased) estimates,
+        as in :py:meth:`WeightedDistribution.var`.
+
+    skipna : bool, optional
+
+        if True, ignore NaN members and renormalize the weights of the
+        remaining members separately for every cell. Default False.
 
     Returns
     -------
 
-    numpy.array
+    DataArray or Dataset
 
-        computed quantiles from weighted distribution
+        statistics along a new dimension ``stat`` replacing ``dim``. ``stat``
+        is labelled by the names in ``moments`` followed by one label per
+        quantile (e.g. ``'q0.05'``), with the quantiles themselves in the
+        ``quantile`` coordinate (NaN for moments).
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> da = xr.DataArray(
+        ...     [[1., 2., 3., 4.], [2., 4., 6., 8.]], dims=['region', 'model'])
+        ...
+        >>> summary = weighted_summary(
+        ...     da, 'model', [0.1, 0.2, 0.3, 0.4], quantiles=[0.5],
+        ...     moments=['mean', 'max'])
+        ...
+        >>> summary.stat.values.tolist()
+        ['mean', 'max', 'q0.5']
+
+        >>> summary.sel(stat='mean').values
+        array([3., 6.])
 
     """
-    if len(values.shape) > 1 and axis is not None:
+    unknown = set(moments) - set(_SUMMARY_MOMENTS)
+    if unknown:
+        raise ValueError(
+            f'moments should be in {_SUMMARY_MOMENTS}, got {sorted(unknown)}')
 
-        return np.apply_along_axis(
-            weighted_quantile_1d,
-            axis,
-            values,
-            quantiles,
-            sample_weight,
-            values_sorted,
-            old_style)
+    _check_quantiles(quantiles)
 
-    else:
+    if hasattr(data, 'data_vars'):
+        return _weighted_xr_ds(
+            _weighted_summary_xr_da, data, quantiles, sample_weight, dim,
+            moments=tuple(moments), skipna=skipna)
 
-        return weighted_quantile_1d(
-            values,
-            quantiles,
-            sample_weight,
-            values_sorted,
-            old_style)
+    return _weighted_summary_xr_da(
+        data, quantiles, sample_weight, dim, moments=tuple(moments),
+        skipna=skipna)
 
 
-def weighted_quantile_1d(
-        values,
-        quantiles,
+def _weighted_summary_xr_da(data, quantiles, sample_weight, dim, **kwargs):
+
+    core_dims = _core_dims(dim)
+    quantiles = list(np.atleast_1d(quantiles))
+
+    # the statistics replace the first of the core dimensions
+    axis = min(data.get_axis_num(core_dims))
+    dims = (
+        list(data.dims[:axis]) + ['stat'] +
+        [d for d in data.dims[axis:] if d not in core_dims])
+
+    weights = _align_weights(sample_weight, data, dim)
+    if weights is None:
+        weights = np.ones([data.sizes[d] for d in core_dims])
+
+    kwargs.update(
+        quantiles=quantiles,
+        sample_weight=weights,
+        axis=-1 if isinstance(dim, str) else tuple(range(-len(core_dims), 0)))
+
+    stats = list(kwargs['moments']) + [f'q{q:g}' for q in quantiles]
+
+    if data.chunks is not None:
+        data = data.chunk({d: -1 for d in core_dims})
+
+    data_summary = xr.apply_ufunc(
+        _weighted_summary,
+        data,
+        input_core_dims=[core_dims],
+        output_core_dims=[['stat']],
+        kwargs=kwargs,
+        dask='parallelized',
+        output_dtypes=['float64'],
+        dask_gufunc_kwargs={'output_sizes': {'stat': len(stats)}})
+
+    return (
+        data_summary
+        .reset_coords(drop=True)
+        .assign_coords(
+            stat=stats,
+            quantile=(
+                'stat', [np.nan] * len(kwargs['moments']) + quantiles))
+        .transpose(*dims))
+
+
+def weighted_cdf(
+        data,
+        thresholds,
         sample_weight=None,
-        values_sorted=False,
-        old_style=False):
+        dim='model',
+        skipna=False,
+        exceedance=False,
+        rank_index=None):
     """
-    Very close to numpy.percentile, but supports weights
+    Weighted cumulative (or exceedance) probability of thresholds
 
-    Thanks to Alleo!
-    http://stackoverflow.com/questions/21844024/weighted-percentile-using-numpy/29677616#29677616
+    The inverse of :py:func:`weighted_quantile_xr`: for every cell, the
+    cumulative weight centers of the sorted members are interpolated
+    linearly at the thresholds, as in :py:meth:`WeightedDistribution.cdf`.
+    Thresholds below the smallest member have probability 0 and thresholds
+    above the largest member have probability 1.
 
-    .. NOTE ::
+    Parameters
+    ----------
 
-        quantiles should be in [0, 1]!
+    data : DataArray or Dataset
+
+        :py:class:`xarray.DataArray` or :py:class:`xarray.Dataset` with data
+        indexed by ``dim``. Dataset variables without ``dim`` are passed
+        through unchanged. Dask-backed inputs stay lazy.
+
+    thresholds : scalar, array-like or DataArray
+
+        values at which to evaluate the CDF. A scalar drops ``dim``; a 1-D
+        array adds a new dimension ``threshold`` in its place. A
+        :py:class:`xarray.DataArray` (e.g. a map of thresholds by region)
+        broadcasts against the dimensions of ``data`` other than ``dim``;
+        its own extra dimensions replace ``dim``.
+
+    sample_weight : array-like, optional
+
+        weights along ``dim``, as in :py:func:`weighted_quantile_xr`. If not
+        provided, all members are weighted equally.
+
+    dim : str or list of str, optional
+
+        dimension(s) holding the distribution, as in
+        :py:func:`weighted_quantile_xr`. Default ``'model'``.
+
+    skipna : bool, optional
+
+        if True, ignore NaN members and renormalize the weights of the
+        remaining members separately for every cell. Default False.
+
+    exceedance : bool, optional
+
+        if True, return the probability of exceeding the thresholds
+        (``1 - cdf``) instead. Default False.
+
+    rank_index : RankIndex, optional
+
+        sorted-order index of ``data`` along ``dim``, used instead of
+        sorting. See :py:func:`weighted_quantile_xr`.
+
+    Returns
+    -------
+
+    DataArray or Dataset
+
+        probabilities, with ``dim`` replaced by the dimensions of
+        ``thresholds`` that are not in ``data``. NaN thresholds return NaN.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> da = xr.DataArray(
+        ...     [[1., 2., 3., 4.], [2., 4., 6., 8.]],
+        ...     dims=['region', 'model'],
+        ...     coords={'region': ['a', 'b']})
+        ...
+        >>> thresholds = xr.DataArray(
+        ...     [2.5, 5.], dims=['region'], coords={'region': ['a', 'b']})
+        ...
+        >>> weighted_cdf(da, thresholds, np.ones(4), exceedance=True).values
+        array([0.5, 0.5])
+
+    """
+
+    if not isinstance(thresholds, xr.DataArray):
+        if np.ndim(thresholds) == 0:
+            thresholds = xr.DataArray(thresholds)
+        else:
+            thresholds = xr.DataArray(
+                thresholds, dims=['threshold'],
+                coords={'threshold': thresholds})
+
+    if hasattr(data, 'data_vars'):
+        return _weighted_xr_ds(
+            _weighted_cdf_xr_da, data, thresholds, sample_weight, dim,
+            skipna=skipna, exceedance=exceedance, rank_index=rank_index)
+
+    return _weighted_cdf_xr_da(
+        data, thresholds, sample_weight, dim, skipna=skipna,
+        exceedance=exceedance, rank_index=rank_index)
+
+
+def _weighted_cdf_xr_da(
+        data, thresholds, sample_weight, dim, rank_index=None, source=None,
+        **kwargs):
+
+    core_dims = _core_dims(dim)
+
+    # dimensions of the thresholds that are new replace the first core
+    # dimension
+    axis = min(data.get_axis_num(core_dims))
+    new_dims = [d for d in thresholds.dims if d not in data.dims]
+    dims = (
+        list(data.dims[:axis]) + new_dims +
+        [d for d in data.dims[axis:] if d not in core_dims])
+
+    weights = _align_weights(sample_weight, data, dim)
+    if weights is None:
+        weights = np.ones([data.sizes[d] for d in core_dims])
+
+    kwargs.update(
+        sample_weight=weights,
+        axis=-1 if isinstance(dim, str) else tuple(range(-len(core_dims), 0)))
+
+    inputs, input_core_dims = _rank_index_inputs(
+        data, rank_index, dim, core_dims, source)
+
+    inputs = [
+        arr.chunk({d: -1 for d in core_dims})
+        if arr.chunks is not None and core_dims[0] in arr.dims else arr
+        for arr in inputs]
+
+    if rank_index is not None:
+        kwargs['ranked'] = True
+
+    probability = xr.apply_ufunc(
+        _weighted_cdf,
+        inputs[0],
+        thresholds,
+        *inputs[1:],
+        input_core_dims=input_core_dims[:1] + [[]] + input_core_dims[1:],
+        kwargs=kwargs,
+        dask='parallelized',
+        output_dtypes=['float64'])
+
+    return probability.transpose(*dims)
+
+
+def weighted_quantile_bootstrap(
+        data,
+        quantiles,
+        sample_weight,
+        dim,
+        n_resamples=1000,
+        seed=None,
+        confidence_level=None,
+        skipna=False,
+        batch_size=None):
+    """
+    Bootstrap weighted quantiles by resampling members along ``dim``
+
+    Every resample draws ``data.sizes[dim]`` members with replacement; each
+    drawn member keeps its weight and quantiles are computed as in
+    :py:func:`weighted_quantile_xr`. All resample indices are drawn at once
+    and resamples are evaluated together in batches by the vectorized
+    kernel, so there is no Python loop over resamples.
 
     Parameters
     ----------
 
-    values : numpy.array
+    data : DataArray or Dataset
 
-        numpy.array with data
+        :py:class:`xarray.DataArray` or :py:class:`xarray.Dataset` with data
+        indexed by ``dim``. Dask-backed inputs stay lazy; every chunk uses
+        the same resamples.
 
     quantiles : array-like
 
-        quantiles of distribution to return
+        quantiles of distribution to return. quantiles should be in [0, 1].
 
-    sample_weight : numpy.array
+    sample_weight : array-like
 
-        weights array-like of the same length as `array`
+        weights along ``dim``, as in :py:func:`weighted_quantile_xr`
 
-    values_sorted : bool
+    dim : str
 
-        if True, then will avoid sorting of initial array
+        dimension holding the members to resample
 
-    old_style : bool
+    n_resamples : int, optional
 
-        if True, will correct output to be consistent with numpy.percentile.
+        number of bootstrap resamples (default 1000)
+
+    seed : int or numpy.random.Generator, optional
+
+        seed of the resampling, for reproducible results
+
+    confidence_level : float, optional
+
+        if provided, return the bounds of the central (percentile)
+        confidence interval at this level along a new dimension ``bound``
+        (``'lower'``, ``'upper'``) instead of every resample
+
+    skipna : bool, optional
+
+        if True, ignore NaN members of each resample. Default False.
+
+    batch_size : int, optional
+
+        number of resamples evaluated together. By default, batches hold
+        about 16 million gathered values per block of ``data``, which caps
+        memory use.
 
     Returns
     -------
 
-    numpy.array
+    DataArray or Dataset
 
-        computed quantiles from weighted distribution
+        quantiles along a new dimension ``quantile`` replacing ``dim``, with
+        a new leading dimension ``resample`` (or ``bound``)
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> da = xr.DataArray(np.arange(10.), dims=['model'])
+        >>> ci = weighted_quantile_bootstrap(
+        ...     da, [0.5], np.ones(10), 'model', n_resamples=200, seed=0,
+        ...     confidence_level=0.9)
+        ...
+        >>> ci.dims
+        ('bound', 'quantile')
+
+        >>> bool(ci.sel(bound='lower') < 4.5 < ci.sel(bound='upper'))
+        True
 
     """
-    values = np.array(values)
-    quantiles = np.array(quantiles)
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, data.sizes[dim], (n_resamples, data.sizes[dim]))
 
-    if sample_weight is None:
-        return np.percentile(values, quantiles)
+    if hasattr(data, 'data_vars'):
+        result = _weighted_xr_ds(
+            _weighted_quantile_bootstrap_xr_da, data, quantiles,
+            sample_weight, dim, indices=indices, skipna=skipna,
+            batch_size=batch_size)
+    else:
+        result = _weighted_quantile_bootstrap_xr_da(
+            data, quantiles, sample_weight, dim, indices=indices,
+            skipna=skipna, batch_size=batch_size)
 
-    sample_weight = np.array(sample_weight)
+    if confidence_level is None:
+        return result
 
-    if not np.all(quantiles >= 0) and np.all(quantiles <= 1):
-        raise ValueError('quantiles should be in [0, 1]')
+    tail = (1 - confidence_level) / 2
 
-    if not values_sorted:
+    # xarray's quantile adds its own ``quantile`` dimension
+    return (
+        result
+        .rename({'quantile': _VARIABLE_DIM})
+        .quantile([tail, 1 - tail], dim='resample', skipna=skipna)
+        .rename({'quantile': 'bound'})
+        .rename({_VARIABLE_DIM: 'quantile'})
+        .assign_coords(bound=['lower', 'upper']))
 
-        sorter = np.argsort(values)
-        values = values[sorter]
-        sample_weight = sample_weight[sorter]
 
-    # Find the cumsum, and locate the center of each weight's mass
-    # e.g. [0.25, 0.25, 0.5, 0] --> [0.125, 0.375, 0.75, 1]
-    weighted_quantiles = np.cumsum(sample_weight) - 0.5 * sample_weight
+def _weighted_quantile_bootstrap_xr_da(
+        data, quantiles, sample_weight, dim, **kwargs):
 
-    if old_style:
+    # the quantiles replace ``dim``, after a leading ``resample`` dimension
+    axis = data.get_axis_num(dim)
+    dims = (
+        ['resample'] + list(data.dims[:axis]) + ['quantile'] +
+        list(data.dims[axis + 1:]))
 
-        # To be convenient with np.percentile
-        # e.g. [0, 0.25, 0.25, 0.5, 0] --> [ 0, 0.2857, 0.7143, 1]
-        weighted_quantiles -= weighted_quantiles[0]
-        weighted_quantiles /= weighted_quantiles[-1]
+    kwargs.update(
+        quantiles=quantiles,
+        sample_weight=np.asarray(
+            _align_weights(sample_weight, data, dim), dtype='float64'))
 
-    else:
+    if data.chunks is not None:
+        data = data.chunk({dim: -1})
 
-        weighted_quantiles /= np.sum(sample_weight)
+    n_resamples = len(kwargs['indices'])
 
-    result = np.interp(quantiles, weighted_quantiles, values)
+    resampled = xr.apply_ufunc(
+        _weighted_quantile_bootstrap,
+        data,
+        input_core_dims=[[dim]],
+        output_core_dims=[['resample', 'quantile']],
+        kwargs=kwargs,
+        dask='parallelized',
+        output_dtypes=['float64'],
+        dask_gufunc_kwargs={
+            'output_sizes': {
+                'resample': n_resamples, 'quantile': len(quantiles)}})
+
+    return (
+        resampled
+        .reset_coords(drop=True)
+        .assign_coords(quantile=quantiles)
+        .transpose(*dims))
+
+
+def rolling_weighted_quantile(
+        data,
+        quantiles,
+        sample_weight,
+        dim='model',
+        time_dim='year',
+        window=20,
+        stride=1,
+        skipna=False):
+    """
+    Weighted quantiles pooling ``dim`` over a rolling window along time
 
-    return result
+    Each window pools all members of ``dim`` over ``window`` consecutive
+    steps of ``time_dim``, as :py:func:`weighted_quantile_xr` would with
+    ``dim=[dim, time_dim]`` on that window. Windows are read from a strided
+    view of the data and sorted together, in batches of windows, instead of
+    one call per window.
+
+    Parameters
+    ----------
+
+    data : DataArray or Dataset
+
+        :py:class:`xarray.DataArray` or :py:class:`xarray.Dataset` with data
+        indexed by ``dim`` and ``time_dim``. Dataset variables without both
+        dimensions are passed through unchanged. Dask-backed inputs stay
+        lazy.
+
+    quantiles : array-like
+
+        quantiles of distribution to return. quantiles should be in [0, 1].
+
+    sample_weight : array-like
+
+        weights along ``dim``, as in :py:func:`weighted_quantile_xr`. Every
+        step of a window has the same weights.
+
+    dim : str, optional
+
+        dimension holding the ensemble members (default ``'model'``)
+
+    time_dim : str, optional
+
+        dimension along which the window rolls (default ``'year'``)
+
+    window : int, optional
+
+        number of ``time_dim`` steps pooled by each window (default 20)
+
+    stride : int, optional
+
+        number of steps between consecutive windows. Use ``stride=window``
+        for adjacent windows such as 2020-2039, 2040-2059, ... (default 1)
+
+    skipna : bool, optional
+
+        if True, ignore NaN members of each window. Default False.
+
+    Returns
+    -------
+
+    DataArray or Dataset
+
+        quantiles along a new dimension ``quantile`` replacing ``dim``.
+        Only complete windows are returned; ``time_dim`` is labelled by the
+        last step of each window, as in :py:meth:`xarray.DataArray.rolling`,
+        and the coordinate ``window_start`` holds the first step.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        >>> da = xr.DataArray(
+        ...     np.arange(12.).reshape(6, 2),
+        ...     dims=['year', 'model'],
+        ...     coords={'year': range(2020, 2026)})
+        ...
+        >>> rolled = rolling_weighted_quantile(
+        ...     da, [0.5], np.ones(2), window=3, stride=3)
+        ...
+        >>> rolled.year.values
+        array([2022, 2025])
+
+        >>> rolled.window_start.values
+        array([2020, 2023])
+
+        >>> rolled.sel(quantile=0.5).values
+        array([2.5, 8.5])
+
+    """
+    if window < 1 or stride < 1:
+        raise ValueError('window and stride should be positive')
+
+    if hasattr(data, 'data_vars'):
+        return _weighted_xr_ds(
+            _rolling_weighted_quantile_xr_da, data, quantiles, sample_weight,
+            dim, required_dims=[time_dim], time_dim=time_dim, window=window,
+            stride=stride, skipna=skipna)
+
+    return _rolling_weighted_quantile_xr_da(
+        data, quantiles, sample_weight, dim, time_dim=time_dim, window=window,
+        stride=stride, skipna=skipna)
+
+
+def _rolling_weighted_quantile_xr_da(
+        data, quantiles, sample_weight, dim, time_dim, window, stride,
+        **kwargs):
+
+    starts = np.arange(0, data.sizes[time_dim] - window + 1, stride)
+
+    # the quantiles replace ``dim``; windows keep the position of time_dim
+    dims = [d if d != dim else 'quantile' for d in data.dims]
+
+    kwargs.update(
+        quantiles=quantiles,
+        sample_weight=np.asarray(
+            _align_weights(sample_weight, data, dim), dtype='float64'),
+        window=window,
+        stride=stride)
+
+    if data.chunks is not None:
+        data = data.chunk({dim: -1, time_dim: -1})
+
+    rolled = xr.apply_ufunc(
+        _rolling_weighted_quantile,
+        data,
+        input_core_dims=[[time_dim, dim]],
+        output_core_dims=[[time_dim, 'quantile']],
+        exclude_dims={time_dim},
+        kwargs=kwargs,
+        dask='parallelized',
+        output_dtypes=['float64'],
+        dask_gufunc_kwargs={
+            'output_sizes': {
+                time_dim: len(starts), 'quantile': len(quantiles)}})
+
+    coords = {'quantile': quantiles}
+    if time_dim in data.coords:
+        labels = data.coords[time_dim].values
+        coords[time_dim] = labels[starts + window - 1]
+        coords['window_start'] = (time_dim, labels[starts])
+
+    return (
+        rolled
+        .reset_coords(drop=True)
+        .assign_coords(coords)
+        .transpose(*dims))
+
+
+def weighted_quantile(
+        values,
+        quantiles,
+        sample_weight=None,
+        values_sorted=False,
+        old_style=False,
+        axis=None,
+        algorithm='sort',
+        skipna=False,
+        engine=None):
+    """
+    Compute quantiles of a weighted distribution
+
+    similar to :py:func:`weighted_quantile_1d` but supports weighting along any
+    (numbered) dimension
+
+    .. NOTE ::
+
+        quantiles should be in [0, 1]!
+
+    Parameters
+    ----------
+
+    values : numpy.array
+
+        numpy.array with data
+
+    quantiles : array-like
+
+        quantiles of distribution to return
+
+    sample_weight : numpy.array
+
+        weights array-like of the same length as `array`
+
+    values_sorted : bool
+
+        if True, then will avoid sorting of initial array
+
+    old_style : bool
+
+        if True, will correct output to be consistent with numpy.percentile.
+
+    axis : int or tuple of int, optional
+
+        axis of ``values`` along which to compute the quantiles. The
+        quantiles replace this axis in the result. All cells are sorted and
+        interpolated together in a single vectorized pass. If a tuple, the
+        distribution pools all members of these axes and the quantiles
+        replace the first of them. ``sample_weight`` is then either 1-D
+        (weights along the first axis) or has one axis per pooled axis,
+        with length 1 where the weights do not vary. Members that share a
+        weight split it equally, so e.g. each model keeps its total weight
+        regardless of its number of samples (counting only non-NaN samples
+        of each cell if ``skipna``).
+
+    algorithm : str, optional
+
+        ``'sort'`` (default) sorts the values along ``axis``. ``'select'``
+        partitions all cells at once with :py:func:`numpy.argpartition`
+        around a band of ranks near each quantile and sorts only the bands,
+        which is O(n) rather than O(n log n) per cell. It returns the same
+        interpolated values (up to floating point rounding of the cumulative
+        weights). Cells with NaNs, or whose weights are too uneven for the
+        bands to bracket a quantile, are sorted instead. It pays off for long
+        distributions (many thousands of samples) over few cells when only a
+        few quantiles are needed; over many cells, numpy's vectorized sort
+        is about as fast. ``values_sorted`` is ignored by ``'select'``.
+
+    skipna : bool, optional
+
+        if True, NaN members are dropped from each cell and the weights of
+        the remaining members are renormalized, all within the vectorized
+        kernel. Cells without any valid member return NaN. If
+        ``values_sorted`` is True, NaNs must come last. Default False.
+
+    engine : str, optional
+
+        ``'numpy'``, ``'numba'`` or ``'auto'``. The ``'numba'`` engine runs
+        the weighted ``'sort'`` algorithm in a compiled kernel, in parallel
+        over cells. If not provided, uses the global option set with
+        :py:class:`~impactlab_tools.utils.engines.set_options` (``'numpy'``
+        by default). See :py:mod:`impactlab_tools.utils.engines`.
+
+    Returns
+    -------
+
+    numpy.array
+
+        computed quantiles from weighted distribution
+
+    """
+    if algorithm not in ('sort', 'select'):
+        raise ValueError(
+            f'algorithm should be "sort" or "select", got "{algorithm}"')
+
+    engine = engines.get_engine(engine)
+
+    if isinstance(axis, (tuple, list)):
+
+        stacked, sample_weight = _stack_axes(
+            values, sample_weight, axis, skipna)
+
+        result = weighted_quantile(
+            stacked,
+            quantiles,
+            sample_weight,
+            values_sorted=values_sorted,
+            old_style=old_style,
+            axis=-1,
+            algorithm=algorithm,
+            skipna=skipna,
+            engine=engine)
+
+        if np.ndim(quantiles) == 0:
+            return result
+
+        return np.moveaxis(result, -1, min(a % values.ndim for a in axis))
+
+    if (engine == 'numba' and algorithm == 'sort'
+            and sample_weight is not None):
+
+        _check_quantiles(quantiles)
+        axis = -1 if axis is None else axis
+
+        result = engines.weighted_quantile_numba(
+            values,
+            quantiles,
+            sample_weight,
+            values_sorted,
+            old_style,
+            axis,
+            skipna)
+
+        if np.ndim(quantiles) == 0:
+            return result[..., 0]
+
+        return np.moveaxis(result, -1, axis % np.ndim(values))
+
+    if algorithm == 'select' and sample_weight is not None:
+
+        return _weighted_quantile_select(
+            values,
+            quantiles,
+            sample_weight,
+            old_style,
+            -1 if axis is None else axis,
+            skipna)
+
+    if (len(values.shape) > 1 and axis is not None) or skipna:
+
+        return _weighted_quantile_nd(
+            values,
+            quantiles,
+            sample_weight,
+            values_sorted,
+            old_style,
+            -1 if axis is None else axis,
+            skipna)
+
+    else:
+
+        return weighted_quantile_1d(
+            values,
+            quantiles,
+            sample_weight,
+            values_sorted,
+            old_style)
+
+
+def weighted_quantile_1d(
+        values,
+        quantiles,
+        sample_weight=None,
+        values_sorted=False,
+        old_style=False):
+    """
+    Very close to numpy.percentile, but supports weights
+
+    Thanks to Alleo!
+    http://stackoverflow.com/questions/21844024/weighted-percentile-using-numpy/29677616#29677616
+
+    .. NOTE ::
+
+        quantiles should be in [0, 1]!
+
+    Parameters
+    ----------
+
+    values : numpy.array
+
+        numpy.array with data
+
+    quantiles : array-like
+
+        quantiles of distribution to return
+
+    sample_weight : numpy.array
+
+        weights array-like of the same length as `array`
+
+    values_sorted : bool
+
+        if True, then will avoid sorting of initial array
+
+    old_style : bool
+
+        if True, will correct output to be consistent with numpy.percentile.
+
+    Returns
+    -------
+
+    numpy.array
+
+        computed quantiles from weighted distribution
+
+    """
+    values = np.array(values)
+    quantiles = np.array(quantiles)
+
+    if sample_weight is None:
+        return np.percentile(values, quantiles)
+
+    sample_weight = np.array(sample_weight)
+
+    _check_quantiles(quantiles)
+
+    if not values_sorted:
+
+        sorter = np.argsort(values)
+        values = values[sorter]
+        sample_weight = sample_weight[sorter]
+
+    # Find the cumsum, and locate the center of each weight's mass
+    # e.g. [0.25, 0.25, 0.5, 0] --> [0.125, 0.375, 0.75, 1]
+    weighted_quantiles = np.cumsum(sample_weight) - 0.5 * sample_weight
+
+    if old_style:
+
+        # To be convenient with np.percentile
+        # e.g. [0, 0.25, 0.25, 0.5, 0] --> [ 0, 0.2857, 0.7143, 1]
+        weighted_quantiles -= weighted_quantiles[0]
+        weighted_quantiles /= weighted_quantiles[-1]
+
+    else:
+
+        weighted_quantiles /= np.sum(sample_weight)
+
+    result = np.interp(quantiles, weighted_quantiles, values)
+
+    return result
+
+
+class WeightedDistribution:
+    """
+    Weighted distribution of an N-D array along one axis
+
+    The values are sorted and the normalized cumulative weights are computed
+    once, when the distribution is created. Quantiles, CDF values and
+    moments are then answered from this cached state without sorting again.
+
+    Parameters
+    ----------
+
+    values : numpy.array
+
+        numpy.array with data
+
+    sample_weight : array-like, optional
+
+        weights array-like of the same length as ``values`` along ``axis``.
+        If not provided, all values are weighted equally.
+
+    axis : int, optional
+
+        axis of ``values`` holding the distribution (default: last axis)
+
+    values_sorted : bool, optional
+
+        if True, then will avoid sorting of initial array
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> dist = WeightedDistribution(
+        ...     np.array([[1., 3., 2., 4.], [4., 2., 3., 1.]]),
+        ...     [0.25, 0.5, 0, 0.25])
+        ...
+        >>> dist.quantile([0.5])
+        array([[3.],
+               [2.]])
+
+        >>> dist.cdf([3.])
+        array([[0.5 ],
+               [0.75]])
+
+        >>> dist.mean()
+        array([2.75, 2.25])
+
+    """
+
+    def __init__(self, values, sample_weight=None, axis=-1,
+                 values_sorted=False):
+
+        values = np.asarray(values)
+        self.axis = axis % values.ndim
+
+        values = np.moveaxis(values, self.axis, -1)
+
+        if sample_weight is None:
+            sample_weight = np.ones(values.shape[-1])
+
+        self.sorted_values, self.sorted_weights = _sort_along_last_axis(
+            values, sample_weight, values_sorted)
+
+        self.cum_weights = _cumulative_weight_centers(self.sorted_weights)
+
+    @property
+    def shape(self):
+        """Shape of the distribution's cells (``values`` without ``axis``)"""
+        return self.sorted_values.shape[:-1]
+
+    def add(self, values, sample_weight=None, values_sorted=False):
+        """
+        Merge new members into the distribution
+
+        Only the new members are sorted. They are then inserted into the
+        cached sorted state with a sorted-merge, located by a binary search
+        in every cell, so refreshing the distribution does not sort the
+        existing members again.
+
+        Parameters
+        ----------
+
+        values : numpy.array
+
+            new members, with the distribution's cells along the other axes
+            and the new members along ``axis``
+
+        sample_weight : array-like, optional
+
+            weights of the new members along ``axis``. If not provided, the
+            new members have weight 1.
+
+        values_sorted : bool, optional
+
+            if True, then will avoid sorting of the new members
+
+        Returns
+        -------
+
+        WeightedDistribution
+
+            the updated distribution (``self``)
+        """
+        values = np.moveaxis(np.asarray(values), self.axis, -1)
+
+        if values.shape[:-1] != self.shape:
+            raise ValueError(
+                f'cells of values {values.shape[:-1]} do not match the '
+                f'distribution {self.shape}')
+
+        if sample_weight is None:
+            sample_weight = np.ones(values.shape[-1])
+
+        new_values, new_weights = _sort_along_last_axis(
+            values, sample_weight, values_sorted)
+
+        self.sorted_values, self.sorted_weights = _merge_sorted(
+            self.sorted_values,
+            np.broadcast_to(self.sorted_weights, self.sorted_values.shape),
+            new_values,
+            np.broadcast_to(new_weights, new_values.shape))
+
+        self.cum_weights = _cumulative_weight_centers(self.sorted_weights)
+
+        return self
+
+    def _restore_axis(self, result, scalar):
+        if scalar:
+            return result[..., 0]
+
+        return np.moveaxis(result, -1, self.axis)
+
+    def quantile(self, quantiles):
+        """
+        Compute quantiles of the weighted distribution
+
+        Matches :py:func:`weighted_quantile` with ``axis``.
+
+        Parameters
+        ----------
+
+        quantiles : array-like
+
+            quantiles of distribution to return. quantiles should be in
+            [0, 1].
+
+        Returns
+        -------
+
+        numpy.array
+
+            quantiles along ``axis``, or with ``axis`` dropped if
+            ``quantiles`` is a scalar
+        """
+        quantiles = np.asarray(quantiles)
+        _check_quantiles(quantiles)
+
+        result = _interp_along_last_axis(
+            np.atleast_1d(quantiles), self.cum_weights, self.sorted_values)
+
+        return self._restore_axis(result, quantiles.ndim == 0)
+
+    def cdf(self, x):
+        """
+        Weighted cumulative probability of the values ``x``
+
+        The inverse of :py:meth:`quantile`: the cumulative weight centers
+        are interpolated linearly between the sorted values. Values below
+        the smallest member have probability 0 and values above the largest
+        member have probability 1.
+
+        Parameters
+        ----------
+
+        x : array-like
+
+            thresholds at which to evaluate the CDF
+
+        Returns
+        -------
+
+        numpy.array
+
+            probabilities along ``axis``, or with ``axis`` dropped if ``x``
+            is a scalar
+        """
+        x = np.asarray(x)
+
+        result = _interp_along_last_axis(
+            np.atleast_1d(x), self.sorted_values, self.cum_weights,
+            left=0., right=1.)
+
+        return self._restore_axis(result, x.ndim == 0)
+
+    def mean(self):
+        """Weighted mean of the distribution"""
+        return (
+            np.sum(self.sorted_values * self.sorted_weights, axis=-1) /
+            np.sum(self.sorted_weights, axis=-1))
+
+    def var(self):
+        """Weighted (population) variance of the distribution"""
+        anomaly = self.sorted_values - self.mean()[..., np.newaxis]
+        return (
+            np.sum(anomaly ** 2 * self.sorted_weights, axis=-1) /
+            np.sum(self.sorted_weights, axis=-1))
+
+    def std(self):
+        """Weighted (population) standard deviation of the distribution"""
+        return np.sqrt(self.var())
+
+
+class WeightedDistributionXr:
+    """
+    Weighted distribution of an xarray object along a named dimension
+
+    :py:class:`xarray.DataArray` wrapper around
+    :py:class:`WeightedDistribution`. Results are returned as DataArrays
+    laid out like those of :py:func:`weighted_quantile_xr`. The data are
+    loaded into memory when the distribution is created.
+
+    Parameters
+    ----------
+
+    data : DataArray
+
+        :py:class:`xarray.DataArray` with data indexed by ``dim``
+
+    sample_weight : array-like
+
+        weights of the same length as ``dim``. A :py:class:`pandas.Series`
+        or :py:class:`xarray.DataArray` is aligned with ``data`` along
+        ``dim``.
+
+    dim : str
+
+        Dimension along which to weight the data
+
+    values_sorted : bool, optional
+
+        if True, then will avoid sorting of initial array
+
+    """
+
+    def __init__(self, data, sample_weight, dim, values_sorted=False):
+
+        self.dim = dim
+        self.dims = tuple(d for d in data.dims if d != dim)
+        self.coords = {d: data.coords[d] for d in self.dims if d in data.coords}
+        self.axis = data.get_axis_num(dim)
+        self.members = (
+            list(data.coords[dim].values) if dim in data.coords else None)
+
+        self.distribution = WeightedDistribution(
+            data.values,
+            _align_weights(sample_weight, data, dim),
+            axis=self.axis,
+            values_sorted=values_sorted)
+
+    def add(self, data, sample_weight, values_sorted=False):
+        """
+        Merge new members along ``dim`` into the distribution
+
+        See :py:meth:`WeightedDistribution.add`. Only the new members are
+        sorted and loaded into memory.
+
+        Parameters
+        ----------
+
+        data : DataArray
+
+            new members along ``dim``, with the distribution's other
+            dimensions
+
+        sample_weight : array-like
+
+            weights of the new members, aligned with ``data`` along ``dim``
+            like the weights of the distribution
+
+        values_sorted : bool, optional
+
+            if True, then will avoid sorting of the new members
+
+        Returns
+        -------
+
+        WeightedDistributionXr
+
+            the updated distribution (``self``)
+        """
+        if self.members is not None:
+            duplicates = set(self.members) & set(data.coords[self.dim].values)
+            if duplicates:
+                raise ValueError(
+                    f'Members {sorted(duplicates)} are already in the '
+                    'distribution')
+
+        # members of the new data must merge into the cells with the same
+        # labels, whatever the order of the other dimensions
+        for d, coord in self.coords.items():
+            if d not in data.indexes:
+                continue
+
+            positions = data.indexes[d].get_indexer(coord.to_index())
+            if len(positions) != data.sizes[d] or (positions < 0).any():
+                raise ValueError(
+                    f'The labels of "{d}" do not match those of the '
+                    'distribution')
+
+            data = data.isel({d: positions})
+
+        order = list(self.dims)
+        order.insert(self.axis, self.dim)
+        data = data.transpose(*order)
+
+        self.distribution.add(
+            data.values,
+            _align_weights(sample_weight, data, self.dim),
+            values_sorted=values_sorted)
+
+        if self.members is not None:
+            self.members.extend(data.coords[self.dim].values)
+
+        return self
+
+    def _wrap(self, result, new_dim=None, labels=None):
+        dims = list(self.dims)
+        coords = dict(self.coords)
+
+        if new_dim is not None:
+            dims.insert(self.axis, new_dim)
+            coords[new_dim] = labels
+
+        return xr.DataArray(result, dims=dims, coords=coords)
+
+    def quantile(self, quantiles):
+        """
+        Compute quantiles along a new dimension ``quantile``
+
+        Equivalent to :py:func:`weighted_quantile_xr`.
+        """
+        return self._wrap(
+            self.distribution.quantile(np.atleast_1d(quantiles)),
+            'quantile', np.atleast_1d(quantiles))
+
+    def cdf(self, x):
+        """
+        Weighted cumulative probability along a new dimension ``threshold``
+
+        See :py:meth:`WeightedDistribution.cdf`.
+        """
+        return self._wrap(
+            self.distribution.cdf(np.atleast_1d(x)),
+            'threshold', np.atleast_1d(x))
+
+    def mean(self):
+        """Weighted mean with ``dim`` dropped"""
+        return self._wrap(self.distribution.mean())
+
+    def var(self):
+        """Weighted (population) variance with ``dim`` dropped"""
+        return self._wrap(self.distribution.var())
+
+    def std(self):
+        """Weighted (population) standard deviation with ``dim`` dropped"""
+        return self._wrap(self.distribution.std())
+
+
+class WeightedQuantileSketch:
+    """
+    Mergeable, bounded-memory summary of weighted distributions
+
+    Keeps, for every cell of an N-D array, a hierarchy of compactors in the
+    manner of KLL sketches (Karnin, Lang & Liberty, 2016). Members can be
+    added in any number of :py:meth:`update` calls (e.g. one per model or
+    per Monte-Carlo batch file), and sketches built in separate processes
+    can be combined with :py:meth:`merge`, so memory does not grow with the
+    ensemble size. Sketches are plain numpy objects and can be pickled.
+
+    New members enter the lowest level. When a level holds more items than
+    its capacity, its items are sorted and paired with their neighbours;
+    one item of each pair, drawn with probability proportional to its
+    weight, moves up a level carrying the weight of both. The top level
+    holds up to ``size`` items and each level below holds 2/3 as many (at
+    least 2), so a sketch keeps fewer than ``3 * size`` items per cell plus
+    two per level, and the number of levels grows with the logarithm of
+    the ensemble size.
+
+    Notes
+    -----
+
+    A compaction leaves the weighted CDF unbiased at every value, and
+    changes it by at most the weight of one pair. The sketch sums, for every
+    cell, the squared weight of the heaviest pair of each compaction, and
+    :py:attr:`rank_error` turns it into a bound on ``|F_sketch(x) - F(x)|``,
+    as a fraction of the total weight, that holds at any given ``x`` with
+    probability ``1 - 1e-6`` (Hoeffding's inequality). Because the capacities shrink
+    geometrically below the top level, the bound is of order ``1 / size``
+    whatever the number of members (about ``7 / size`` for members of
+    similar weight). Quantiles returned by :py:meth:`quantile` lie within
+    ``rank_error`` of the requested quantile with the same probability.
+    Until a level is compacted the sketch is exact and the result equals
+    :py:func:`weighted_quantile`.
+
+    Parameters
+    ----------
+
+    size : int, optional
+
+        capacity of the top level (default 200)
+
+    seed : int or numpy.random.Generator, optional
+
+        seed of the compactions, for reproducible sketches
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> weights = _get_weights(project='gcp', rcp='rcp85')
+        >>> rng = np.random.default_rng(0)
+        >>> sketch = WeightedQuantileSketch(size=20, seed=0)
+        >>> for model in weights.model.values:
+        ...     draws = rng.normal(size=(3, 4, 10))  # (region, year, batch)
+        ...     _ = sketch.update(
+        ...         draws, float(weights.sel(model=model)), axis=-1)
+        ...
+        >>> sketch.quantile([0.05, 0.5, 0.95]).shape
+        (3, 4, 3)
+
+        >>> sketch.values.shape[-1] < 3 * sketch.size + 2 * len(sketch.levels)
+        True
+
+    """
+
+    def __init__(self, size=200, seed=None):
+        self.size = size
+        self.levels = []
+        self._spread = None
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def shape(self):
+        """Shape of the summarized cells"""
+        return self.levels[0][0].shape[:-1] if self.levels else None
+
+    @property
+    def values(self):
+        """Items kept for every cell, along the last axis"""
+        if not self.levels:
+            return None
+        return np.concatenate([values for values, _ in self.levels], axis=-1)
+
+    @property
+    def weights(self):
+        """Weights of :py:attr:`values`"""
+        if not self.levels:
+            return None
+        return np.concatenate(
+            [weights for _, weights in self.levels], axis=-1)
+
+    @property
+    def total_weight(self):
+        """Total weight added to each cell"""
+        return np.sum(self.weights, axis=-1)
+
+    @property
+    def rank_error(self):
+        """
+        Bound on the CDF error, as a fraction of the total weight, that
+        holds with probability ``1 - 1e-6`` at any given value
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(
+                self._spread * np.log(2 / _SKETCH_FAILURE_PROBABILITY) / 2
+                ) / self.total_weight
+
+    def update(self, values, sample_weight=None, axis=None):
+        """
+        Add members to the sketch
+
+        Parameters
+        ----------
+
+        values : numpy.array
+
+            new data. If ``axis`` is None, ``values`` is a single member
+            with the shape of the sketch's cells. Otherwise members are
+            stacked along ``axis``.
+
+        sample_weight : float or array-like, optional
+
+            weight of the member (if ``axis`` is None) or weights of the
+            same length as ``values`` along ``axis``. Default 1 per member.
+
+        axis : int, optional
+
+            axis of ``values`` holding the members
+
+        Returns
+        -------
+
+        self : WeightedQuantileSketch
+        """
+        values = np.asarray(values, dtype='float64')
+
+        if axis is None:
+            values = values[..., np.newaxis]
+        else:
+            values = np.moveaxis(values, axis, -1)
+
+        if sample_weight is None:
+            sample_weight = 1.
+
+        weights = np.broadcast_to(
+            np.asarray(sample_weight, dtype='float64'), values.shape)
+
+        return self._add([(values, weights)], np.zeros(values.shape[:-1]))
+
+    def merge(self, other):
+        """
+        Merge another sketch of the same shape into this one
+
+        Returns
+        -------
+
+        self : WeightedQuantileSketch
+        """
+        if not other.levels:
+            return self
+
+        return self._add(other.levels, other._spread)
+
+    def quantile(self, quantiles):
+        """
+        Compute approximate quantiles of the summarized distributions
+
+        Parameters
+        ----------
+
+        quantiles : array-like
+
+            quantiles of distribution to return. quantiles should be in
+            [0, 1].
+
+        Returns
+        -------
+
+        numpy.array
+
+            quantiles along a new last axis, or with no new axis if
+            ``quantiles`` is a scalar
+        """
+        return WeightedDistribution(self.values, self.weights).quantile(
+            quantiles)
+
+    def _add(self, levels, spread):
+
+        if self.levels and levels[0][0].shape[:-1] != self.shape:
+            raise ValueError(
+                f'Cannot add data of shape {levels[0][0].shape[:-1]} to a '
+                f'sketch of shape {self.shape}')
+
+        if not self.levels:
+            self._spread = np.zeros(levels[0][0].shape[:-1])
+
+        # items of the same level carry comparable weights
+        for level, (values, weights) in enumerate(levels):
+            if level == len(self.levels):
+                self.levels.append((np.array(values), np.array(weights)))
+            else:
+                held_values, held_weights = self.levels[level]
+                self.levels[level] = (
+                    np.concatenate([held_values, values], axis=-1),
+                    np.concatenate([held_weights, weights], axis=-1))
+
+        self._spread = self._spread + spread
+        self._compress()
+
+        return self
+
+    def _capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, int(np.ceil(self.size * (2 / 3) ** depth)))
+
+    def _compress(self):
+
+        level = 0
+        while level < len(self.levels):
+            if self.levels[level][0].shape[-1] <= self._capacity(level):
+                level += 1
+                continue
+
+            if level == len(self.levels) - 1:
+                values, weights = self.levels[level]
+                self.levels.append((values[..., :0], weights[..., :0]))
+
+            self._compact(level)
+
+            # a new top level shrinks the capacities below it
+            level = 0
+
+    def _compact(self, level):
+
+        values, weights = _sort_along_last_axis(*self.levels[level])
+
+        # pair neighbours, leaving the largest item of an odd count behind
+        paired = values.shape[-1] - values.shape[-1] % 2
+        pairs = values.shape[:-1] + (paired // 2, 2)
+        pair_values = values[..., :paired].reshape(pairs)
+        pair_weights = weights[..., :paired].reshape(pairs)
+
+        # keeping the first item with probability w1 / (w1 + w2) leaves the
+        # expected CDF unchanged between the two, and errs by at most
+        # w1 + w2 at any value
+        total = np.sum(pair_weights, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            first = np.where(total > 0, pair_weights[..., 0] / total, 1.)
+
+        kept = np.where(
+            self._rng.random(first.shape) < first,
+            pair_values[..., 0],
+            pair_values[..., 1])
+
+        self._spread = self._spread + np.max(total, axis=-1) ** 2
+
+        held_values, held_weights = self.levels[level + 1]
+        self.levels[level] = (values[..., paired:], weights[..., paired:])
+        self.levels[level + 1] = (
+            np.concatenate([held_values, kept], axis=-1),
+            np.concatenate([held_weights, total], axis=-1))
+
+
+# Vectorized N-D kernels
+#
+# These operate on the last axis of an array so that every cell along the
+# remaining axes is sorted, accumulated and interpolated at once. They
+# reproduce :py:func:`weighted_quantile_1d` (including the interpolation rules
+# of :py:func:`numpy.interp`) without any per-cell Python calls.
+
+def _check_quantiles(quantiles):
+    quantiles = np.asarray(quantiles)
+    if not np.all((quantiles >= 0) & (quantiles <= 1)):
+        raise ValueError('quantiles should be in [0, 1]')
+
+
+def _weighted_quantile_nd(
+        values,
+        quantiles,
+        sample_weight=None,
+        values_sorted=False,
+        old_style=False,
+        axis=-1,
+        skipna=False):
+
+    values = np.asarray(values)
+    quantiles = np.asarray(quantiles)
+    axis = axis % values.ndim
+
+    if sample_weight is None:
+        percentile = np.nanpercentile if skipna else np.percentile
+        result = percentile(values, np.atleast_1d(quantiles), axis=axis)
+        result = np.moveaxis(result, 0, -1)
+
+    else:
+        _check_quantiles(quantiles)
+
+        sorted_values, sorted_weights, valid = _sort_members(
+            values, sample_weight, axis, skipna, values_sorted)
+
+        cum_weights = _cumulative_weight_centers(
+            sorted_weights, old_style, valid=valid)
+
+        result = _interp_along_last_axis(
+            np.atleast_1d(quantiles), cum_weights, sorted_values, valid=valid)
+
+    if quantiles.ndim == 0:
+        return result[..., 0]
+
+    return np.moveaxis(result, -1, axis)
+
+
+def _stack_axes(values, sample_weight, axes, skipna=False):
+    """
+    Pool several axes of ``values`` into one last axis
+
+    Returns the reshaped values and weights matching the pooled axis. Weights
+    shared by several members (length-1 weight axes) are divided by the
+    number of members sharing them.
+    """
+    values = np.asarray(values)
+    axes = [a % values.ndim for a in axes]
+
+    moved = np.moveaxis(values, axes, range(-len(axes), 0))
+
+    if sample_weight is not None:
+        sample_weight = _pool_weights(moved, sample_weight, len(axes), skipna)
+
+    return moved.reshape(moved.shape[:-len(axes)] + (-1, )), sample_weight
+
+
+def _pool_weights(moved, sample_weight, naxes, skipna=False):
+    """
+    Expand weights over the last ``naxes`` axes of ``moved`` to one axis
+    """
+    shape = moved.shape[-naxes:]
+    weights = np.asarray(sample_weight, dtype='float64')
+
+    if weights.ndim == 1:
+        weights = weights.reshape((-1, ) + (1, ) * (naxes - 1))
+
+    if weights.ndim != naxes:
+        raise ValueError(
+            f'sample_weight of shape {weights.shape} does not match the '
+            f'{naxes} pooled axes')
+
+    shared = tuple(
+        i - naxes for i in range(naxes)
+        if weights.shape[i] == 1 and shape[i] > 1)
+
+    if shared and skipna:
+        count = np.sum(~np.isnan(moved), axis=shared, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weights = np.where(count > 0, weights / count, 0.)
+
+        return np.broadcast_to(weights, moved.shape).reshape(
+            moved.shape[:-naxes] + (-1, ))
+
+    if shared:
+        weights = weights / np.prod(
+            [shape[i] for i in shared], dtype='float64')
+
+    return np.broadcast_to(weights, shape).reshape(-1)
+
+
+def _sort_members(
+        values, sample_weight, axis=-1, skipna=False, values_sorted=False):
+    """
+    Move (or pool) the distribution axes of ``values`` to the end and sort
+    the members along it, carrying ``sample_weight`` with them
+
+    Returns ``(sorted_values, sorted_weights, valid)``. If ``skipna``, NaN
+    members get no weight and sort to the end of each cell, and ``valid``
+    marks the other members. Otherwise ``valid`` is None.
+    """
+    values = np.asarray(values)
+
+    if isinstance(axis, (tuple, list)):
+        values, sample_weight = _stack_axes(
+            values, sample_weight, axis, skipna)
+    else:
+        values = np.moveaxis(values, axis, -1)
+
+    if skipna:
+        sample_weight = np.where(np.isnan(values), 0., sample_weight)
+
+    sorted_values, sorted_weights = _sort_along_last_axis(
+        values, sample_weight, values_sorted)
+
+    valid = ~np.isnan(sorted_values) if skipna else None
+
+    return sorted_values, sorted_weights, valid
+
+
+def _sort_along_last_axis(values, sample_weight, values_sorted=False):
+    """
+    Sort ``values`` along the last axis and carry ``sample_weight`` with them
+
+    ``sample_weight`` may be 1-D (one weight per position along the last
+    axis) or broadcastable to ``values``.
+    """
+    if values_sorted:
+        return values, _sort_weights(sample_weight, None, values.shape)
+
+    sorter = np.argsort(values, axis=-1)
+    sorted_values = np.take_along_axis(values, sorter, axis=-1)
+
+    return sorted_values, _sort_weights(sample_weight, sorter, values.shape)
+
+
+def _sort_weights(sample_weight, sorter, shape):
+    """
+    Reorder weights with an argsort permutation of values of ``shape``
+    """
+    sample_weight = np.asarray(sample_weight, dtype='float64')
+
+    if sorter is None:
+        return np.broadcast_to(sample_weight, shape)
+
+    if sample_weight.ndim == 1:
+        return sample_weight[sorter]
+
+    return np.take_along_axis(
+        np.broadcast_to(sample_weight, shape), sorter, axis=-1)
+
+
+def _weighted_quantile_multi(
+        values,
+        quantiles,
+        sample_weights,
+        values_sorted=False,
+        old_style=False,
+        axis=-1,
+        algorithm='sort',
+        skipna=False,
+        engine=None):
+    """
+    Weighted quantiles for several weight sets sharing one sort
+
+    ``sample_weights`` is a sequence of weights, each as accepted by
+    :py:func:`weighted_quantile`. Returns an array with new axes
+    ``(weighting, quantile)`` appended after the remaining axes of
+    ``values``.
+    """
+    _check_quantiles(quantiles)
+    quantiles = np.atleast_1d(quantiles)
+    values = np.asarray(values)
+
+    axes = axis if isinstance(axis, (tuple, list)) else (axis, )
+    axes = [a % values.ndim for a in axes]
+
+    if algorithm == 'select' or engines.get_engine(engine) == 'numba':
+        # selection does not sort, and compiled kernels keep their sorted
+        # copies in per-thread scratch space, so there is nothing to share
+        return np.stack([
+            np.moveaxis(
+                weighted_quantile(
+                    values, quantiles, weights, values_sorted=values_sorted,
+                    old_style=old_style, axis=axis, algorithm=algorithm,
+                    skipna=skipna, engine=engine),
+                min(axes), -1)
+            for weights in sample_weights], axis=-2)
+
+    # move (and pool) the distribution axes to the end once
+    moved = np.moveaxis(values, axes, range(-len(axes), 0))
+
+    if len(axes) > 1:
+        sample_weights = [
+            _pool_weights(moved, weights, len(axes), skipna)
+            for weights in sample_weights]
+        moved = moved.reshape(moved.shape[:-len(axes)] + (-1, ))
+
+    # the sort is shared; each weight set only needs its own cumsum
+    if values_sorted:
+        sorter = None
+        sorted_values = moved
+    else:
+        sorter = np.argsort(moved, axis=-1)
+        sorted_values = np.take_along_axis(moved, sorter, axis=-1)
+
+    valid = ~np.isnan(sorted_values) if skipna else None
+
+    result = np.empty(
+        moved.shape[:-1] + (len(sample_weights), len(quantiles)),
+        dtype='float64')
+
+    for i, weights in enumerate(sample_weights):
+        sorted_weights = _sort_weights(weights, sorter, moved.shape)
+
+        if skipna:
+            sorted_weights = np.where(valid, sorted_weights, 0.)
+
+        cum_weights = _cumulative_weight_centers(
+            sorted_weights, old_style, valid=valid)
+
+        result[..., i, :] = _interp_along_last_axis(
+            quantiles, cum_weights, sorted_values, valid=valid)
+
+    return result
+
+
+def _weighted_summary(
+        values,
+        quantiles,
+        sample_weight,
+        moments,
+        axis=-1,
+        skipna=False):
+    """
+    Weighted moments followed by weighted quantiles along a new last axis,
+    all computed from a single sorted copy of ``values``
+    """
+    sorted_values, sorted_weights, valid = _sort_members(
+        values, sample_weight, axis, skipna)
+
+    filled = sorted_values
+    if skipna:
+        filled = np.where(valid, sorted_values, 0.)
+
+    total = np.sum(sorted_weights, axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(filled * sorted_weights, axis=-1) / total
+        anomaly = filled - mean[..., np.newaxis]
+        var = np.sum(anomaly ** 2 * sorted_weights, axis=-1) / total
+
+        stats = {
+            'mean': lambda: mean,
+            'var': lambda: var,
+            'std': lambda: np.sqrt(var),
+            'skew': lambda: (
+                np.sum(anomaly ** 3 * sorted_weights, axis=-1) / total /
+                var ** 1.5),
+            # without skipna, NaNs sort last and make every statistic NaN
+            'min': lambda: (
+                sorted_values[..., 0] if skipna else np.where(
+                    np.isnan(sorted_values[..., -1]), np.nan,
+                    sorted_values[..., 0])),
+            'max': lambda: (
+                _take_last(sorted_values, _last_valid_index(valid))[..., 0]
+                if skipna else sorted_values[..., -1]),
+        }
+
+        result = [stats[moment]() for moment in moments]
+
+    cum_weights = _cumulative_weight_centers(sorted_weights, valid=valid)
+
+    quantile_values = _interp_along_last_axis(
+        np.atleast_1d(quantiles), cum_weights, sorted_values, valid=valid)
+
+    return np.concatenate(
+        [np.stack(result, axis=-1).reshape(mean.shape + (len(result), )),
+         quantile_values], axis=-1)
+
+
+def _weighted_cdf(
+        values,
+        thresholds,
+        order=None,
+        valid_count=None,
+        sample_weight=None,
+        axis=-1,
+        skipna=False,
+        exceedance=False,
+        ranked=False):
+    """
+    Weighted CDF of ``thresholds``, which broadcast against the cells of
+    ``values`` (``values`` without ``axis``)
+
+    If ``ranked``, ``values`` are gathered in the order of the stored
+    argsort permutation ``order`` instead of being sorted, and
+    ``valid_count`` holds the number of non-NaN members of each cell.
+    """
+    values = np.asarray(values)
+    thresholds = np.asarray(thresholds, dtype='float64')
+
+    if ranked:
+        order = np.asarray(order, dtype='intp')
+        sorted_values = np.take_along_axis(values, order, axis=-1)
+        sorted_weights = _sort_weights(sample_weight, order, values.shape)
+
+        valid = None
+        if skipna:
+            valid = np.arange(values.shape[-1]) < np.asarray(
+                valid_count)[..., np.newaxis]
+            sorted_weights = np.where(valid, sorted_weights, 0.)
+
+    else:
+        sorted_values, sorted_weights, valid = _sort_members(
+            values, sample_weight, axis, skipna)
+
+    cum_weights = _cumulative_weight_centers(sorted_weights, valid=valid)
+
+    # thresholds may have leading dimensions the values lack, which
+    # apply_ufunc does not add to the values
+    shape = np.broadcast_shapes(
+        thresholds.shape, sorted_values.shape[:-1]) + sorted_values.shape[-1:]
+    sorted_values, cum_weights = (
+        np.broadcast_to(sorted_values, shape),
+        np.broadcast_to(cum_weights, shape))
+    if valid is not None:
+        valid = np.broadcast_to(valid, shape)
+
+    probability = _interp_along_last_axis(
+        thresholds[..., np.newaxis], sorted_values, cum_weights,
+        left=0., right=1., valid=valid)[..., 0]
+
+    if exceedance:
+        probability = 1. - probability
+
+    return np.where(np.isnan(thresholds), np.nan, probability)
+
+
+def _weighted_quantile_ranked(
+        values,
+        order,
+        valid_count,
+        quantiles,
+        sample_weight=None,
+        sample_weights=None,
+        old_style=False,
+        skipna=False):
+    """
+    Weighted quantiles along the last axis of ``values`` using a stored
+    argsort permutation ``order`` instead of sorting
+
+    With ``sample_weights``, returns new axes ``(weighting, quantile)`` as
+    :py:func:`_weighted_quantile_multi` does.
+    """
+    _check_quantiles(quantiles)
+    quantiles = np.asarray(quantiles)
+    values = np.asarray(values)
+    order = np.asarray(order, dtype='intp')
+
+    valid = None
+    if skipna:
+        valid = np.arange(values.shape[-1]) < np.asarray(
+            valid_count)[..., np.newaxis]
+
+    multi = sample_weights is not None
+    if not multi:
+        sample_weights = [
+            np.ones(values.shape[-1]) if sample_weight is None
+            else sample_weight]
+
+    result = []
+    for weights in sample_weights:
+        sorted_weights = _sort_weights(weights, order, values.shape)
+
+        if skipna:
+            sorted_weights = np.where(valid, sorted_weights, 0.)
+
+        cum_weights = _cumulative_weight_centers(
+            sorted_weights, old_style, valid=valid)
+
+        result.append(_interp_along_last_axis(
+            np.atleast_1d(quantiles), cum_weights, values, valid=valid,
+            fp_order=order))
+
+    if multi:
+        return np.stack(result, axis=-2)
+
+    if quantiles.ndim == 0:
+        return result[0][..., 0]
+
+    return result[0]
+
+
+def _searchsorted_along_last_axis(sorted_values, x):
+    """
+    Row-wise :py:func:`numpy.searchsorted` (``side='right'``) of ``x`` in
+    ``sorted_values``, both sorted along the last axis with NaNs last
+    """
+    n = sorted_values.shape[-1]
+    lo = np.zeros(x.shape, dtype='intp')
+    hi = np.full(x.shape, n, dtype='intp')
+
+    # binary search on all cells at once: ceil(log2(n + 1)) steps
+    for _ in range(int(n).bit_length()):
+        mid = (lo + hi) // 2
+        pivot = np.take_along_axis(
+            sorted_values, np.minimum(mid, n - 1), axis=-1)
+
+        right = (pivot <= x) | np.isnan(x)
+        active = lo < hi
+
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+
+    return lo
+
+
+def _merge_sorted(values, weights, new_values, new_weights):
+    """
+    Merge new sorted members (and their weights) into sorted members along
+    the last axis. New members go after existing members equal to them.
+    """
+    n = values.shape[-1]
+    k = new_values.shape[-1]
+
+    # final position of each new member
+    dest = _searchsorted_along_last_axis(values, new_values) + np.arange(k)
+
+    is_new = np.zeros(values.shape[:-1] + (n + k, ), dtype=bool)
+    np.put_along_axis(is_new, dest, True, axis=-1)
+
+    merged = []
+    for old, new in [(values, new_values), (weights, new_weights)]:
+        out = np.empty(
+            values.shape[:-1] + (n + k, ),
+            dtype=np.result_type(old.dtype, new.dtype))
+        np.put_along_axis(out, dest, new, axis=-1)
+        out[~is_new] = old.reshape(-1)
+        merged.append(out)
+
+    return tuple(merged)
+
+
+def _weighted_quantile_bootstrap(
+        values,
+        quantiles,
+        sample_weight,
+        indices,
+        skipna=False,
+        batch_size=None):
+    """
+    Weighted quantiles of resamples of the last axis of ``values``
+
+    ``indices`` holds the members drawn by every resample, one row per
+    resample. Returns new axes ``(resample, quantile)`` appended after the
+    cells of ``values``.
+    """
+    _check_quantiles(quantiles)
+    quantiles = np.atleast_1d(quantiles)
+    values = np.asarray(values)
+
+    n_resamples, n = indices.shape
+    cells = max(int(np.prod(values.shape[:-1])), 1)
+
+    if batch_size is None:
+        batch_size = max(1, _BOOTSTRAP_BATCH_ELEMENTS // (cells * n))
+
+    result = np.empty(
+        values.shape[:-1] + (n_resamples, len(quantiles)), dtype='float64')
+
+    for start in range(0, n_resamples, batch_size):
+        batch = indices[start:start + batch_size]
+
+        # (..., resample, member) values and (resample, member) weights
+        result[..., start:start + len(batch), :] = _weighted_quantile_nd(
+            values[..., batch],
+            quantiles,
+            sample_weight[batch],
+            axis=-1,
+            skipna=skipna)
+
+    return result
+
+
+def _rolling_weighted_quantile(
+        values,
+        quantiles,
+        sample_weight,
+        window,
+        stride=1,
+        skipna=False,
+        batch_size=None):
+    """
+    Weighted quantiles of rolling windows over the second-to-last axis of
+    ``values``, pooling the members along the last axis
+
+    Returns new axes ``(window, quantile)`` appended after the cells.
+    """
+    _check_quantiles(quantiles)
+    quantiles = np.atleast_1d(quantiles)
+    values = np.asarray(values)
+
+    steps, n = values.shape[-2:]
+    cells = max(int(np.prod(values.shape[:-2])), 1)
+
+    # (..., window, member, step) view of every window
+    windows = np.lib.stride_tricks.sliding_window_view(
+        values, window, axis=-2)[..., ::stride, :, :]
+
+    # as when pooling dimensions, each model's weight is split among its
+    # (valid) members in the window
+    weights = np.asarray(sample_weight, dtype='float64')[:, np.newaxis]
+
+    if batch_size is None:
+        batch_size = max(1, _ROLLING_BATCH_ELEMENTS // (cells * n * window))
+
+    nwindows = windows.shape[-3]
+    result = np.empty(
+        values.shape[:-2] + (nwindows, len(quantiles)), dtype='float64')
+
+    for start in range(0, nwindows, batch_size):
+        sorted_values, sorted_weights, valid = _sort_members(
+            windows[..., start:start + batch_size, :, :], weights,
+            axis=(-2, -1), skipna=skipna)
+
+        cum_weights = _cumulative_weight_centers(sorted_weights, valid=valid)
+
+        result[..., start:start + batch_size, :] = _interp_along_last_axis(
+            quantiles, cum_weights, sorted_values, valid=valid)
+
+    return result
+
+
+def _last_valid_index(valid):
+    """Index of the last entry of the leading valid run along the last axis"""
+    return np.count_nonzero(valid, axis=-1)[..., np.newaxis] - 1
+
+
+def _take_last(arr, last):
+    return np.take_along_axis(arr, np.maximum(last, 0), axis=-1)
+
+
+def _cumulative_weight_centers(sorted_weights, old_style=False, valid=None):
+    """
+    Locate the center of each weight's mass along the last axis
+
+    Normalized to [0, 1] per cell as in :py:func:`weighted_quantile_1d`.
+    If given, ``valid`` marks the leading entries of each cell to use (the
+    remaining entries must have zero weight).
+    """
+    weighted_quantiles = (
+        np.cumsum(sorted_weights, axis=-1) - 0.5 * sorted_weights)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if old_style:
+            weighted_quantiles -= weighted_quantiles[..., :1]
+
+            if valid is None:
+                weighted_quantiles /= weighted_quantiles[..., -1:]
+            else:
+                weighted_quantiles /= _take_last(
+                    weighted_quantiles, _last_valid_index(valid))
+
+        else:
+            weighted_quantiles /= np.sum(
+                sorted_weights, axis=-1, keepdims=True)
+
+    return weighted_quantiles
+
+
+def _interp_along_last_axis(
+        x, xp, fp, left=None, right=None, valid=None, fp_order=None):
+    """
+    Row-wise :py:func:`numpy.interp` of scalars ``x`` along the last axis
+
+    ``xp`` must be non-decreasing along the last axis. ``x`` is either 1-D
+    and shared by all cells, or holds its own points for every cell along
+    its last axis and broadcasts against ``xp.shape[:-1]``. Returns an array
+    of shape ``xp.shape[:-1] + (len(x),)`` (broadcast with the cells of
+    ``x``). ``left`` and ``right`` are returned below the first and above
+    the last breakpoint (default ``fp[..., 0]`` and ``fp[..., -1]``).
+
+    If given, ``valid`` marks the leading breakpoints of each cell to
+    interpolate between. Cells without valid breakpoints return NaN.
+
+    If given, ``fp_order`` maps each breakpoint to its position in ``fp``
+    along the last axis, so only the values bracketing ``x`` are gathered
+    from an unsorted ``fp``.
+    """
+    def gather(index):
+        if fp_order is not None:
+            index = np.take_along_axis(fp_order, index, axis=-1)
+        return np.take_along_axis(fp, index, axis=-1)[..., 0]
+
+    x = np.asarray(x)
+    n = xp.shape[-1]
+    result = np.empty(
+        np.broadcast_shapes(xp.shape[:-1], x.shape[:-1]) + (x.shape[-1], ),
+        dtype='float64')
+
+    if valid is None:
+        last_index = n - 1
+        x_last = xp[..., -1]
+        f_last = gather(np.full(xp.shape[:-1] + (1, ), n - 1))
+    else:
+        last_index = _last_valid_index(valid)
+        x_last = _take_last(xp, last_index)[..., 0]
+        f_last = gather(np.maximum(last_index, 0))
+
+    first = left
+    if left is None:
+        first = gather(np.zeros(xp.shape[:-1] + (1, ), dtype='intp'))
+    last = f_last if right is None else right
+
+    for i in range(x.shape[-1]):
+        xi = x[..., i]
+
+        # index of the last breakpoint <= xi, as in numpy.interp
+        below = xp <= xi[..., np.newaxis]
+        if valid is not None:
+            below &= valid
+
+        j = np.count_nonzero(below, axis=-1)[..., np.newaxis] - 1
+        lo = np.clip(j, 0, np.maximum(last_index, 0))
+        hi = np.clip(j + 1, 0, np.maximum(last_index, 0))
+
+        x0 = np.take_along_axis(xp, lo, axis=-1)[..., 0]
+        x1 = np.take_along_axis(xp, hi, axis=-1)[..., 0]
+        f0 = gather(lo)
+        f1 = gather(hi)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = (f1 - f0) / (x1 - x0)
+            res = slope * (xi - x0) + f0
+
+            # numpy.interp retries from the right end on non-finite slopes
+            retry = np.isnan(res)
+            if retry.any():
+                res = np.where(retry, slope * (xi - x1) + f1, res)
+                res = np.where(np.isnan(res) & (f0 == f1), f0, res)
+
+        res = np.where(xi == x0, f0, res)
+
+        j = j[..., 0]
+        res = np.where(j < 0, first, res)
+        if valid is None:
+            res = np.where(j >= n - 1, f_last, res)
+        else:
+            res = np.where(j >= last_index[..., 0], f_last, res)
+            res = np.where(last_index[..., 0] < 0, np.nan, res)
+
+        if right is not None:
+            res = np.where(xi > x_last, last, res)
+
+        result[..., i] = res
+
+    return result
+
+
+# Selection kernels
+#
+# For every quantile, the order statistics in a band of ranks around its
+# unweighted rank are placed with one numpy.argpartition of all cells, and
+# only the band is sorted. The weight below the band locates the weight
+# centers inside it. Cells whose quantile falls outside its band (heavily
+# skewed weights) or that hold NaNs are finished with the sort algorithm.
+
+# distributions at most this long are sorted
+_SELECT_SORT_SIZE = 64
+
+
+def _weighted_quantile_select(
+        values,
+        quantiles,
+        sample_weight,
+        old_style=False,
+        axis=-1,
+        skipna=False):
+
+    values = np.asarray(values)
+    quantiles = np.asarray(quantiles)
+    _check_quantiles(quantiles)
+    axis = axis % values.ndim
+
+    moved = np.moveaxis(values, axis, -1)
+    n = moved.shape[-1]
+    flat = moved.reshape(-1, n)
+    qs = np.atleast_1d(quantiles).ravel()
+
+    sample_weight = np.asarray(sample_weight, dtype='float64')
+    if sample_weight.ndim <= 1:
+        weights = np.broadcast_to(sample_weight, (n, ))
+        spread = np.std(weights) / max(np.mean(weights), 1e-300)
+    else:
+        weights = np.broadcast_to(sample_weight, moved.shape).reshape(-1, n)
+        spread = 1.
+
+    # the weighted rank of a quantile strays from its unweighted rank by a
+    # few sqrt(n), more so for uneven weights
+    margin = int(4 * (1 + spread) * np.sqrt(n)) + 8
+    bands = [
+        (max(int(q * (n - 1)) - margin, 0),
+         min(int(q * (n - 1)) + margin, n - 1)) for q in qs]
+
+    result = np.empty((len(flat), len(qs)), dtype='float64')
+    fallback = np.isnan(flat).any(axis=-1)
+
+    # sorting the bands must be cheaper than sorting everything
+    banded = np.zeros(n, dtype=bool)
+    for k1, k2 in bands:
+        banded[k1:k2 + 1] = True
+
+    if n <= _SELECT_SORT_SIZE or banded.sum() > n / 2:
+        fallback[:] = True
+
+    cells = np.nonzero(~fallback)[0]
+
+    if len(cells):
+        selected = flat[cells]
+
+        if weights.ndim == 1:
+            def gather(index):
+                return weights[index]
+        else:
+            selected_weights = weights[cells]
+
+            def gather(index):
+                return np.take_along_axis(selected_weights, index, axis=-1)
+
+        order = np.argpartition(
+            selected, sorted({k for band in bands for k in band}), axis=-1)
+        partitioned = np.take_along_axis(selected, order, axis=-1)
+        partitioned_weights = gather(order)
+
+        # normalization of the weight centers, as in weighted_quantile_1d
+        total = np.sum(partitioned_weights, axis=-1)
+        if old_style:
+            lowest = gather(np.argmin(selected, axis=-1)[:, np.newaxis])[:, 0]
+            highest = gather(np.argmax(selected, axis=-1)[:, np.newaxis])[:, 0]
+            origin = 0.5 * lowest
+            scale = total - 0.5 * highest - origin
+        else:
+            origin = 0.
+            scale = total
+
+        covered = scale > 0
+
+        for i, (q, (k1, k2)) in enumerate(zip(qs, bands)):
+            band = partitioned[:, k1:k2 + 1]
+            band_weights = partitioned_weights[:, k1:k2 + 1]
+
+            sorter = np.argsort(band, axis=-1)
+            band = np.take_along_axis(band, sorter, axis=-1)
+            band_weights = np.take_along_axis(band_weights, sorter, axis=-1)
+
+            below = np.sum(partitioned_weights[:, :k1], axis=-1)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                centers = (
+                    below[:, np.newaxis] + np.cumsum(band_weights, axis=-1)
+                    - 0.5 * band_weights - np.reshape(origin, (-1, 1))
+                ) / scale[:, np.newaxis]
+
+            # the band must bracket the quantile, unless it reaches the
+            # smallest or largest member
+            if k1 > 0:
+                covered &= centers[:, 0] <= q
+            if k2 < n - 1:
+                covered &= centers[:, -1] >= q
+
+            result[cells, i] = _interp_along_last_axis(
+                [q], centers, band)[:, 0]
+
+        fallback[cells[~covered]] = True
+
+    if fallback.any():
+        result[fallback] = _weighted_quantile_nd(
+            flat[fallback],
+            qs,
+            weights if weights.ndim == 1 else weights[fallback],
+            old_style=old_style,
+            axis=-1,
+            skipna=skipna)
+
+    result = result.reshape(moved.shape[:-1] + (len(qs), ))
+
+    if quantiles.ndim == 0:
+        return result[..., 0]
+
+    return np.moveaxis(result, -1, axis)
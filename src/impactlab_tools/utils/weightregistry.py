@@ -0,0 +1,222 @@
+"""
+Registry of ensemble model weights
+
+The ACP and GCP model weights shipped in ``impactlab_tools/assets`` are
+read once, for all projects and RCPs, into compact arrays with a prebuilt
+index of lowercase model names. Aligning the weights with the models of a
+dataset is then a single vectorized lookup, and repeated alignments of the
+same model list (e.g. calling
+:py:func:`~impactlab_tools.gcp.dist.gcp_quantiles` for every region or
+every file) are served from a cache.
+
+Custom weight sets can be registered under any project and name, and are
+then used like the default RCP weights.
+
+Example
+-------
+
+.. code-block:: python
+
+    >>> registry = get_weight_registry()
+    >>> registry.align(['CCSM4', 'GFDL-ESM2G'], project='gcp', rcp='rcp85')
+    array([0.0229, 0.04  ])
+
+    >>> registry = WeightRegistry()
+    >>> registry.register('gcp', 'equal', {'ccsm4': 1., 'gfdl-esm2g': 1.})
+    >>> registry.align(['GFDL-ESM2G'], project='gcp', rcp='equal')
+    array([1.])
+
+"""
+
+from functools import cache
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import impactlab_tools.assets
+
+
+# projects with a weights file in the assets directory
+_ASSET_PROJECTS = ('acp', 'gcp')
+
+# number of aligned model lists kept per registry
+_ALIGNED_CACHE_SIZE = 256
+
+
+class WeightRegistry:
+    """
+    Model weights by project and RCP, indexed by lowercase model name
+
+    Use :py:func:`get_weight_registry` for the shared registry of the
+    default ACP and GCP weights.
+    """
+
+    def __init__(self):
+        self._weights = {}
+        self._index = {}
+        self._aligned = {}
+
+    @classmethod
+    def from_assets(cls, projects=_ASSET_PROJECTS):
+        """
+        Read the weights files of ``projects`` from the assets directory
+        """
+        registry = cls()
+
+        for project in projects:
+            table = pd.read_csv(
+                os.path.join(
+                    os.path.dirname(impactlab_tools.assets.__file__),
+                    f'weights_{project}.csv'))
+
+            for rcp, weights in table.groupby('rcp', sort=False):
+                registry.register(
+                    project, rcp, weights.set_index('model')['weight'])
+
+        return registry
+
+    def keys(self):
+        """Registered ``(project, rcp)`` weight sets"""
+        return list(self._weights)
+
+    def register(self, project, rcp, weights, overwrite=False):
+        """
+        Add a weight set
+
+        Parameters
+        ----------
+
+        project : str
+
+            project of the weight set, e.g. ``'gcp'``
+
+        rcp : str
+
+            name of the weight set within the project, e.g. an RCP
+
+        weights : mapping, pandas.Series or xarray.DataArray
+
+            weights by model name. Model names are case insensitive.
+
+        overwrite : bool, optional
+
+            if True, replace an existing weight set of the same name instead
+            of raising a ``ValueError``. Default False.
+        """
+        key = (project, rcp)
+
+        if key in self._weights and not overwrite:
+            raise ValueError(
+                f'Weights for project "{project}", rcp "{rcp}" are already '
+                'registered. Use overwrite=True to replace them.')
+
+        if isinstance(weights, xr.DataArray):
+            weights = weights.to_series()
+
+        weights = pd.Series(weights, dtype='float64')
+        index = pd.Index(_lower(weights.index.values))
+
+        if index.has_duplicates:
+            raise ValueError(
+                'Duplicate (case insensitive) models in weights: '
+                f'{sorted(set(index[index.duplicated()]))}')
+
+        values = weights.values.copy()
+        values.flags.writeable = False
+
+        self._weights[key] = values
+        self._index[key] = index
+        self._aligned.pop(key, None)
+
+    def weights(self, project='gcp', rcp='rcp85'):
+        """
+        Weight set as a :py:class:`xarray.DataArray` along ``model``, with
+        lowercase model names
+        """
+        key = self._check_key(project, rcp)
+
+        return xr.DataArray(
+            self._weights[key],
+            dims=['model'],
+            coords={'model': self._index[key].values},
+            name='weight')
+
+    def align(self, models, project='gcp', rcp='rcp85'):
+        """
+        Weights of ``models``, in the same order
+
+        Parameters
+        ----------
+
+        models : array-like
+
+            model names (case insensitive), e.g. the coordinate of the
+            model dimension of a dataset
+
+        project : str, optional
+
+            project of the weight set (default ``'gcp'``)
+
+        rcp : str, optional
+
+            name of the weight set (default ``'rcp85'``)
+
+        Returns
+        -------
+
+        numpy.ndarray
+
+            read-only array of weights aligned with ``models``
+        """
+        key = self._check_key(project, rcp)
+
+        models = tuple(np.asarray(models).ravel().tolist())
+        aligned = self._aligned.setdefault(key, {})
+
+        if models not in aligned:
+            positions = self._index[key].get_indexer(_lower(models))
+
+            if (positions < 0).any():
+                unknown = [m for m, p in zip(models, positions) if p < 0]
+                raise KeyError(
+                    f'No weights for models {unknown} in project '
+                    f'"{project}", rcp "{rcp}"')
+
+            weights = self._weights[key][positions]
+            weights.flags.writeable = False
+
+            if len(aligned) >= _ALIGNED_CACHE_SIZE:
+                aligned.clear()
+
+            aligned[models] = weights
+
+        return aligned[models]
+
+    def _check_key(self, project, rcp):
+        key = (project, rcp)
+
+        if key not in self._weights:
+            raise KeyError(
+                f'No weights registered for project "{project}", rcp '
+                f'"{rcp}". Available: {self.keys()}')
+
+        return key
+
+
+@cache
+def get_weight_registry():
+    """
+    Shared :py:class:`WeightRegistry` of the default ACP and GCP weights
+
+    The weights files are read on the first call only. Custom weight sets
+    registered here are available to
+    :py:func:`~impactlab_tools.gcp.dist.gcp_quantiles` and
+    :py:func:`~impactlab_tools.acp.dist.acp_quantiles` through ``rcp``.
+    """
+    return WeightRegistry.from_assets()
+
+
+def _lower(names):
+    return np.char.lower(np.asarray(names, dtype=str))
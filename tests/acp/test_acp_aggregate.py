@@ -0,0 +1,149 @@
+import os
+
+import impactlab_tools.acp.aggregate
+import impactlab_tools.assets
+import xarray as xr
+import numpy as np
+
+import pytest
+
+
+@pytest.fixture
+def pop():
+    return xr.load_dataset(
+        os.path.join(
+            os.path.dirname(impactlab_tools.assets.__file__),
+            'ACP_county_census_pop.nc'))
+
+
+def groupby_mean(ds, pop, level, year=2012):
+    return (
+        (ds * pop[str(year)]).groupby(level).sum(dim='fips') /
+        pop[str(year)].groupby(level).sum(dim='fips'))
+
+
+@pytest.mark.parametrize(
+    'level', ['fips', 'state', 'state_names', 'census', 'national'])
+def test_population_weighted_mean(pop, level):
+    '''
+    Asserts the sparse aggregation matches the groupby definition
+    '''
+
+    da = xr.DataArray(
+        np.random.random((3, pop.sizes['fips'], 2)),
+        dims=['year', 'fips', 'draw'],
+        coords={'fips': pop.fips.values, 'year': [2020, 2021, 2022]})
+
+    da[0, 5, 0] = np.nan
+
+    for data in [da, da.isel(fips=slice(100, 700)), da.chunk({'year': 1})]:
+        xr.testing.assert_allclose(
+            impactlab_tools.acp.aggregate.population_weighted_mean(
+                data, level, pop=pop).compute(),
+            groupby_mean(data.compute(), pop, level))
+
+
+def test_population_weighted_mean_levels(pop):
+    '''
+    Asserts levels rolled up from finer levels match the groupby definition
+    '''
+
+    levels = ['national', 'state', 'census', 'state_abbrevs']
+
+    ds = xr.Dataset({
+        'a': (('fips', 'year'), np.random.random((pop.sizes['fips'], 3))),
+        'b': ('year', [1., 2., 3.])}, coords={'fips': pop.fips.values})
+
+    means = impactlab_tools.acp.aggregate.population_weighted_mean(
+        ds.isel(fips=slice(200, 1500)), levels, pop=pop)
+
+    for level in levels:
+        expected = groupby_mean(ds.isel(fips=slice(200, 1500)), pop, level)
+
+        for var in ds.data_vars:
+            xr.testing.assert_allclose(
+                means[level][var],
+                expected[var].transpose(*means[level][var].dims))
+
+    combined = impactlab_tools.acp.aggregate.population_weighted_mean(
+        ds.a, levels, pop=pop, combine_dim='region')
+
+    assert combined.dims == ('region', 'year')
+    np.testing.assert_allclose(
+        combined.sel(level='census').values,
+        groupby_mean(ds.a, pop, 'census').values)
+
+
+def test_population_weighted_mean_default_pop(pop, monkeypatch):
+    '''
+    Asserts the default population is read once and aggregates the data
+    '''
+
+    da = xr.DataArray(
+        np.random.random((pop.sizes['fips'], 2)),
+        dims=['county', 'draw'],
+        coords={'county': pop.fips.values})
+
+    impactlab_tools.acp.aggregate.acp_population()
+
+    def no_io(*args, **kwargs):
+        raise AssertionError('the population asset was read again')
+
+    monkeypatch.setattr(xr, 'open_dataset', no_io)
+
+    mean = impactlab_tools.acp.aggregate.population_weighted_mean(
+        da, 'census', dim='county', year=2014)
+
+    expected = groupby_mean(da.rename(county='fips'), pop, 'census', 2014)
+
+    xr.testing.assert_allclose(mean, expected)
+
+
+def test_population_weighted_mean_year_dim(pop):
+    '''
+    Asserts time-varying weights match aggregating each year separately
+    '''
+
+    da = xr.DataArray(
+        np.random.random((pop.sizes['fips'], 4, 2)),
+        dims=['fips', 'time', 'draw'],
+        coords={'fips': pop.fips.values, 'time': [2008, 2011, 2014, 2050]})
+
+    means = impactlab_tools.acp.aggregate.population_weighted_mean(
+        da, 'state', year_dim='time', pop=pop)
+
+    for time, year in zip(da.time.values, [2010, 2011, 2014, 2014]):
+        xr.testing.assert_allclose(
+            means.sel(time=time, drop=True),
+            groupby_mean(da.sel(time=time, drop=True), pop, 'state', year))
+
+    interpolated = impactlab_tools.acp.aggregate.population_weighted_mean(
+        da.assign_coords(time=[2010, 2010.5, 2011, 2012]), 'national',
+        year_dim='time', year_method='linear')
+
+    weights = (pop['2010'] + pop['2011']) / 2
+    np.testing.assert_allclose(
+        interpolated.isel(time=1).values.ravel(),
+        ((da.isel(time=1) * weights).sum('fips') / weights.sum()).values)
+
+
+def test_population_weighted_mean_cache_size(pop, monkeypatch):
+    '''
+    Asserts the membership matrix cache is bounded
+    '''
+
+    monkeypatch.setattr(impactlab_tools.acp.aggregate, '_MEMBERSHIP_CACHE', {})
+    monkeypatch.setattr(
+        impactlab_tools.acp.aggregate, '_MEMBERSHIP_CACHE_SIZE', 2)
+
+    da = xr.DataArray(
+        np.random.random(pop.sizes['fips']), dims=['fips'],
+        coords={'fips': pop.fips.values})
+
+    for level in ['state', 'census', 'national']:
+        xr.testing.assert_allclose(
+            impactlab_tools.acp.aggregate.population_weighted_mean(
+                da, level, pop=pop),
+            groupby_mean(da, pop, level))
+
+    assert len(impactlab_tools.acp.aggregate._MEMBERSHIP_CACHE) <= 2
@@ -0,0 +1,126 @@
+import impactlab_tools.gcp.aggregate
+import xarray as xr
+import numpy as np
+
+import pytest
+
+
+@pytest.fixture
+def regions():
+    hierarchy = impactlab_tools.gcp.aggregate.region_hierarchy()
+    return hierarchy.index.values[::7]
+
+
+def groupby_prefix(data, level, weights=None):
+    hierids = data.hierid.to_index()
+
+    if level == 'iso':
+        groups = hierids.str.split('.').str[0]
+    elif level == 'admin1':
+        groups = hierids.str.split('.').str[:2].str.join('.')
+    else:
+        groups = np.full(len(hierids), 'global')
+
+    group = xr.DataArray(
+        np.asarray(groups), dims=['hierid'], coords={'hierid': hierids},
+        name=level)
+
+    if weights is None:
+        weights = xr.ones_like(data.hierid, dtype='float64')
+
+    return (
+        (data * weights).groupby(group).sum('hierid') /
+        (data.notnull() * weights).groupby(group).sum('hierid'))
+
+
+@pytest.mark.parametrize('level', ['admin1', 'iso', 'global'])
+def test_aggregate_regions(regions, level):
+    '''
+    Asserts the sparse aggregation matches a groupby on hierid prefixes
+    '''
+
+    da = xr.DataArray(
+        np.random.random((2, len(regions), 3)),
+        dims=['year', 'hierid', 'batch'],
+        coords={'hierid': regions, 'year': [2020, 2050]})
+
+    da[0, 10, 1] = np.nan
+
+    pop = xr.DataArray(
+        np.random.random(len(regions)) * 1000,
+        dims=['hierid'],
+        coords={'hierid': regions})
+
+    for data in [da, da.chunk({'year': 1})]:
+        xr.testing.assert_allclose(
+            impactlab_tools.gcp.aggregate.aggregate_regions(
+                data, level).compute(),
+            groupby_prefix(da, level).transpose('year', level, 'batch'))
+
+        xr.testing.assert_allclose(
+            impactlab_tools.gcp.aggregate.aggregate_regions(
+                data, level, weights=pop).compute(),
+            groupby_prefix(da, level, pop).transpose('year', level, 'batch'))
+
+
+def test_aggregate_regions_levels(regions):
+    '''
+    Asserts several levels, time-varying weights and sums on a Dataset
+    '''
+
+    ds = xr.Dataset(
+        {
+            'a': (('hierid', 'year'), np.random.random((len(regions), 3))),
+            'b': ('year', [1., 2., 3.])},
+        coords={'hierid': regions, 'year': [2020, 2030, 2040]})
+
+    pop = xr.DataArray(
+        np.random.random((3, len(regions))),
+        dims=['year', 'hierid'],
+        coords={'hierid': regions, 'year': [2020, 2030, 2040]})
+
+    means = impactlab_tools.gcp.aggregate.aggregate_regions(
+        ds, ['iso', 'global'], weights=pop)
+
+    for level in ['iso', 'global']:
+        expected = groupby_prefix(ds.a, level, pop)
+        xr.testing.assert_allclose(
+            means[level].a, expected.transpose(level, 'year'))
+        xr.testing.assert_allclose(
+            means[level].b,
+            ds.b.broadcast_like(expected).transpose(*means[level].b.dims))
+
+    sums = impactlab_tools.gcp.aggregate.aggregate_regions(
+        ds.a, 'iso', how='sum')
+
+    np.testing.assert_allclose(
+        sums.sel(iso='CAN').values,
+        ds.a.sel(hierid=ds.hierid.str.startswith('CAN.')).sum('hierid'))
+
+    with pytest.raises(IndexError):
+        impactlab_tools.gcp.aggregate.aggregate_regions(
+            ds.assign_coords(hierid=['XXX.1'] + list(regions[1:])))
+
+    with pytest.raises(ValueError):
+        impactlab_tools.gcp.aggregate.aggregate_regions(ds, 'county')
+
+
+def test_aggregate_regions_cache_size(regions, monkeypatch):
+    '''
+    Asserts the membership matrix cache is bounded
+    '''
+
+    monkeypatch.setattr(impactlab_tools.gcp.aggregate, '_MATRIX_CACHE', {})
+    monkeypatch.setattr(
+        impactlab_tools.gcp.aggregate, '_MATRIX_CACHE_SIZE', 2)
+
+    for size in [10, 20, 30]:
+        da = xr.DataArray(
+            np.random.random(size), dims=['hierid'],
+            coords={'hierid': regions[:size]})
+
+        xr.testing.assert_allclose(
+            impactlab_tools.gcp.aggregate.aggregate_regions(da, 'iso'),
+            groupby_prefix(da, 'iso'))
+
+    assert len(impactlab_tools.gcp.aggregate._MATRIX_CACHE) <= 2
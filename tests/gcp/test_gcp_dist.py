@@ -73,3 +73,54 @@ def test_gcp_quantiles():
 
     if da.mean(dim='quantile') != 1:
         raise ValueError
+
+
+def test_gcp_quantiles_model_batch():
+    models = ['GFDL-ESM2G', 'MIROC-ESM-CHEM', 'surrogate_CanESM2_99']
+
+    # each model has the same median but a different number of batches
+    data = xr.DataArray(
+        [[1, 2, 3, np.nan], [0, 2, 4, np.nan], [2, 2, 2, 2]],
+        dims=['model', 'batch'],
+        coords={'model': models})
+
+    da = impactlab_tools.gcp.dist.gcp_quantiles(
+        data, rcp='rcp85', quantiles=[0.5], dim=['model', 'batch'],
+        skipna=True)
+
+    assert da.dims == ('quantile', )
+    assert da.sel(quantile=0.5) == 2
+
+
+def test_gcp_quantiles_multiple_rcps(rcp85_models):
+    data = xr.DataArray(
+        np.random.random((len(rcp85_models), 3)),
+        dims=['model', 'region'],
+        coords={'model': rcp85_models})
+
+    da = impactlab_tools.gcp.dist.gcp_quantiles(
+        data, rcp=['rcp45', 'rcp85'])
+
+    assert da.dims == ('rcp', 'quantile', 'region')
+
+    for rcp in ['rcp45', 'rcp85']:
+        xr.testing.assert_allclose(
+            da.sel(rcp=rcp, drop=True),
+            impactlab_tools.gcp.dist.gcp_quantiles(data, rcp=rcp))
+
+
+def test_gcp_cdf_threshold_map(rcp85_models):
+
+    da = xr.DataArray(
+        np.random.random((len(rcp85_models), 3)),
+        dims=['model', 'region'],
+        coords=[rcp85_models, ['a', 'b', 'c']])
+
+    medians = impactlab_tools.gcp.dist.gcp_quantiles(
+        da, rcp='rcp85', quantiles=[0.5]).sel(quantile=0.5, drop=True)
+
+    exceedance = impactlab_tools.gcp.dist.gcp_cdf(
+        da, medians, rcp='rcp85', exceedance=True)
+
+    assert exceedance.dims == ('region', )
+    np.testing.assert_allclose(exceedance.values, 0.5)
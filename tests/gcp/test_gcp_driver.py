@@ -0,0 +1,133 @@
+import importlib.util
+
+import impactlab_tools.gcp.dist
+import impactlab_tools.gcp.driver
+import xarray as xr
+import numpy as np
+
+import pytest
+
+
+@pytest.fixture
+def ensemble_files(tmp_path):
+    models = ['GFDL-ESM2G', 'MIROC-ESM-CHEM', 'CCSM4', 'inmcm4']
+
+    ds = xr.Dataset(
+        {
+            'rebased': (
+                ('model', 'batch', 'hierid', 'year'),
+                np.random.random((4, 3, 23, 5))),
+            'other': (('model', 'hierid'), np.random.random((4, 23)))},
+        coords={
+            'model': models,
+            'batch': range(3),
+            'hierid': [f'REG.{i}' for i in range(23)],
+            'year': range(2020, 2025)})
+
+    paths = []
+    for model in models:
+        path = str(tmp_path / f'{model}.nc')
+        ds.sel(model=[model]).to_netcdf(path)
+        paths.append(path)
+
+    return ds, paths
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_compute_gcp_quantiles(ensemble_files, tmp_path, processes):
+    pytest.importorskip('dask')
+
+    ds, paths = ensemble_files
+    output = str(tmp_path / 'quantiles.nc')
+
+    impactlab_tools.gcp.driver.compute_gcp_quantiles(
+        str(tmp_path / '*.nc'), output, rcp='rcp85', dim=['model', 'batch'],
+        variables=['rebased'], block_size=5, processes=processes,
+        progress=False).close()
+
+    expected = impactlab_tools.gcp.dist.gcp_quantiles(
+        ds[['rebased']], rcp='rcp85', dim=['model', 'batch'])
+
+    with xr.open_dataset(output) as result:
+        xr.testing.assert_allclose(result, expected)
+
+
+def test_compute_gcp_quantiles_resume(ensemble_files, tmp_path):
+    pytest.importorskip('dask')
+
+    ds, paths = ensemble_files
+    output = str(tmp_path / 'quantiles.nc')
+    parts = output + '.parts'
+
+    impactlab_tools.gcp.driver.main([
+        *paths, '-o', output, '--rcp', 'rcp85', '--variable', 'other',
+        '--block-size', '10', '-j', '1', '--keep-parts', '--quiet'])
+
+    # computed blocks are reused, not recomputed
+    part = impactlab_tools.gcp.driver._part_path(parts, 10, 20)
+    marked = xr.load_dataset(part) + 1000
+    marked.to_netcdf(part)
+
+    with impactlab_tools.gcp.driver.compute_gcp_quantiles(
+            paths, output, rcp='rcp85', variables=['other'], block_size=10,
+            processes=1, keep_parts=True, progress=False) as result:
+
+        # the output is opened lazily, not loaded
+        assert result.encoding['source'] == output
+        assert not result.other.variable._in_memory
+
+        assert (result.other.isel(hierid=slice(10, 20)) > 1000).all()
+        assert (result.other.isel(hierid=slice(0, 10)) < 1000).all()
+        assert (result.other.isel(hierid=slice(20, None)) < 1000).all()
+
+    with pytest.raises(ValueError):
+        impactlab_tools.gcp.driver.compute_gcp_quantiles(
+            paths, output, rcp='rcp45', variables=['other'], block_size=10,
+            processes=1, progress=False)
+
+
+def test_compute_gcp_quantiles_zarr(ensemble_files, tmp_path):
+    '''
+    Asserts blocks are written by region into a Zarr store
+    '''
+
+    pytest.importorskip('dask')
+    pytest.importorskip('zarr')
+
+    ds, paths = ensemble_files
+    output = str(tmp_path / 'quantiles.zarr')
+
+    with impactlab_tools.gcp.driver.compute_gcp_quantiles(
+            paths, output, rcp='rcp85', dim=['model', 'batch'],
+            variables=['rebased'], block_size=5, processes=1,
+            progress=False) as result:
+
+        assert result.rebased.chunks is not None
+
+        xr.testing.assert_allclose(
+            result.compute(),
+            impactlab_tools.gcp.dist.gcp_quantiles(
+                ds[['rebased']], rcp='rcp85', dim=['model', 'batch']))
+
+
+def test_compute_gcp_quantiles_requirements(
+        ensemble_files, tmp_path, monkeypatch):
+    '''
+    Asserts missing output dependencies are reported before any block is
+    computed
+    '''
+
+    ds, paths = ensemble_files
+    find_spec = importlib.util.find_spec
+
+    monkeypatch.setattr(
+        importlib.util, 'find_spec',
+        lambda name, *args: None if name == 'zarr' else find_spec(name, *args))
+
+    output = str(tmp_path / 'quantiles.zarr')
+
+    with pytest.raises(ImportError, match='zarr'):
+        impactlab_tools.gcp.driver.compute_gcp_quantiles(
+            paths, output, rcp='rcp85', processes=1, progress=False)
+
+    assert not (tmp_path / 'quantiles.zarr.parts').exists()
@@ -0,0 +1,115 @@
+import tracemalloc
+
+import impactlab_tools.gcp.reindex
+import xarray as xr
+import numpy as np
+
+import pytest
+
+
+def test_region_index_roundtrip():
+    '''
+    Asserts both conversions follow the order of the data, not the mapping
+    '''
+
+    index = impactlab_tools.gcp.reindex.get_region_index()
+    mapping = impactlab_tools.gcp.reindex._get_impactregion_mapping()
+
+    positions = np.random.permutation(len(index))[:500]
+    shapenums = mapping.SHAPENUM.values[positions]
+
+    da = xr.DataArray(
+        np.arange(500.), dims=['SHAPENUM'], coords={'SHAPENUM': shapenums})
+
+    by_hierid = impactlab_tools.gcp.reindex.shapenum_to_hierid(da)
+
+    np.testing.assert_array_equal(
+        by_hierid.hierid.values, mapping.hierid.values[positions].astype(str))
+
+    by_shapenum = impactlab_tools.gcp.reindex.hierid_to_shapenum(by_hierid)
+
+    np.testing.assert_array_equal(by_shapenum.SHAPENUM.values, shapenums)
+    np.testing.assert_array_equal(by_shapenum.values, da.values)
+
+    # bytes hierids, as stored in the asset, are accepted
+    np.testing.assert_array_equal(
+        index.to_shapenum(mapping.hierid.values[positions]), shapenums)
+
+    # the cached mapping is not modified
+    assert mapping.hierid.dtype.kind == 'S'
+
+
+def test_region_index_missing():
+    da = xr.DataArray(
+        [1., 2.], dims=['hierid'], coords={'hierid': ['ABW', 'XXX.1']})
+
+    with pytest.raises(IndexError, match='XXX.1'):
+        impactlab_tools.gcp.reindex.hierid_to_shapenum(da)
+
+    for shapenums in [[1, 10 ** 6], [1, 1.5], [1, -2]]:
+        with pytest.raises(IndexError):
+            impactlab_tools.gcp.reindex.shapenum_to_hierid(
+                xr.DataArray(
+                    [1., 2.], dims=['SHAPENUM'],
+                    coords={'SHAPENUM': shapenums}))
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_reindex_without_copy(chunked):
+    '''
+    Asserts copy=False shares the data buffers and leaves the input as is
+    '''
+
+    ds = xr.Dataset(
+        {'var': (('batch', 'SHAPENUM'), np.random.random((3, 24378)))},
+        coords={'SHAPENUM': np.arange(1, 24379)})
+
+    if chunked:
+        ds = ds.chunk({'batch': 1})
+
+    relabelled = impactlab_tools.gcp.reindex.shapenum_to_hierid(ds, copy=False)
+    copied = impactlab_tools.gcp.reindex.shapenum_to_hierid(ds)
+
+    assert 'SHAPENUM' in ds.dims
+
+    if chunked:
+        assert relabelled['var'].data.name == ds['var'].data.name
+        xr.testing.assert_identical(relabelled.compute(), copied.compute())
+
+    else:
+        assert np.shares_memory(relabelled['var'].values, ds['var'].values)
+        assert not np.shares_memory(copied['var'].values, ds['var'].values)
+        xr.testing.assert_identical(relabelled, copied)
+
+    back = impactlab_tools.gcp.reindex.hierid_to_shapenum(
+        relabelled, copy=False)
+
+    if not chunked:
+        assert np.shares_memory(back['var'].values, ds['var'].values)
+
+    np.testing.assert_array_equal(back.SHAPENUM.values, ds.SHAPENUM.values)
+
+
+def test_reindex_without_copy_memory():
+    '''
+    Asserts copy=False allocates the new coordinate, not a copy of the data
+    '''
+
+    ds = xr.Dataset(
+        {'var': (('batch', 'SHAPENUM'), np.random.random((100, 24378)))},
+        coords={'SHAPENUM': np.arange(1, 24379)})
+
+    # builds the cached region index outside of the measurement
+    impactlab_tools.gcp.reindex.get_region_index()
+
+    peaks = {}
+    for copy in [False, True]:
+        tracemalloc.start()
+        try:
+            impactlab_tools.gcp.reindex.shapenum_to_hierid(ds, copy=copy)
+            peaks[copy] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    assert peaks[False] < ds['var'].nbytes / 4
+    assert peaks[True] > ds['var'].nbytes
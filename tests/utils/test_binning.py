@@ -0,0 +1,34 @@
+
+import pytest
+
+import xarray as xr
+import numpy as np
+
+from impactlab_tools.utils.binning import binned_statistic_1d
+
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32', 'int64'])
+@pytest.mark.parametrize(
+    'statistic', ['count', 'sum', 'mean', 'min', 'max', 'median'])
+@pytest.mark.parametrize(
+    'bins,value_range', [(10, None), (7, (-5, 5)), ([-20, -3, 0, 2, 20], None)])
+def test_numba_engine_matches_scipy(dtype, statistic, bins, value_range):
+    '''
+    Asserts the compiled engine matches scipy.stats.binned_statistic
+    '''
+
+    pytest.importorskip('numba')
+
+    da = xr.DataArray(
+        (np.random.normal(size=(6, 40)) * 10).astype(dtype),
+        dims=('a', 'b'),
+        coords={'a': list('uvwxyz')})
+
+    for dim in da.dims:
+        expected = binned_statistic_1d(
+            da, dim, bins, statistic, value_range=value_range)
+
+        result = binned_statistic_1d(
+            da, dim, bins, statistic, value_range=value_range, engine='numba')
+
+        xr.testing.assert_allclose(result, expected)
@@ -1,12 +1,13 @@
 
 
+import pickle
 import pytest
 
 import xarray as xr
 import numpy as np
 import pandas as pd
 
-from impactlab_tools.utils import weighting
+from impactlab_tools.utils import weighting, weightregistry
 
 
 @pytest.yield_fixture
@@ -98,3 +99,953 @@ def test_unsorted_weights_index(increasing_array):
             )
 
         assert (weighted == manual).all()
+
+
+@pytest.mark.parametrize('old_style', [False, True])
+@pytest.mark.parametrize('values_sorted', [False, True])
+def test_vectorized_matches_1d(random_array, old_style, values_sorted):
+    '''
+    Asserts the N-D weighted_quantile engine matches weighted_quantile_1d
+    '''
+
+    weights = np.array([0.1, 0.4, 0, 0.3, 0.2])
+    quantiles = [0, 0.05, 0.17, 0.5, 0.83, 0.95, 1]
+
+    for axis in range(random_array.ndim):
+        expected = np.apply_along_axis(
+            weighting.weighted_quantile_1d,
+            axis,
+            random_array.values,
+            quantiles,
+            weights,
+            values_sorted,
+            old_style)
+
+        result = weighting.weighted_quantile(
+            random_array.values,
+            quantiles,
+            weights,
+            values_sorted=values_sorted,
+            old_style=old_style,
+            axis=axis)
+
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_quantiles_out_of_range(random_array):
+    '''
+    Asserts weighted_quantile rejects quantiles outside [0, 1]
+    '''
+
+    with pytest.raises(ValueError):
+        weighting.weighted_quantile(
+            random_array.values, [0.5, 50], np.ones(5), axis=0)
+
+
+def test_dask_weighted_quantile_is_lazy(random_array):
+    '''
+    Asserts weighted_quantile_xr stays lazy on dask-backed data
+    '''
+
+    pytest.importorskip('dask')
+
+    chunked = random_array.chunk({'x': 2, 'y': 2, 'z': 2})
+    weights = [0.1, 0.4, 0, 0.3, 0.2]
+
+    for dim in random_array.dims:
+        expected = weighting.weighted_quantile_xr(
+            random_array, [0.17, 0.5, 0.83], weights, dim=dim)
+
+        result = weighting.weighted_quantile_xr(
+            chunked, [0.17, 0.5, 0.83], weights, dim=dim)
+
+        assert result.chunks is not None
+        assert result.dims == expected.dims
+
+        xr.testing.assert_identical(result.compute(), expected)
+
+
+def test_dataset_matches_dataarrays(random_array, increasing_array):
+    '''
+    Asserts Dataset quantiles match per-variable DataArray quantiles
+    '''
+
+    ds = xr.Dataset({
+        'a': random_array,
+        'b': increasing_array,
+        'c': random_array.transpose('z', 'x', 'y') * 2,
+        'd': random_array.isel(x=0)})
+
+    weights = pd.Series(
+        [0.25, 0.5, 0.25, 0, 0],
+        index=pd.Index(['x' + str(i) for i in [2, 4, 1, 3, 0]]))
+
+    result = weighting.weighted_quantile_xr(
+        ds, [0.17, 0.5, 0.83], weights, dim='x')
+
+    assert list(result.data_vars) == ['a', 'b', 'c', 'd']
+
+    for var in ['a', 'b', 'c']:
+        expected = weighting.weighted_quantile_xr(
+            ds[var], [0.17, 0.5, 0.83], weights, dim='x')
+
+        xr.testing.assert_equal(result[var], expected)
+
+    xr.testing.assert_identical(result['d'], ds['d'])
+
+
+def test_weighted_distribution_queries(random_array):
+    '''
+    Asserts WeightedDistribution matches the one-shot functions
+    '''
+
+    weights = np.array([0.1, 0.4, 0, 0.3, 0.2])
+    quantiles = [0.05, 0.17, 0.5, 0.83, 0.95]
+
+    for axis in range(random_array.ndim):
+        dist = weighting.WeightedDistribution(
+            random_array.values, weights, axis=axis)
+
+        np.testing.assert_array_equal(
+            dist.quantile(quantiles),
+            weighting.weighted_quantile(
+                random_array.values, quantiles, weights, axis=axis))
+
+        mean = np.average(random_array.values, weights=weights, axis=axis)
+        np.testing.assert_allclose(dist.mean(), mean)
+
+        anomaly = random_array.values - np.expand_dims(mean, axis)
+        np.testing.assert_allclose(
+            dist.std(),
+            np.sqrt(np.average(anomaly ** 2, weights=weights, axis=axis)))
+
+        # cdf inverts quantile within the range of the data
+        median = dist.quantile(0.5)
+        np.testing.assert_allclose(
+            np.moveaxis(dist.cdf([-1, 2]), axis, -1), [[[0, 1]] * 5] * 5)
+        np.testing.assert_allclose(
+            [dist.cdf(m)[idx] for idx, m in np.ndenumerate(median)],
+            0.5)
+
+
+def test_weighted_distribution_xr(random_array):
+    '''
+    Asserts WeightedDistributionXr matches weighted_quantile_xr
+    '''
+
+    weights = [0.1, 0.4, 0, 0.3, 0.2]
+
+    for dim in random_array.dims:
+        dist = weighting.WeightedDistributionXr(random_array, weights, dim)
+
+        xr.testing.assert_equal(
+            dist.quantile([0.17, 0.5, 0.83]),
+            weighting.weighted_quantile_xr(
+                random_array, [0.17, 0.5, 0.83], weights, dim=dim))
+
+        assert dist.mean().dims == random_array.isel(**{dim: 0}).dims
+        assert dist.cdf([0.5]).dims == tuple(
+            d if d != dim else 'threshold' for d in random_array.dims)
+
+
+@pytest.mark.parametrize('old_style', [False, True])
+@pytest.mark.parametrize('n', [5, 64, 1000])
+def test_select_matches_sort(n, old_style):
+    '''
+    Asserts the selection algorithm matches the sorting algorithm
+    '''
+
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(4, n, 3))
+    weights = rng.random(n) + 0.01
+    quantiles = [0, 0.001, 0.05, 0.5, 0.95, 0.999, 1]
+
+    expected = weighting.weighted_quantile(
+        values, quantiles, weights, old_style=old_style, axis=1)
+
+    result = weighting.weighted_quantile(
+        values, quantiles, weights, old_style=old_style, axis=1,
+        algorithm='select')
+
+    np.testing.assert_allclose(result, expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('old_style', [False, True])
+def test_select_many_cells(monkeypatch, old_style):
+    '''
+    Asserts all cells are partitioned at once, and that cells with NaNs or
+    skewed weights fall back to sorting
+    '''
+
+    rng = np.random.default_rng(1)
+    values = rng.normal(size=(3, 5, 20000))
+    weights = np.broadcast_to(rng.random(20000) + 0.01, values.shape).copy()
+    quantiles = [0.05, 0.5, 0.95]
+
+    values[0, 1, 7] = np.nan
+    weights[2, 3, values[2, 3] > 1] *= 1000
+
+    partitioned = []
+    argpartition = np.argpartition
+
+    def spy(a, *args, **kwargs):
+        partitioned.append(a.shape)
+        return argpartition(a, *args, **kwargs)
+
+    monkeypatch.setattr(np, 'argpartition', spy)
+
+    for skipna in [False, True]:
+        result = weighting.weighted_quantile(
+            values, quantiles, weights, old_style=old_style, axis=-1,
+            algorithm='select', skipna=skipna)
+
+        expected = weighting.weighted_quantile(
+            values, quantiles, weights, old_style=old_style, axis=-1,
+            skipna=skipna)
+
+        np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-12)
+
+    assert partitioned == [(14, 20000)] * 2
+
+
+def test_select_xr(random_array):
+    '''
+    Asserts weighted_quantile_xr accepts the selection algorithm
+    '''
+
+    weights = [0.1, 0.4, 0, 0.3, 0.2]
+
+    for dim in random_array.dims:
+        xr.testing.assert_allclose(
+            weighting.weighted_quantile_xr(
+                random_array, [0.5], weights, dim=dim, algorithm='select'),
+            weighting.weighted_quantile_xr(
+                random_array, [0.5], weights, dim=dim))
+
+    with pytest.raises(ValueError):
+        weighting.weighted_quantile_xr(
+            random_array, [0.5], weights, dim='x', algorithm='bogus')
+
+
+def test_sketch_exact_without_compression(random_array):
+    '''
+    Asserts a small sketch reproduces weighted_quantile exactly
+    '''
+
+    weights = [0.1, 0.4, 0, 0.3, 0.2]
+
+    sketch = weighting.WeightedQuantileSketch(size=10)
+    for i, weight in enumerate(weights):
+        sketch.update(random_array.values[..., i], weight)
+
+    np.testing.assert_allclose(
+        sketch.quantile([0.05, 0.5, 0.95]),
+        weighting.weighted_quantile(
+            random_array.values, [0.05, 0.5, 0.95], weights, axis=-1))
+
+    assert (sketch.rank_error == 0).all()
+
+
+def test_sketch_merge_error_bound():
+    '''
+    Asserts merged sketches stay within their reported rank error
+    '''
+
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(size=(4, 3, 2000))
+    weights = rng.random(2000)
+
+    sketches = [
+        weighting.WeightedQuantileSketch(size=50, seed=i) for i in range(3)]
+    for start in range(0, 2000, 20):
+        sketches[start % 3].update(
+            values[..., start:start+20], weights[start:start+20], axis=-1)
+
+    sketch = pickle.loads(pickle.dumps(sketches[0]))
+    sketch.merge(sketches[1]).merge(sketches[2])
+
+    assert sketch.values.shape[-1] < 150 + 2 * len(sketch.levels)
+    np.testing.assert_allclose(sketch.total_weight, weights.sum())
+
+    quantiles = np.linspace(0.01, 0.99, 99)
+    estimates = sketch.quantile(quantiles)
+
+    for idx in np.ndindex(sketch.shape):
+        ranks = np.sum(
+            weights[:, np.newaxis] * (
+                values[idx][:, np.newaxis] <= estimates[idx]),
+            axis=0) / weights.sum()
+        assert (np.abs(ranks - quantiles) <= sketch.rank_error[idx]).all()
+
+    with pytest.raises(ValueError):
+        sketch.update(np.ones((2, 2)), 1.)
+
+
+def test_sketch_error_independent_of_size():
+    '''
+    Asserts the rank error bound stays of order 1 / size, and holds, for
+    ensembles much larger than size ** 2
+    '''
+
+    rng = np.random.default_rng(0)
+    size = 20
+
+    bounds = {}
+    for n in [size ** 2, 100 * size ** 2]:
+        values = rng.normal(size=(2, n))
+        weights = rng.random(n) + 0.5
+
+        sketch = weighting.WeightedQuantileSketch(size=size, seed=0)
+        for start in range(0, n, 50):
+            sketch.update(
+                values[:, start:start+50], weights[start:start+50], axis=-1)
+
+        assert sketch.values.shape[-1] < 3 * size + 2 * len(sketch.levels)
+
+        bounds[n] = sketch.rank_error
+        assert (bounds[n] < 10 / size).all()
+
+        estimates = sketch.quantile([0.05, 0.5, 0.95])
+        for cell in range(2):
+            ranks = np.sum(
+                weights[:, np.newaxis] * (
+                    values[cell][:, np.newaxis] <= estimates[cell]),
+                axis=0) / weights.sum()
+            assert (
+                np.abs(ranks - [0.05, 0.5, 0.95]) <= bounds[n][cell]).all()
+
+    assert (bounds[100 * size ** 2] < 1.5 * bounds[size ** 2]).all()
+
+
+@pytest.mark.parametrize('algorithm', ['sort', 'select'])
+def test_skipna(algorithm):
+    '''
+    Asserts skipna drops NaN members and renormalizes weights per cell
+    '''
+
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(6, 7, 9))
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[0, 0] = np.nan
+    weights = rng.random(9)
+    quantiles = [0, 0.17, 0.5, 0.83, 1]
+
+    result = weighting.weighted_quantile(
+        values, quantiles, weights, axis=-1, skipna=True,
+        algorithm=algorithm)
+
+    assert np.isnan(result[0, 0]).all()
+
+    for idx in np.ndindex(values.shape[:-1]):
+        valid = ~np.isnan(values[idx])
+        if valid.any():
+            np.testing.assert_allclose(
+                result[idx],
+                weighting.weighted_quantile_1d(
+                    values[idx][valid], quantiles, weights[valid]))
+
+
+def test_skipna_xr(random_array):
+    '''
+    Asserts weighted_quantile_xr ignores missing models with skipna
+    '''
+
+    weights = [0.1, 0.4, 0, 0.3, 0.2]
+    missing = random_array.where(random_array.x != 'x3')
+
+    xr.testing.assert_allclose(
+        weighting.weighted_quantile_xr(
+            missing, [0.5], weights, dim='x', skipna=True),
+        weighting.weighted_quantile_xr(
+            random_array.isel(x=[0, 1, 2, 4]), [0.5], [0.1, 0.4, 0, 0.2],
+            dim='x'))
+
+
+def test_multiple_dims_normalizes_sample_counts():
+    '''
+    Asserts pooled model x batch quantiles split model weights by sample count
+    '''
+
+    rng = np.random.default_rng(0)
+    data = xr.DataArray(
+        rng.normal(size=(4, 3, 6)),
+        dims=('region', 'model', 'batch'),
+        coords={'model': ['a', 'b', 'c']})
+
+    # model "c" only has three batches
+    data[:, 2, 3:] = np.nan
+    weights = pd.Series([0.5, 0.3, 0.2], index=['c', 'a', 'b'])
+
+    result = weighting.weighted_quantile_xr(
+        data, [0.1, 0.5, 0.9], weights, dim=['model', 'batch'], skipna=True)
+
+    assert result.dims == ('region', 'quantile')
+
+    for region in range(4):
+        values = []
+        sample_weight = []
+        for i, model in enumerate(['a', 'b', 'c']):
+            samples = data.values[region, i]
+            samples = samples[~np.isnan(samples)]
+            values.extend(samples)
+            sample_weight.extend([weights[model] / len(samples)] * len(samples))
+
+        np.testing.assert_allclose(
+            result.values[region],
+            weighting.weighted_quantile_1d(
+                np.array(values), [0.1, 0.5, 0.9], np.array(sample_weight)))
+
+
+def test_multiple_dims_matches_stack(random_array):
+    '''
+    Asserts per-member weights over several dims match a stacked array
+    '''
+
+    weights = xr.DataArray(
+        np.random.random((5, 5)), dims=('z', 'x'),
+        coords={'x': random_array.x, 'z': random_array.z})
+
+    result = weighting.weighted_quantile_xr(
+        random_array, [0.17, 0.5, 0.83], weights, dim=['x', 'z'])
+
+    stacked = random_array.stack(member=('x', 'z')).drop_vars(
+        ['member', 'x', 'z'])
+
+    expected = weighting.weighted_quantile_xr(
+        stacked, [0.17, 0.5, 0.83],
+        weights.transpose('x', 'z').values.ravel(), dim='member')
+
+    xr.testing.assert_allclose(result, expected.transpose('quantile', 'y'))
+
+
+@pytest.mark.parametrize('algorithm', ['sort', 'select'])
+def test_multiple_weight_sets(random_array, algorithm):
+    '''
+    Asserts a mapping of weight sets matches separate calls
+    '''
+
+    weights = {
+        'a': [0.1, 0.4, 0, 0.3, 0.2],
+        'b': np.ones(5),
+        'c': pd.Series([0.25, 0.5, 0.25, 0, 0], index=[
+            'x' + str(i) for i in [2, 4, 1, 3, 0]])}
+
+    result = weighting.weighted_quantile_xr(
+        random_array, [0.17, 0.5, 0.83], weights, dim='x',
+        algorithm=algorithm)
+
+    assert result.dims == ('weighting', 'quantile', 'y', 'z')
+    assert list(result.weighting.values) == ['a', 'b', 'c']
+
+    for key, weight in weights.items():
+        xr.testing.assert_allclose(
+            result.sel(weighting=key, drop=True),
+            weighting.weighted_quantile_xr(
+                random_array, [0.17, 0.5, 0.83], weight, dim='x'))
+
+
+@pytest.mark.parametrize('skipna', [False, True])
+@pytest.mark.parametrize('old_style', [False, True])
+def test_numba_engine_matches_numpy(skipna, old_style):
+    '''
+    Asserts the compiled engine matches the NumPy reference
+    '''
+
+    pytest.importorskip('numba')
+
+    values = np.random.random((4, 33, 6))
+    if skipna:
+        values[np.random.random(values.shape) < 0.2] = np.nan
+        values[0, :, 0] = np.nan
+
+    quantiles = [0, 0.05, 0.17, 0.5, 0.83, 0.95, 1]
+
+    for weights in [np.random.random(33), np.random.random((4, 6, 33))]:
+        expected = weighting.weighted_quantile(
+            values, quantiles, weights, old_style=old_style, axis=1,
+            skipna=skipna)
+
+        result = weighting.weighted_quantile(
+            values, quantiles, weights, old_style=old_style, axis=1,
+            skipna=skipna, engine='numba')
+
+        np.testing.assert_allclose(result, expected, equal_nan=True)
+
+
+@pytest.mark.filterwarnings('ignore:invalid value:RuntimeWarning')
+@pytest.mark.parametrize('old_style', [False, True])
+def test_numba_engine_degenerate_weights(old_style):
+    '''
+    Asserts single members and all-zero weights match the NumPy engine
+    '''
+
+    pytest.importorskip('numba')
+
+    quantiles = [0, 0.17, 0.5, 0.83, 1]
+
+    cases = [
+        (np.random.random((5, 1)), np.ones(1)),
+        (np.random.random((5, 4)), np.zeros(4)),
+        (np.random.random((5, 70)), np.zeros(70))]
+
+    for values, weights in cases:
+        expected = weighting.weighted_quantile(
+            values, quantiles, weights, old_style=old_style, axis=1)
+
+        result = weighting.weighted_quantile(
+            values, quantiles, weights, old_style=old_style, axis=1,
+            engine='numba')
+
+        assert np.isfinite(result).all()
+        np.testing.assert_allclose(result, expected)
+
+
+def test_numba_engine_option(random_array):
+    '''
+    Asserts set_options selects the engine of weighted_quantile_xr
+    '''
+
+    pytest.importorskip('numba')
+
+    from impactlab_tools.utils.engines import set_options
+
+    weights = {'a': np.random.random(5), 'b': np.ones(5)}
+    expected = weighting.weighted_quantile_xr(
+        random_array, [0.17, 0.5, 0.83], weights, dim=['x', 'y'])
+
+    with set_options(engine='numba'):
+        result = weighting.weighted_quantile_xr(
+            random_array, [0.17, 0.5, 0.83], weights, dim=['x', 'y'])
+
+    xr.testing.assert_allclose(result, expected)
+
+    with pytest.raises(ValueError):
+        weighting.weighted_quantile(
+            random_array.values, 0.5, np.ones(5), axis=0, engine='fortran')
+
+
+def test_weighted_summary(random_array):
+    '''
+    Asserts weighted_summary matches the separate statistics
+    '''
+
+    weights = np.random.random(5)
+    quantiles = [0.17, 0.5, 0.83]
+
+    summary = weighting.weighted_summary(
+        random_array.chunk({'y': 2}), 'x', weights, quantiles=quantiles,
+        moments=['mean', 'std', 'min', 'max'])
+
+    assert summary.chunks is not None
+    assert summary.dims == ('stat', 'y', 'z')
+    assert list(summary.stat.values) == [
+        'mean', 'std', 'min', 'max', 'q0.17', 'q0.5', 'q0.83']
+
+    dist = weighting.WeightedDistributionXr(random_array, weights, 'x')
+
+    xr.testing.assert_allclose(
+        summary.sel(stat='mean', drop=True), dist.mean())
+    xr.testing.assert_allclose(summary.sel(stat='std', drop=True), dist.std())
+    xr.testing.assert_allclose(
+        summary.sel(stat='min', drop=True), random_array.min('x'))
+    xr.testing.assert_allclose(
+        summary.sel(stat='max', drop=True), random_array.max('x'))
+
+    expected = weighting.weighted_quantile_xr(
+        random_array, quantiles, weights, dim='x')
+
+    np.testing.assert_allclose(
+        summary.isel(stat=slice(4, None)).values, expected.values)
+
+    with pytest.raises(ValueError):
+        weighting.weighted_summary(random_array, 'x', moments=['kurtosis'])
+
+
+def test_weighted_summary_nan(random_array):
+    '''
+    Asserts every statistic of a cell with NaN members is NaN without skipna
+    '''
+
+    weights = np.random.random(5)
+    quantiles = [0.17, 0.5, 0.83]
+    moments = ['mean', 'var', 'std', 'skew', 'min', 'max']
+
+    data = random_array.copy()
+    data[2, 1, 3] = np.nan
+
+    summary = weighting.weighted_summary(
+        data, 'x', weights, quantiles=quantiles, moments=moments)
+
+    # moments are NaN, as with numpy; quantiles follow weighted_quantile_xr
+    for moment in moments:
+        assert summary.sel(stat=moment).isel(y=1, z=3).isnull()
+        assert summary.sel(stat=moment).isel(y=0).notnull().all()
+
+    expected = weighting.weighted_quantile_xr(
+        data, quantiles, weights, dim='x')
+
+    np.testing.assert_allclose(
+        summary.isel(stat=slice(len(moments), None)).values, expected.values)
+
+    skipped = weighting.weighted_summary(
+        data, 'x', weights, quantiles=quantiles, moments=moments,
+        skipna=True)
+
+    assert skipped.notnull().all()
+    np.testing.assert_allclose(
+        skipped.sel(stat='min').isel(y=1, z=3),
+        data.isel(y=1, z=3).min('x'))
+
+
+def test_weighted_cdf(random_array):
+    '''
+    Asserts weighted_cdf inverts weighted_quantile_xr cell by cell
+    '''
+
+    # no member holds enough weight to clamp the 0.3 quantile to its value
+    weights = np.random.random(5) + 1
+
+    thresholds = weighting.weighted_quantile_xr(
+        random_array, [0.3], weights, dim='x').sel(quantile=0.3, drop=True)
+
+    probability = weighting.weighted_cdf(
+        random_array.chunk({'y': 2}), thresholds, weights, dim='x')
+
+    assert probability.dims == ('y', 'z')
+    np.testing.assert_allclose(probability.values, 0.3)
+
+    dist = weighting.WeightedDistributionXr(random_array, weights, 'x')
+
+    xr.testing.assert_allclose(
+        weighting.weighted_cdf(random_array, [0.2, 0.8], weights, dim='x'),
+        dist.cdf([0.2, 0.8]))
+
+
+@pytest.mark.parametrize('skipna', [False, True])
+def test_weighted_cdf_1d(skipna):
+    '''
+    Asserts weighted_cdf accepts array thresholds for an ensemble without
+    other dimensions
+    '''
+
+    da = xr.DataArray([1., 2., 3., 4.], dims=['model'])
+    weights = [0.1, 0.4, 0.3, 0.2]
+
+    expected = weighting.WeightedDistribution(da.values, weights).cdf(
+        [1.5, 2.5])
+
+    probability = weighting.weighted_cdf(
+        da, [1.5, 2.5], weights, skipna=skipna)
+
+    assert probability.dims == ('threshold', )
+    np.testing.assert_allclose(probability.values, expected)
+
+    thresholds = xr.DataArray(
+        [[1.5, 2.5]], dims=['region', 'level'], coords={'region': ['a']})
+
+    probability = weighting.weighted_cdf(
+        da.chunk(), thresholds, weights, skipna=skipna)
+
+    assert probability.dims == ('region', 'level')
+    np.testing.assert_allclose(probability.values, [expected])
+
+
+@pytest.mark.parametrize('skipna', [False, True])
+def test_rank_index(random_array, tmp_path, skipna):
+    '''
+    Asserts queries through a saved rank index match sorting, and that
+    the index is refused once the data change
+    '''
+
+    from impactlab_tools.utils import rankindex
+
+    data = random_array.copy()
+    data[0, 0, 0] = np.nan
+
+    path = str(tmp_path / 'index.nc')
+    rankindex.build_rank_index(data, 'x', path=path)
+    index = rankindex.open_rank_index(path, data)
+
+    assert index.order().dtype == np.int8
+
+    weights = np.random.random(5)
+
+    xr.testing.assert_allclose(
+        weighting.weighted_quantile_xr(
+            data, [0, 0.17, 0.5, 1], weights, 'x', skipna=skipna,
+            rank_index=index),
+        weighting.weighted_quantile_xr(
+            data, [0, 0.17, 0.5, 1], weights, 'x', skipna=skipna))
+
+    xr.testing.assert_allclose(
+        weighting.weighted_cdf(
+            data, [0.2, 0.5], weights, 'x', skipna=skipna, rank_index=index),
+        weighting.weighted_cdf(data, [0.2, 0.5], weights, 'x', skipna=skipna))
+
+    data[1, 1, 1] = 2.
+
+    with pytest.raises(ValueError):
+        weighting.weighted_quantile_xr(
+            data, [0.5], weights, 'x', rank_index=index)
+
+
+def test_rank_index_dataset_source(random_array, tmp_path):
+    '''
+    Asserts variables of a Dataset are checked against the Dataset's source
+    store, without changing the variables' encoding
+    '''
+
+    from impactlab_tools.utils import rankindex
+
+    store = tmp_path / 'data.zarr'
+    (store / 'var').mkdir(parents=True)
+    (store / 'var' / '0.0.0').write_bytes(b'0')
+
+    ds = random_array.to_dataset(name='var')
+    ds.encoding['source'] = str(store)
+
+    path = str(tmp_path / 'index.nc')
+    rankindex.build_rank_index(ds, 'x', path=path)
+
+    assert 'source' not in ds['var'].encoding
+
+    weights = np.random.random(5)
+
+    xr.testing.assert_allclose(
+        weighting.weighted_cdf(
+            ds, [0.2, 0.5], weights, 'x',
+            rank_index=rankindex.open_rank_index(path))['var'],
+        weighting.weighted_cdf(random_array, [0.2, 0.5], weights, 'x'))
+
+    (store / 'var' / '0.0.0').write_bytes(b'00')
+
+    with pytest.raises(ValueError):
+        weighting.weighted_cdf(
+            ds, [0.5], weights, 'x',
+            rank_index=rankindex.open_rank_index(path))
+
+
+def test_rank_index_zarr(random_array, tmp_path):
+    '''
+    Asserts a rank index of a Zarr store round-trips through Zarr, and is
+    refused once the store's chunks are rewritten
+    '''
+
+    pytest.importorskip('zarr')
+
+    from impactlab_tools.utils import rankindex
+
+    store = str(tmp_path / 'data.zarr')
+    random_array.to_dataset(name='var').to_zarr(store, mode='w')
+
+    ds = xr.open_zarr(store)
+
+    path = str(tmp_path / 'x.zarr')
+    built = rankindex.build_rank_index(ds, 'x', path=path)
+    index = rankindex.open_rank_index(path, ds)
+
+    xr.testing.assert_equal(index.order('var'), built.order('var'))
+    assert index.order('var').attrs['fingerprint'] == (
+        built.order('var').attrs['fingerprint'])
+
+    assert 'source' not in ds['var'].encoding
+
+    weights = np.random.random(5)
+
+    # an index opened without data is checked against a new read of the
+    # unchanged store through its files
+    xr.testing.assert_allclose(
+        weighting.weighted_quantile_xr(
+            xr.open_zarr(store), [0.17, 0.5], weights, 'x',
+            rank_index=rankindex.open_rank_index(path))['var'],
+        weighting.weighted_quantile_xr(
+            random_array, [0.17, 0.5], weights, 'x'))
+
+    changed = random_array.copy()
+    changed[1, 1, 1] = 2.
+    changed.to_dataset(name='var').to_zarr(store, mode='w')
+
+    with pytest.raises(ValueError):
+        rankindex.open_rank_index(path, xr.open_zarr(store))
+
+
+def test_weighted_distribution_add(random_array):
+    '''
+    Asserts merging new members matches a distribution built at once
+    '''
+
+    weights = np.random.random(5)
+
+    dist = weighting.WeightedDistributionXr(
+        random_array.isel(y=slice(0, 2)), weights[:2], 'y')
+    dist.add(
+        random_array.isel(y=slice(2, None)).transpose('z', 'y', 'x'),
+        weights[2:])
+
+    expected = weighting.WeightedDistributionXr(random_array, weights, 'y')
+
+    xr.testing.assert_allclose(
+        dist.quantile([0.17, 0.5, 0.83]),
+        expected.quantile([0.17, 0.5, 0.83]))
+    xr.testing.assert_allclose(dist.mean(), expected.mean())
+
+    with pytest.raises(ValueError):
+        dist.add(random_array.isel(y=[0]), weights[:1])
+
+
+def test_weighted_distribution_add_aligns_cells(random_array):
+    '''
+    Asserts new members merge into the cells with the same labels
+    '''
+
+    weights = np.random.random(5)
+
+    dist = weighting.WeightedDistributionXr(
+        random_array.isel(y=slice(0, 2)), weights[:2], 'y')
+    dist.add(
+        random_array.isel(y=slice(2, None), x=[3, 0, 4, 1, 2], z=[4, 3, 2, 1, 0]),
+        weights[2:])
+
+    expected = weighting.WeightedDistributionXr(random_array, weights, 'y')
+
+    xr.testing.assert_allclose(
+        dist.quantile([0.17, 0.5, 0.83]),
+        expected.quantile([0.17, 0.5, 0.83]))
+
+    with pytest.raises(ValueError):
+        dist.add(
+            random_array.isel(y=[2], x=[0, 1, 2, 3]).assign_coords(y=['new']),
+            weights[:1])
+
+
+def test_weighted_quantile_bootstrap(random_array):
+    '''
+    Asserts batched bootstrap resamples match resampling one at a time
+    '''
+
+    weights = np.random.random(5)
+
+    resampled = weighting.weighted_quantile_bootstrap(
+        random_array.chunk({'y': 2}), [0.17, 0.5, 0.83], weights, 'x',
+        n_resamples=20, seed=42, batch_size=3)
+
+    assert resampled.dims == ('resample', 'quantile', 'y', 'z')
+
+    indices = np.random.default_rng(42).integers(0, 5, (20, 5))
+
+    for i in [0, 7, 19]:
+        sample = random_array.isel(x=indices[i]).drop_vars('x')
+        np.testing.assert_allclose(
+            resampled.isel(resample=i).values,
+            weighting.weighted_quantile_xr(
+                sample, [0.17, 0.5, 0.83], weights[indices[i]], 'x').values)
+
+    ci = weighting.weighted_quantile_bootstrap(
+        random_array, [0.5], weights, 'x', n_resamples=20, seed=42,
+        confidence_level=0.9)
+
+    assert ci.dims == ('bound', 'quantile', 'y', 'z')
+    assert (ci.sel(bound='lower') <= ci.sel(bound='upper')).all()
+
+
+@pytest.mark.parametrize('stride, skipna', [(1, False), (2, True), (4, True)])
+def test_rolling_weighted_quantile(stride, skipna):
+    '''
+    Asserts rolling windows match pooling each window separately
+    '''
+
+    da = xr.DataArray(
+        np.random.random((12, 3, 5)),
+        dims=['year', 'region', 'model'],
+        coords={'year': range(2000, 2012)})
+
+    if skipna:
+        da[2, 0, :2] = np.nan
+        da[:, 1, 3] = np.nan
+
+    weights = np.random.random(5)
+
+    rolled = weighting.rolling_weighted_quantile(
+        da.chunk({'region': 2}), [0.17, 0.5, 0.83], weights, window=4,
+        stride=stride, skipna=skipna)
+
+    starts = range(0, 9, stride)
+    assert list(rolled.year.values) == [2003 + s for s in starts]
+    assert list(rolled.window_start.values) == [2000 + s for s in starts]
+
+    for i, start in enumerate(starts):
+        expected = weighting.weighted_quantile_xr(
+            da.isel(year=slice(start, start + 4)), [0.17, 0.5, 0.83],
+            weights, ['model', 'year'], skipna=skipna)
+
+        np.testing.assert_allclose(
+            rolled.isel(year=i).transpose(*expected.dims).values,
+            expected.values)
+
+
+def test_rolling_weighted_quantile_dataset():
+    '''
+    Asserts batches of windows match one batch, and Dataset variables
+    without the time dimension are passed through
+    '''
+
+    values = np.random.random((3, 30, 5))
+    weights = np.random.random(5)
+
+    np.testing.assert_array_equal(
+        weighting._rolling_weighted_quantile(
+            values, [0.17, 0.5, 0.83], weights, window=10, stride=2,
+            batch_size=3),
+        weighting._rolling_weighted_quantile(
+            values, [0.17, 0.5, 0.83], weights, window=10, stride=2))
+
+    ds = xr.Dataset({
+        'a': (('region', 'year', 'model'), values),
+        'b': (('region', 'model'), values[:, 0]),
+        'c': ('region', values[:, 0, 0])})
+
+    rolled = weighting.rolling_weighted_quantile(
+        ds, [0.5], weights, window=10, stride=2)
+
+    xr.testing.assert_identical(
+        rolled.a,
+        weighting.rolling_weighted_quantile(
+            ds.a, [0.5], weights, window=10, stride=2))
+
+    xr.testing.assert_identical(rolled.b, ds.b)
+    xr.testing.assert_identical(rolled.c, ds.c)
+
+
+def test_weight_registry():
+    '''
+    Asserts registry alignment matches selecting the default weights
+    '''
+
+    registry = weightregistry.get_weight_registry()
+    expected = weighting._get_weights(project='gcp', rcp='rcp45')
+
+    models = ['CCSM4', 'gfdl-esm2g', 'Surrogate_MRI-CGCM3_01']
+    aligned = registry.align(models, project='gcp', rcp='rcp45')
+
+    np.testing.assert_array_equal(
+        aligned, expected.sel(model=[m.lower() for m in models]).values)
+
+    # repeated alignments are served from the cache
+    assert registry.align(models, project='gcp', rcp='rcp45') is aligned
+
+    with pytest.raises(KeyError, match='not-a-model'):
+        registry.align(['CCSM4', 'not-a-model'], project='gcp', rcp='rcp45')
+
+    with pytest.raises(KeyError):
+        registry.align(models, project='gcp', rcp='rcp99')
+
+    custom = weightregistry.WeightRegistry()
+    custom.register('gcp', 'custom', {'CCSM4': 2., 'inmcm4': 1.})
+    np.testing.assert_array_equal(
+        custom.align(['INMCM4', 'ccsm4'], rcp='custom'), [1., 2.])
+
+    with pytest.raises(ValueError):
+        custom.register('gcp', 'custom', {'ccsm4': 1.})
+
+    with pytest.raises(ValueError):
+        custom.register('gcp', 'dup', {'ccsm4': 1., 'CCSM4': 1.})